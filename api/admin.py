@@ -1,11 +1,28 @@
-from django.contrib import admin
-from .models import Company, UserProfile, Product, Material, ProductMaterialMapping, ProductionOrder, InwardEntry
+from django import forms
+from django.contrib import admin, messages
+from django.core.exceptions import ValidationError
+from django.core.paginator import Paginator
+from django.db import connections, transaction
+from django.utils.functional import cached_property
+
+from . import stock_stripes
+from .archiving import move_all
+from .models import Company, CompanyShard, UserProfile, Product, Material, ProductMaterialMapping, ProductionOrder, InwardEntry, ArchivedProductionOrder, ArchivedInwardEntry, SlowQuery, StockReservation
+from .reservations import reserved_stock_error
+from .routing import exclude_read_only
 
 @admin.register(Company)
 class CompanyAdmin(admin.ModelAdmin):
     list_display = ('name', 'created_at')
     search_fields = ('name',)
 
+@admin.register(CompanyShard)
+class CompanyShardAdmin(admin.ModelAdmin):
+    list_display = ('company', 'database', 'read_only', 'updated_at')
+    list_filter = ('database', 'read_only')
+    search_fields = ('company__name',)
+    raw_id_fields = ('company',)
+
 @admin.register(UserProfile)
 class UserProfileAdmin(admin.ModelAdmin):
     list_display = ('user', 'company', 'role')
@@ -19,11 +36,45 @@ class ProductAdmin(admin.ModelAdmin):
     list_filter = ('company',)
     search_fields = ('name', 'company__name')
 
+class MaterialAdminForm(forms.ModelForm):
+    def clean_quantity(self):
+        quantity = self.cleaned_data['quantity']
+        if self.instance.pk and quantity is not None and quantity < self.instance.reserved_quantity:
+            raise ValidationError(
+                f'{self.instance.reserved_quantity} is reserved; release reservations before setting a lower quantity.'
+            )
+        return quantity
+
 @admin.register(Material)
 class MaterialAdmin(admin.ModelAdmin):
-    list_display = ('name', 'quantity', 'unit', 'style', 'company')
+    form = MaterialAdminForm
+    list_display = ('name', 'on_hand', 'reserved_quantity', 'unit', 'style', 'company')
     list_filter = ('company', 'style')
     search_fields = ('name', 'company__name', 'style')
+    # Maintained with the StockReservation rows by api/reservations.py; the
+    # stripes are set with the stripe_material command.
+    readonly_fields = ('reserved_quantity', 'stock_stripes')
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).with_stock()
+
+    def save_model(self, request, obj, form, change):
+        with transaction.atomic():
+            if change:
+                # Reservations may have changed since the form was loaded: save
+                # the current reserved quantity, locked until the save.
+                obj.reserved_quantity = Material.objects.select_for_update().values_list(
+                    'reserved_quantity', flat=True
+                ).get(pk=obj.pk)
+                if 'quantity' in form.changed_data and obj.quantity < obj.reserved_quantity:
+                    # Reserved after the form was validated; an exception here
+                    # would be a 500 page.
+                    self.message_user(request, reserved_stock_error([(obj.name, obj.reserved_quantity)]), messages.ERROR)
+                    return
+            if change and obj.stock_stripes and 'quantity' in form.changed_data:
+                # The entered quantity is the whole stock.
+                stock_stripes.discard([obj.pk])
+            super().save_model(request, obj, form, change)
 
 @admin.register(ProductMaterialMapping)
 class ProductMaterialMappingAdmin(admin.ModelAdmin):
@@ -31,14 +82,148 @@ class ProductMaterialMappingAdmin(admin.ModelAdmin):
     list_filter = ('company',)
     search_fields = ('product__name', 'material__name', 'company__name')
 
+class EstimatedCountPaginator(Paginator):
+    """
+    Paginator for tables with millions of rows. An unfiltered changelist on
+    PostgreSQL uses the planner's row estimate; anything else is counted, but
+    never beyond COUNT_LIMIT rows.
+    """
+    ESTIMATE_ABOVE = 100000
+    COUNT_LIMIT = 100000
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        if not queryset.query.where:
+            estimate = estimated_row_count(queryset.model, queryset.db)
+            if estimate is not None and estimate > self.ESTIMATE_ABOVE:
+                return estimate
+        # COUNT(*) over a LIMITed subquery stops scanning at the limit.
+        return queryset.order_by()[:self.COUNT_LIMIT + 1].count()
+
+
+def estimated_row_count(model, database):
+    connection = connections[database]
+    if connection.vendor != 'postgresql':
+        return None
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT reltuples::bigint FROM pg_class WHERE oid = to_regclass(%s)', [model._meta.db_table])
+        row = cursor.fetchone()
+    # reltuples is -1 until the table has been analysed.
+    return row[0] if row and row[0] >= 0 else None
+
+
+class CompanyIdFilter(admin.RelatedFieldListFilter):
+    """
+    Company filter that takes a typed-in company id instead of listing every
+    company.
+    """
+    template = 'admin/api/company_filter.html'
+
+    def has_output(self):
+        return True
+
+    @property
+    def company_id(self):
+        value = self.lookup_val[-1] if isinstance(self.lookup_val, list) else self.lookup_val
+        return value if value and value.isdigit() else None
+
+    def field_choices(self, field, request, model_admin):
+        # Only the selected company is loaded, to label the active choice.
+        if self.company_id is None:
+            return []
+        return field.get_choices(include_blank=False, limit_choices_to={'pk': self.company_id})
+
+    def hidden_params(self):
+        return [(name, value) for name, value in self.request.GET.items() if name not in (self.lookup_kwarg, 'p')]
+
+
+class LargeTableAdmin(admin.ModelAdmin):
+    """
+    Changelist settings for the append-only history tables: related rows are
+    joined, the row count is estimated or bounded, and the delete
+    confirmation summarises instead of listing every row. Dates are filtered
+    by fixed ranges rather than date_hierarchy, whose drill-down links need a
+    DISTINCT over every row's truncated date.
+    """
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    list_per_page = 50
+    list_filter = (('company', CompanyIdFilter), ('created_at', admin.DateFieldListFilter))
+    DELETE_PREVIEW = 20
+
+    def get_deleted_objects(self, objs, request):
+        if not hasattr(objs, 'model'):
+            return super().get_deleted_objects(objs, request)
+        # The history tables have no dependent rows, so a summary is complete.
+        count = objs.count()
+        preview = [str(obj) for obj in objs.select_related(*self.list_select_related)[:self.DELETE_PREVIEW]]
+        if count > len(preview):
+            preview.append(f'... and {count - len(preview)} more')
+        perms_needed = set()
+        if not self.has_delete_permission(request):
+            perms_needed.add(self.opts.verbose_name)
+        return preview, {self.opts.verbose_name_plural: count}, perms_needed, []
+
+    @admin.action(description='Move selected rows to the archive', permissions=['delete'])
+    def archive_selected(self, request, queryset):
+        # Rows of companies that are being moved stay until the move is done.
+        moved = move_all(exclude_read_only(queryset))
+        self.message_user(request, f'Archived {moved} {self.opts.verbose_name_plural}.', messages.SUCCESS)
+
+
 @admin.register(ProductionOrder)
-class ProductionOrderAdmin(admin.ModelAdmin):
+class ProductionOrderAdmin(LargeTableAdmin):
     list_display = ('product', 'quantity', 'created_at', 'company')
-    list_filter = ('company', 'created_at')
-    search_fields = ('product__name', 'company__name')
+    list_select_related = ('product', 'company')
+    autocomplete_fields = ('company', 'product')
+    search_fields = ('product__name',)
+    actions = ['archive_selected']
 
 @admin.register(InwardEntry)
-class InwardEntryAdmin(admin.ModelAdmin):
+class InwardEntryAdmin(LargeTableAdmin):
     list_display = ('material', 'quantity', 'created_at', 'company')
-    list_filter = ('company', 'created_at')
-    search_fields = ('material__name', 'company__name')
+    list_select_related = ('material', 'company')
+    autocomplete_fields = ('company', 'material')
+    search_fields = ('material__name',)
+    actions = ['archive_selected']
+
+@admin.register(ArchivedProductionOrder)
+class ArchivedProductionOrderAdmin(LargeTableAdmin):
+    list_display = ('product', 'quantity', 'created_at', 'archived_at', 'company')
+    list_select_related = ('product', 'company')
+    autocomplete_fields = ('company', 'product')
+    search_fields = ('product__name',)
+
+@admin.register(ArchivedInwardEntry)
+class ArchivedInwardEntryAdmin(LargeTableAdmin):
+    list_display = ('material', 'quantity', 'created_at', 'archived_at', 'company')
+    list_select_related = ('material', 'company')
+    autocomplete_fields = ('company', 'material')
+    search_fields = ('material__name',)
+
+@admin.register(StockReservation)
+class StockReservationAdmin(admin.ModelAdmin):
+    """
+    Read-only: reservations change Material.reserved_quantity, so they are
+    only created and released through the API and sweep_reservations.
+    """
+    list_display = ('material', 'quantity', 'note', 'expires_at', 'company')
+    list_select_related = ('material', 'company')
+    list_filter = ('company',)
+    search_fields = ('material__name', 'note')
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+@admin.register(SlowQuery)
+class SlowQueryAdmin(admin.ModelAdmin):
+    list_display = ('duration_ms', 'view', 'database', 'tenant_id', 'created_at')
+    list_filter = ('database', 'created_at')
+    search_fields = ('fingerprint', 'statement', 'view')
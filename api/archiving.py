@@ -0,0 +1,50 @@
+"""
+Moves production orders and inward entries into their archive tables. Used
+by the archive_history command and the admin's archive action.
+"""
+from django.db import transaction
+
+from .models import ArchivedInwardEntry, ArchivedProductionOrder, InwardEntry, ProductionOrder
+from .signals import VERSIONED_MODELS
+from .versioning import bump_version
+
+# Hot model -> (archive model, fields copied besides the primary key).
+ARCHIVES = {
+    ProductionOrder: (ArchivedProductionOrder, ('company_id', 'product_id', 'quantity', 'created_at')),
+    InwardEntry: (ArchivedInwardEntry, ('company_id', 'material_id', 'quantity', 'created_at')),
+}
+
+
+def move_batch(queryset, batch_size):
+    """
+    Copies up to `batch_size` rows of `queryset` into the archive table and
+    deletes them from the hot table in one transaction. Returns the number of
+    rows moved.
+    """
+    archive_model, fields = ARCHIVES[queryset.model]
+    database = queryset.db
+    with transaction.atomic(using=database):
+        rows = list(queryset.select_for_update().order_by('pk').values('pk', *fields)[:batch_size])
+        if not rows:
+            return 0
+        archive_model.objects.using(database).bulk_create([
+            archive_model(id=row['pk'], **{field: row[field] for field in fields}) for row in rows
+        ])
+        # A raw delete: nothing references these rows, and per-row delete
+        # signals would bump the resource version once per row.
+        queryset.model.objects.using(database).filter(pk__in=[row['pk'] for row in rows])._raw_delete(database)
+        for company_id in {row['company_id'] for row in rows}:
+            bump_version(company_id, VERSIONED_MODELS[queryset.model])
+    return len(rows)
+
+
+def move_all(queryset, batch_size=1000):
+    """
+    Moves every row of `queryset` in batches. Returns the number of rows moved.
+    """
+    moved = 0
+    while True:
+        count = move_batch(queryset, batch_size)
+        if not count:
+            return moved
+        moved += count
@@ -0,0 +1,187 @@
+"""
+POST /api/batch/ applies an ordered list of queued client writes in one
+round trip, so a client that worked offline can sync with one request.
+
+Each operation runs through the same viewset code as its single-request
+endpoint, in its own savepoint of one enclosing transaction. By default a
+failed operation is rolled back alone and the rest still apply. With
+`"atomic": true`, the first failure rolls back the whole batch. Every
+operation carries a client-generated `id`. A successful operation's result
+is kept in the idempotency store under that id, so a batch replayed after a
+lost response returns the stored results and does not apply anything twice.
+A batch takes one writes throttle token per operation.
+"""
+import logging
+
+from django.conf import settings
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.db import DatabaseError, IntegrityError, transaction
+from django.http import Http404
+from rest_framework import serializers, status
+from rest_framework.decorators import api_view, permission_classes, throttle_classes
+from rest_framework.exceptions import APIException, ValidationError
+from rest_framework.permissions import IsAuthenticated
+from rest_framework.response import Response
+
+from .idempotency import KeyInFlight, KeyReused, acquire, payload_fingerprint
+from .throttling import BatchRateThrottle
+from .versioning import PreconditionFailed, coalesced_bumps
+from .views import InwardEntryViewSet, MaterialViewSet, ProductionOrderViewSet
+
+# Operation type -> (viewset, action).
+OPERATIONS = {
+    'inward_entry.create': (InwardEntryViewSet, 'create'),
+    'production_order.create': (ProductionOrderViewSet, 'create'),
+    'material.update': (MaterialViewSet, 'partial_update'),
+}
+KEY_PREFIX = 'batch:'
+
+logger = logging.getLogger(__name__)
+
+
+class BatchOperationSerializer(serializers.Serializer):
+    id = serializers.CharField(max_length=200)
+    type = serializers.ChoiceField(choices=sorted(OPERATIONS))
+    data = serializers.DictField()
+    # For updates: the object to change and, optionally, the version the
+    # client last saw.
+    object_id = serializers.IntegerField(required=False)
+    version = serializers.IntegerField(required=False)
+
+    def validate(self, attrs):
+        if OPERATIONS[attrs['type']][1] != 'create' and 'object_id' not in attrs:
+            raise serializers.ValidationError({'object_id': 'This operation needs an object_id.'})
+        return attrs
+
+
+class BatchSerializer(serializers.Serializer):
+    atomic = serializers.BooleanField(default=False)
+    operations = serializers.ListField(child=BatchOperationSerializer(), min_length=1)
+
+    def validate_operations(self, operations):
+        if len(operations) > settings.BATCH_MAX_OPERATIONS:
+            raise serializers.ValidationError(f'At most {settings.BATCH_MAX_OPERATIONS} operations per batch.')
+        ids = [operation['id'] for operation in operations]
+        if len(set(ids)) != len(ids):
+            raise serializers.ValidationError('Operation ids must be unique within a batch.')
+        return operations
+
+
+class OperationFailed(Exception):
+    def __init__(self, result):
+        self.result = result
+
+
+def apply_operation(request, operation):
+    """
+    Runs one operation through its viewset and returns (status, data).
+    Raises the viewset's exceptions unchanged.
+    """
+    viewset_class, action = OPERATIONS[operation['type']]
+    kwargs = {'pk': operation['object_id']} if 'object_id' in operation else {}
+    view = viewset_class(request=request, args=(), kwargs=kwargs, format_kwarg=None, action=action)
+    view.check_permissions(request)
+    if action == 'create':
+        serializer = view.get_serializer(data=operation['data'])
+        serializer.is_valid(raise_exception=True)
+        view.perform_create(serializer)
+        return status.HTTP_201_CREATED, serializer.data
+
+    instance = view.get_object()
+    if operation.get('version', instance.version) != instance.version:
+        raise PreconditionFailed()
+    serializer = view.get_serializer(instance, data=operation['data'], partial=True)
+    serializer.is_valid(raise_exception=True)
+    view.perform_update(serializer)
+    return status.HTTP_200_OK, serializer.data
+
+
+def error_result(exc):
+    if isinstance(exc, Http404):
+        return status.HTTP_404_NOT_FOUND, {'detail': 'Not found.'}
+    if isinstance(exc, KeyReused):
+        return status.HTTP_422_UNPROCESSABLE_ENTITY, {'detail': 'This id was already used for a different operation.'}
+    if isinstance(exc, KeyInFlight):
+        return status.HTTP_409_CONFLICT, {'detail': 'An operation with this id is still being processed.'}
+    if isinstance(exc, ValidationError):
+        return exc.status_code, exc.detail
+    if isinstance(exc, DjangoValidationError):
+        return status.HTTP_400_BAD_REQUEST, exc.message_dict if hasattr(exc, 'error_dict') else {'detail': exc.messages}
+    if isinstance(exc, IntegrityError):
+        return status.HTTP_409_CONFLICT, {'detail': 'The operation conflicts with existing data.'}
+    if isinstance(exc, DatabaseError):
+        return status.HTTP_503_SERVICE_UNAVAILABLE, {'detail': 'The operation could not be applied. Please retry.'}
+    return exc.status_code, {'detail': exc.detail}
+
+
+def run_operation(request, company, operation):
+    """
+    Applies one operation in a savepoint, or replays its stored result.
+    Returns the operation's result; raises OperationFailed with it when the
+    operation failed. Database errors are caught too: the savepoint has
+    rolled the operation back, so the rest of the batch can still apply.
+    """
+    operation_fingerprint = payload_fingerprint({'user': request.user.pk, **operation})
+    try:
+        with transaction.atomic():
+            record, replay = acquire(company, KEY_PREFIX + operation['id'], operation_fingerprint)
+            if replay:
+                return {'id': operation['id'], 'status': record.status_code, 'data': record.response, 'replayed': True}
+            code, data = apply_operation(request, operation)
+            record.status_code = code
+            record.response = data
+            record.save(update_fields=['status_code', 'response'])
+    except (APIException, Http404, KeyReused, KeyInFlight, DjangoValidationError, DatabaseError) as exc:
+        if isinstance(exc, DatabaseError) and not isinstance(exc, IntegrityError):
+            logger.exception("Batch operation '%s' failed.", operation['id'])
+        code, errors = error_result(exc)
+        raise OperationFailed({'id': operation['id'], 'status': code, 'errors': errors})
+    return {'id': operation['id'], 'status': code, 'data': data}
+
+
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+@throttle_classes([BatchRateThrottle])
+def batch_apply(request):
+    """
+    Applies queued writes in order and returns one result per operation.
+    Body:
+    - operations: [{id, type, data, object_id?, version?}], types are
+      inward_entry.create, production_order.create and material.update
+    - atomic: roll back every operation if one fails (default false)
+    """
+    if not hasattr(request.user, 'profile'):
+        return Response({'error': 'Admin user cannot create company-specific resources.'}, status=status.HTTP_400_BAD_REQUEST)
+    envelope = BatchSerializer(data=request.data)
+    envelope.is_valid(raise_exception=True)
+    operations = envelope.validated_data['operations']
+    atomic = envelope.validated_data['atomic']
+    company = request.user.profile.company
+
+    results = []
+    try:
+        # The version rows are bumped once per resource after the commit, not
+        # locked by the first operation until the end of the batch.
+        with coalesced_bumps(), transaction.atomic():
+            for operation in operations:
+                try:
+                    results.append(run_operation(request, company, operation))
+                except OperationFailed as failure:
+                    results.append(failure.result)
+                    if atomic:
+                        raise
+    except OperationFailed as failure:
+        # Nothing was written: report the operations before the failure as
+        # rolled back and the ones after it as not attempted.
+        failed_id = failure.result['id']
+        rolled_back = {'status': status.HTTP_424_FAILED_DEPENDENCY, 'errors': {'detail': f"Rolled back: operation '{failed_id}' failed."}}
+        skipped = {'status': status.HTTP_424_FAILED_DEPENDENCY, 'errors': {'detail': f"Not applied: operation '{failed_id}' failed."}}
+        results = [
+            result if result.get('replayed') or result['id'] == failed_id else {'id': result['id'], **rolled_back}
+            for result in results
+        ]
+        results += [{'id': operation['id'], **skipped} for operation in operations[len(results):]]
+        return Response({'atomic': True, 'applied': False, 'results': results}, status=failure.result['status'])
+
+    applied = all(status.is_success(result['status']) for result in results)
+    return Response({'atomic': atomic, 'applied': applied, 'results': results})
@@ -0,0 +1,97 @@
+"""
+Whole-BOM replacement for a product: the submitted mapping list is diffed
+against the stored ProductMaterialMapping rows and the difference is applied
+with bulk queries in one transaction, so readers never see a half-edited BOM.
+"""
+from django.db import transaction
+from django.db.models import F
+from django.utils.http import parse_etags
+from rest_framework import serializers
+
+from .models import Material, Product, ProductMaterialMapping
+from .versioning import PreconditionFailed, bump_version
+
+
+def bom_etag(product):
+    return f'"product-{product.pk}-bom{product.bom_version}"'
+
+
+def check_bom_precondition(request, product):
+    """
+    Raises PreconditionFailed when If-Match is sent and does not name the
+    product's current BOM version.
+    """
+    if_match = request.headers.get('If-Match')
+    if not if_match:
+        return
+    client_etags = [tag.removeprefix('W/') for tag in parse_etags(if_match)]
+    if '*' not in client_etags and bom_etag(product) not in client_etags:
+        raise PreconditionFailed()
+
+
+def lock_boms(product_ids):
+    """
+    Locks the products whose BOMs a mapping write is about to change. Every
+    mapping write takes the product locks before the mapping rows, the same
+    order as replace_bom, so the two never deadlock.
+    """
+    list(Product.objects.select_for_update().filter(pk__in=product_ids).order_by('pk').values_list('pk', flat=True))
+
+
+def replace_bom(product, entries, request=None):
+    """
+    Makes `entries` ([{'material': id, 'fixed_quantity': Decimal}]) the
+    product's complete BOM. Returns (product, summary).
+    """
+    quantities = {}
+    for entry in entries:
+        if entry['material'] in quantities:
+            raise serializers.ValidationError({'material': f"Material {entry['material']} is listed more than once."})
+        quantities[entry['material']] = entry['fixed_quantity']
+
+    with transaction.atomic():
+        # Locking the product serialises concurrent replaces of the same BOM.
+        product = Product.objects.select_for_update().get(pk=product.pk)
+        if request is not None:
+            check_bom_precondition(request, product)
+
+        known = set(Material.objects.filter(company_id=product.company_id, pk__in=quantities).values_list('pk', flat=True))
+        unknown = sorted(set(quantities) - known)
+        if unknown:
+            raise serializers.ValidationError(
+                {'material': f"Materials not found in your company: {', '.join(map(str, unknown))}"}
+            )
+
+        # Locked, so the version below is one past the stored one even when a
+        # single-mapping PATCH committed after the product lock was taken.
+        existing = {
+            mapping.material_id: mapping
+            for mapping in ProductMaterialMapping.objects.select_for_update().filter(product=product)
+        }
+        to_delete = [mapping.pk for material_id, mapping in existing.items() if material_id not in quantities]
+        to_update = []
+        to_create = []
+        for material_id, fixed_quantity in quantities.items():
+            mapping = existing.get(material_id)
+            if mapping is None:
+                to_create.append(ProductMaterialMapping(
+                    company_id=product.company_id, product=product, material_id=material_id, fixed_quantity=fixed_quantity
+                ))
+            elif mapping.fixed_quantity != fixed_quantity:
+                mapping.fixed_quantity = fixed_quantity
+                mapping.version += 1
+                to_update.append(mapping)
+
+        if to_delete or to_update or to_create:
+            # Nothing references mappings, so a raw DELETE is safe; it skips the
+            # per-row post_delete signals, which would bump the versions once per row.
+            stale = ProductMaterialMapping.objects.filter(pk__in=to_delete)
+            stale._raw_delete(stale.db)
+            ProductMaterialMapping.objects.bulk_update(to_update, ['fixed_quantity', 'version'])
+            ProductMaterialMapping.objects.bulk_create(to_create)
+            Product.objects.filter(pk=product.pk).update(bom_version=F('bom_version') + 1)
+            product.refresh_from_db(fields=['bom_version'])
+            # Bulk queries skip the post_save/post_delete signals.
+            bump_version(product.company_id, 'mappings', 'products')
+
+    return product, {'created': len(to_create), 'updated': len(to_update), 'deleted': len(to_delete)}
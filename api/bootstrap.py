@@ -0,0 +1,143 @@
+"""
+One snapshot of everything the app loads at startup: the current user, the
+dashboard, products, materials, mappings and low-stock materials.
+
+The response costs one read of the company's resource versions plus a fixed
+number of list queries, whatever the size of the catalogue. The versions
+give the ETag and a `sync_token`. Passing the token back as `?since=` returns
+only the sections whose resources changed since; a section is always sent
+whole.
+"""
+import base64
+import json
+
+from rest_framework import serializers, status
+from rest_framework.decorators import api_view, permission_classes
+from rest_framework.permissions import IsAuthenticated
+from rest_framework.response import Response
+
+from . import metrics
+from .models import InwardEntry, Material, Product, ProductionOrder, ProductMaterialMapping, UserProfile
+from .routing import use_read_replica
+from .serializers import (
+    InwardEntrySerializer,
+    MaterialSerializer,
+    ProductionOrderSerializer,
+    ProductMaterialMappingSerializer,
+    ProductSerializer,
+)
+from .user_serializers import UserSerializer
+from .versioning import get_versions, is_not_modified, set_validators, validators_for
+
+# Section -> the resources whose versions it depends on.
+SECTIONS = {
+    'dashboard': ('products', 'materials', 'production_orders', 'inward_entries'),
+    'products': ('products',),
+    'materials': ('materials',),
+    'mappings': ('mappings',),
+    'low_stock_materials': ('materials',),
+}
+RESOURCES = tuple(sorted({resource for resources in SECTIONS.values() for resource in resources}))
+RECENT_ACTIVITY = 5
+
+
+def encode_sync_token(company_id, versions):
+    payload = {'company': company_id, 'versions': {resource: version for resource, (version, _) in versions.items()}}
+    return base64.urlsafe_b64encode(json.dumps(payload, separators=(',', ':')).encode()).decode().rstrip('=')
+
+
+def decode_sync_token(value, company_id):
+    """
+    Returns {resource: version} from a token issued to `company_id`.
+    """
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(value + '=' * (-len(value) % 4)))
+        if payload['company'] != company_id:
+            raise ValueError(value)
+        return {resource: int(version) for resource, version in payload['versions'].items()}
+    except (ValueError, TypeError, KeyError, AttributeError):
+        raise serializers.ValidationError({'since': 'Invalid sync token.'})
+
+
+def changed_sections(since, versions):
+    if since is None:
+        return list(SECTIONS)
+    return [
+        section for section, resources in SECTIONS.items()
+        if any(since.get(resource, 0) != versions[resource][0] for resource in resources)
+    ]
+
+
+def build_sections(company_id, sections):
+    """
+    Serializes the requested sections, loading each table at most once.
+    """
+    data = {}
+    products = materials = None
+    if 'products' in sections:
+        products = list(Product.objects.filter(company_id=company_id))
+        data['products'] = ProductSerializer(products, many=True).data
+    if 'materials' in sections or 'low_stock_materials' in sections:
+        materials = list(Material.objects.with_stock().filter(company_id=company_id))
+        if 'materials' in sections:
+            data['materials'] = MaterialSerializer(materials, many=True).data
+        if 'low_stock_materials' in sections:
+            low_stock = [material for material in materials if material.available_quantity <= material.low_stock_threshold]
+            data['low_stock_materials'] = MaterialSerializer(low_stock, many=True).data
+    if 'mappings' in sections:
+        mappings = ProductMaterialMapping.objects.filter(company_id=company_id)
+        data['mappings'] = ProductMaterialMappingSerializer(mappings, many=True).data
+    if 'dashboard' in sections:
+        orders = ProductionOrder.objects.filter(company_id=company_id).order_by('-created_at')[:RECENT_ACTIVITY]
+        entries = InwardEntry.objects.filter(company_id=company_id).order_by('-created_at')[:RECENT_ACTIVITY]
+        data['dashboard'] = {
+            'product_count': len(products) if products is not None else Product.objects.filter(company_id=company_id).count(),
+            'material_count': len(materials) if materials is not None else Material.objects.filter(company_id=company_id).count(),
+            'recent_production_orders': ProductionOrderSerializer(orders, many=True).data,
+            'recent_inward_entries': InwardEntrySerializer(entries, many=True).data,
+        }
+    return data
+
+
+@use_read_replica
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def bootstrap(request):
+    """
+    Returns the user, dashboard, products, materials, mappings and low-stock
+    materials in one response, with a sync_token for incremental refreshes.
+    Query parameters:
+    - since: a sync_token from an earlier response; only the sections that
+      changed since are included, and `sections` lists them
+    """
+    user = request.user
+    try:
+        user.profile = profile = UserProfile.objects.select_related('company').get(user=user)
+    except UserProfile.DoesNotExist:
+        # Users without a company (e.g. superusers) have nothing to sync.
+        empty = {'dashboard': {'product_count': 0, 'material_count': 0, 'recent_production_orders': [], 'recent_inward_entries': []}}
+        empty.update({section: [] for section in SECTIONS if section != 'dashboard'})
+        return Response({'user': UserSerializer(user).data, 'sync_token': None, 'sections': list(SECTIONS), **empty})
+
+    company_id = profile.company_id
+    since = request.query_params.get('since')
+    since = decode_sync_token(since, company_id) if since else None
+
+    # Read the versions before the data: a concurrent write can only make the
+    # ETag and sync token older than the body, never newer.
+    versions = get_versions(company_id, RESOURCES)
+    scope = f"bootstrap|{user.pk}|{user.username}|{user.email}|{profile.role}|{profile.company.name}|{request.query_params.get('since', '')}"
+    etag, last_modified = validators_for(company_id, versions, scope)
+    if is_not_modified(request, etag, last_modified):
+        metrics.cache_requests.inc(cache='etag', result='hit')
+        return set_validators(Response(status=status.HTTP_304_NOT_MODIFIED), etag, last_modified)
+    metrics.cache_requests.inc(cache='etag', result='miss')
+
+    sections = changed_sections(since, versions)
+    data = {
+        'user': UserSerializer(user).data,
+        'sync_token': encode_sync_token(company_id, versions),
+        'sections': sections,
+        **build_sections(company_id, sections),
+    }
+    return set_validators(Response(data), etag, last_modified)
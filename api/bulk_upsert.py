@@ -0,0 +1,128 @@
+"""
+Bulk insert-or-update of company catalogue rows keyed by (company, name).
+
+The existing rows for the submitted names are read (and locked) in one query
+to build the diff. Changed rows are then written with
+INSERT ... ON CONFLICT (company, name) DO UPDATE in batches, with the next
+version computed from the locked row; new rows are plain INSERTs, so a row
+another request created meanwhile is never overwritten with version 1 (the
+upsert is planned again instead). Unchanged rows are not written at all, so
+their versions and ETags stay the same.
+"""
+from collections import Counter
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from rest_framework import serializers, status
+from rest_framework.decorators import action
+from rest_framework.response import Response
+
+from .versioning import bump_version
+
+TRUE_VALUES = ('1', 'true', 'yes')
+
+
+class BulkUpsertMixin:
+    """
+    Adds POST <list>/bulk-upsert/ to a company-scoped viewset. The body is a
+    list of objects in the viewset's serializer format; with ?dry_run=true the
+    diff is returned without writing anything.
+    """
+    upsert_key = 'name'
+    upsert_batch_size = 1000
+
+    def get_upsert_fields(self, serializer):
+        return [name for name in serializer.child.fields if name not in ('id', self.upsert_key, 'version')
+                and not serializer.child.fields[name].read_only]
+
+    @action(detail=False, methods=['post'], url_path='bulk-upsert')
+    def bulk_upsert(self, request):
+        if not hasattr(request.user, 'profile'):
+            raise serializers.ValidationError("Admin user cannot create company-specific resources.")
+        if not isinstance(request.data, list):
+            raise serializers.ValidationError('Expected a list of objects.')
+        if len(request.data) > settings.BULK_UPSERT_MAX_ITEMS:
+            raise serializers.ValidationError(f'At most {settings.BULK_UPSERT_MAX_ITEMS} objects can be upserted at once.')
+
+        serializer = self.get_serializer(data=request.data, many=True)
+        serializer.is_valid(raise_exception=True)
+        rows = serializer.validated_data
+        keys = [row[self.upsert_key] for row in rows]
+        duplicates = sorted(key for key, count in Counter(keys).items() if count > 1)
+        if duplicates:
+            raise serializers.ValidationError({self.upsert_key: f'Duplicate values in request: {", ".join(duplicates)}'})
+
+        company = request.user.profile.company
+        model = self.get_queryset().model
+        fields = self.get_upsert_fields(serializer)
+        dry_run = request.query_params.get('dry_run', '').lower() in TRUE_VALUES
+
+        for attempt in range(2):
+            try:
+                with transaction.atomic():
+                    created, updated, unchanged = self.plan_upsert(keys, rows, fields, lock=not dry_run)
+                    if not dry_run and (created or updated):
+                        self.write_upsert(model, company, fields, created, updated)
+                break
+            except IntegrityError:
+                # Another request inserted one of the new names first; the
+                # second plan sees it as an existing row.
+                if attempt:
+                    return Response(
+                        {'error': 'Some of these rows were created concurrently. Please retry.'},
+                        status=status.HTTP_409_CONFLICT,
+                    )
+
+        summary = {'created': len(created), 'updated': len(updated), 'unchanged': unchanged, 'dry_run': dry_run}
+        if dry_run:
+            summary['diff'] = {
+                'created': [row[self.upsert_key] for row in created],
+                'updated': [{self.upsert_key: row[self.upsert_key], 'changes': changes} for _, row, changes in updated],
+            }
+        return Response(summary, status=status.HTTP_200_OK)
+
+    def plan_upsert(self, keys, rows, fields, lock):
+        """
+        Reads the existing rows for `keys` (locking them when `lock` is set)
+        and returns (created rows, [(current, row, changes)], unchanged count).
+        """
+        existing = self.get_queryset().filter(**{f'{self.upsert_key}__in': keys})
+        if lock:
+            existing = existing.select_for_update()
+        existing = {getattr(obj, self.upsert_key): obj for obj in existing}
+
+        created, updated, unchanged = [], [], 0
+        for row in rows:
+            current = existing.get(row[self.upsert_key])
+            if current is None:
+                created.append(row)
+                continue
+            changes = {
+                field: [getattr(current, field), row[field]]
+                for field in fields if field in row and getattr(current, field) != row[field]
+            }
+            if changes:
+                updated.append((current, row, changes))
+            else:
+                unchanged += 1
+        return created, updated, unchanged
+
+    def write_upsert(self, model, company, fields, created, updated):
+        versioned = any(field.name == 'version' for field in model._meta.concrete_fields)
+        # New rows are plain INSERTs: a conflict means a concurrent insert, and
+        # the IntegrityError makes the caller plan again.
+        model.objects.bulk_create([model(company=company, **row) for row in created], batch_size=self.upsert_batch_size)
+        objects = []
+        for current, row, _ in updated:
+            obj = model(company=company, **{**{field: getattr(current, field) for field in fields}, **row})
+            if versioned:
+                # The rows are locked, so the next version is known exactly.
+                obj.version = current.version + 1
+            objects.append(obj)
+        if objects:
+            model.objects.bulk_create(
+                objects, batch_size=self.upsert_batch_size, update_conflicts=True,
+                unique_fields=['company', self.upsert_key], update_fields=fields + (['version'] if versioned else []),
+            )
+        # bulk_create skips the post_save signal.
+        bump_version(company.pk, *self.get_version_resources())
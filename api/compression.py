@@ -0,0 +1,259 @@
+"""
+Response compression for API payloads.
+
+Negotiates zstd, brotli or gzip from the request's Accept-Encoding header,
+depending on which codecs are importable. Buffered responses are only
+compressed above a size threshold; streaming responses are compressed chunk by
+chunk. Per-response byte savings and CPU cost are logged and accumulated in
+`stats`.
+"""
+import gzip
+import logging
+import re
+import threading
+import time
+import zlib
+
+from django.conf import settings
+from django.utils.cache import patch_vary_headers
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    'MIN_SIZE': 1024,
+    'GZIP_LEVEL': 6,
+    'BROTLI_QUALITY': 4,
+    'ZSTD_LEVEL': 3,
+}
+
+COMPRESSIBLE_TYPES = (
+    'application/json',
+    'application/javascript',
+    'application/xml',
+    'text/',
+)
+
+_ACCEPT_ENCODING_RE = re.compile(r'^\s*([^\s;]+)\s*(?:;\s*q\s*=\s*([0-9.]+))?\s*$')
+
+
+def get_setting(name):
+    return getattr(settings, 'API_COMPRESSION', {}).get(name, DEFAULTS[name])
+
+
+class GzipCodec:
+    name = 'gzip'
+
+    def compress(self, data):
+        return gzip.compress(data, compresslevel=get_setting('GZIP_LEVEL'), mtime=0)
+
+    def stream(self):
+        compressor = zlib.compressobj(get_setting('GZIP_LEVEL'), zlib.DEFLATED, 31)
+        return compressor.compress, compressor.flush
+
+
+class BrotliCodec:
+    name = 'br'
+
+    def compress(self, data):
+        return brotli.compress(data, quality=get_setting('BROTLI_QUALITY'))
+
+    def stream(self):
+        compressor = brotli.Compressor(quality=get_setting('BROTLI_QUALITY'))
+        return compressor.process, compressor.finish
+
+
+class ZstdCodec:
+    name = 'zstd'
+
+    def compress(self, data):
+        return zstandard.ZstdCompressor(level=get_setting('ZSTD_LEVEL')).compress(data)
+
+    def stream(self):
+        compressor = zstandard.ZstdCompressor(level=get_setting('ZSTD_LEVEL')).compressobj()
+        return compressor.compress, compressor.flush
+
+
+def available_codecs():
+    """
+    Returns the usable codecs in server preference order.
+    """
+    codecs = []
+    if zstandard is not None:
+        codecs.append(ZstdCodec())
+    if brotli is not None:
+        codecs.append(BrotliCodec())
+    codecs.append(GzipCodec())
+    return codecs
+
+
+def parse_accept_encoding(header):
+    """
+    Parses an Accept-Encoding header into {coding: qvalue}.
+    """
+    accepted = {}
+    for part in header.split(','):
+        match = _ACCEPT_ENCODING_RE.match(part)
+        if not match:
+            continue
+        coding, qvalue = match.groups()
+        try:
+            accepted[coding.lower()] = float(qvalue) if qvalue is not None else 1.0
+        except ValueError:
+            continue
+    return accepted
+
+
+def negotiate(header, codecs=None):
+    """
+    Picks the codec with the highest client qvalue, preferring the server's
+    order on ties. Returns None when nothing acceptable is available.
+    """
+    if not header:
+        return None
+    accepted = parse_accept_encoding(header)
+    best, best_q = None, 0.0
+    for codec in codecs if codecs is not None else available_codecs():
+        qvalue = accepted.get(codec.name, accepted.get('*', 0.0))
+        if qvalue > best_q:
+            best, best_q = codec, qvalue
+    return best
+
+
+class CompressionStats:
+    """
+    Process-wide totals of compressed responses, keyed by encoding.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._totals = {}
+
+    def record(self, encoding, original_size, compressed_size, cpu_seconds):
+        with self._lock:
+            totals = self._totals.setdefault(
+                encoding, {'responses': 0, 'bytes_in': 0, 'bytes_out': 0, 'cpu_seconds': 0.0}
+            )
+            totals['responses'] += 1
+            totals['bytes_in'] += original_size
+            totals['bytes_out'] += compressed_size
+            totals['cpu_seconds'] += cpu_seconds
+
+    def snapshot(self):
+        with self._lock:
+            return {encoding: dict(totals) for encoding, totals in self._totals.items()}
+
+
+stats = CompressionStats()
+
+
+def _record(request, encoding, original_size, compressed_size, cpu_seconds):
+    stats.record(encoding, original_size, compressed_size, cpu_seconds)
+    logger.debug(
+        'Compressed %s with %s: %d -> %d bytes (saved %d) in %.2f ms CPU',
+        request.path, encoding, original_size, compressed_size,
+        original_size - compressed_size, cpu_seconds * 1000,
+    )
+
+
+class CompressionMiddleware:
+    """
+    Compresses API responses for clients that accept it. Place it after any
+    middleware that serves pre-compressed static files.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        response = self.get_response(request)
+        return self.process_response(request, response)
+
+    def process_response(self, request, response):
+        if response.has_header('Content-Encoding') or response.status_code in (204, 304):
+            return response
+        content_type = response.get('Content-Type', '').lower()
+        # Event streams must reach the client as soon as each event is written.
+        if not content_type.startswith(COMPRESSIBLE_TYPES) or content_type.startswith('text/event-stream'):
+            return response
+        if not response.streaming and len(response.content) < get_setting('MIN_SIZE'):
+            return response
+
+        patch_vary_headers(response, ('Accept-Encoding',))
+        codec = negotiate(request.headers.get('Accept-Encoding', ''))
+        if codec is None:
+            return response
+
+        if response.streaming:
+            if response.is_async:
+                response.streaming_content = self._compress_async_stream(
+                    request, codec, response.streaming_content
+                )
+            else:
+                response.streaming_content = self._compress_stream(request, codec, response.streaming_content)
+            del response['Content-Length']
+        else:
+            original = response.content
+            started = time.thread_time()
+            compressed = codec.compress(original)
+            cpu_seconds = time.thread_time() - started
+            if len(compressed) >= len(original):
+                return response
+            response.content = compressed
+            response['Content-Length'] = str(len(compressed))
+            _record(request, codec.name, len(original), len(compressed), cpu_seconds)
+
+        # The compressed body is a different representation of the same
+        # resource, so strong validators must be weakened.
+        etag = response.get('ETag')
+        if etag and etag.startswith('"'):
+            response['ETag'] = 'W/' + etag
+        response['Content-Encoding'] = codec.name
+        return response
+
+    def _compress_stream(self, request, codec, chunks):
+        compress, flush = codec.stream()
+        original_size = compressed_size = 0
+        cpu_seconds = 0.0
+        for chunk in chunks:
+            original_size += len(chunk)
+            started = time.thread_time()
+            data = compress(chunk)
+            cpu_seconds += time.thread_time() - started
+            if data:
+                compressed_size += len(data)
+                yield data
+        started = time.thread_time()
+        data = flush()
+        cpu_seconds += time.thread_time() - started
+        compressed_size += len(data)
+        _record(request, codec.name, original_size, compressed_size, cpu_seconds)
+        yield data
+
+    async def _compress_async_stream(self, request, codec, chunks):
+        compress, flush = codec.stream()
+        original_size = compressed_size = 0
+        cpu_seconds = 0.0
+        async for chunk in chunks:
+            original_size += len(chunk)
+            started = time.thread_time()
+            data = compress(chunk)
+            cpu_seconds += time.thread_time() - started
+            if data:
+                compressed_size += len(data)
+                yield data
+        started = time.thread_time()
+        data = flush()
+        cpu_seconds += time.thread_time() - started
+        compressed_size += len(data)
+        _record(request, codec.name, original_size, compressed_size, cpu_seconds)
+        yield data
@@ -0,0 +1,99 @@
+"""
+Connection-lifecycle visibility for the configured databases.
+
+Tracks when each physical connection was opened (via the connection_created
+signal) and reports, per alias, the connection mode, the native pool's gauges
+when pooling is enabled, and the age of the connections currently open.
+"""
+import threading
+import time
+import weakref
+
+from django.conf import settings
+from django.db import connections
+
+_lock = threading.Lock()
+# psycopg connections can be weakly referenced and may outlive the Django
+# wrapper that opened them (they go back to the pool), so they are tracked
+# directly. sqlite3 connections cannot, and live exactly as long as their
+# wrapper's connection, so the wrapper is tracked instead.
+_raw_births = weakref.WeakKeyDictionary()
+_wrapper_births = weakref.WeakKeyDictionary()
+
+
+def register_connection(connection):
+    """
+    Records the first time a physical connection is seen.
+    """
+    now = time.monotonic()
+    with _lock:
+        try:
+            _raw_births.setdefault(connection.connection, (connection.alias, now))
+        except TypeError:
+            _wrapper_births[connection] = (connection.alias, id(connection.connection), now)
+
+
+def connection_ages(alias):
+    """
+    Returns the ages in seconds of the open connections for `alias`.
+    """
+    now = time.monotonic()
+    ages = []
+    with _lock:
+        for raw, (raw_alias, born) in list(_raw_births.items()):
+            if raw_alias == alias and not getattr(raw, 'closed', False):
+                ages.append(now - born)
+        for wrapper, (wrapper_alias, raw_id, born) in list(_wrapper_births.items()):
+            if wrapper_alias == alias and wrapper.connection is not None and id(wrapper.connection) == raw_id:
+                ages.append(now - born)
+    return ages
+
+
+def pool_stats(alias):
+    """
+    Returns the native pool's gauges for `alias`, or None when it is not pooled.
+    """
+    pool = getattr(connections[alias], 'pool', None)
+    if pool is None:
+        return None
+    stats = pool.get_stats()
+    requests = stats.get('requests_num', 0)
+    return {
+        'size': stats.get('pool_size', 0),
+        'available': stats.get('pool_available', 0),
+        'min_size': stats.get('pool_min', 0),
+        'max_size': stats.get('pool_max', 0),
+        'requests_waiting': stats.get('requests_waiting', 0),
+        'requests': requests,
+        'wait_ms_total': stats.get('requests_wait_ms', 0),
+        'wait_ms_avg': stats.get('requests_wait_ms', 0) / requests if requests else 0.0,
+        'connection_errors': stats.get('connections_errors', 0),
+        'connections_lost': stats.get('connections_lost', 0),
+    }
+
+
+def connection_stats():
+    """
+    Returns a snapshot of connection gauges for every configured alias.
+    """
+    snapshot = {}
+    for alias, config in settings.DATABASES.items():
+        pool = pool_stats(alias)
+        ages = connection_ages(alias)
+        if pool is not None:
+            mode = 'pooled'
+        elif config.get('CONN_MAX_AGE', 0) == 0:
+            mode = 'per-request'
+        else:
+            mode = 'persistent'
+        snapshot[alias] = {
+            'vendor': connections[alias].vendor,
+            'mode': mode,
+            'conn_max_age': config.get('CONN_MAX_AGE', 0),
+            'health_checks': config.get('CONN_HEALTH_CHECKS', False),
+            'pool': pool,
+            'open_connections': len(ages),
+            'connection_age_max_seconds': max(ages) if ages else 0.0,
+            'connection_age_avg_seconds': sum(ages) / len(ages) if ages else 0.0,
+        }
+    return snapshot
@@ -0,0 +1,109 @@
+"""
+Sparse fieldsets (`?fields=`) and embedded related objects (`?expand=`) for
+read requests.
+
+Both parameters take comma-separated, optionally dotted paths:
+`?expand=mappings.material&fields=id,name,mappings.fixed_quantity`. Expanded
+relations are loaded with select_related (foreign keys) or a Prefetch
+(reverse relations, and foreign keys whose serializer needs an annotated
+queryset), so the query count does not depend on the number of rows. Conditional GETs include the expanded resources' versions in the ETag.
+"""
+from django.db.models import Prefetch
+from rest_framework import serializers
+from rest_framework.permissions import SAFE_METHODS
+
+MAX_EXPAND_DEPTH = 3
+
+
+def parse_paths(value):
+    """
+    Turns 'a,b.c,b.d' into {'a': {}, 'b': {'c': {}, 'd': {}}}.
+    """
+    tree = {}
+    for path in value.split(','):
+        node = tree
+        for part in filter(None, (segment.strip() for segment in path.split('.'))):
+            node = node.setdefault(part, {})
+    return tree
+
+
+def _depth(tree):
+    return 1 + max(map(_depth, tree.values())) if tree else 0
+
+
+def check_expand(serializer_class, tree, path=''):
+    """
+    Raises ValidationError for paths that are not expandable.
+    """
+    expandable = serializer_class.get_expandable_fields()
+    for name, subtree in tree.items():
+        if name not in expandable:
+            allowed = ', '.join(sorted(f'{path}{field}' for field in expandable)) or 'none'
+            raise serializers.ValidationError({'expand': f"'{path}{name}' cannot be expanded. Allowed: {allowed}."})
+        check_expand(expandable[name][0], subtree, f'{path}{name}.')
+
+
+def expanded_resources(serializer_class, tree):
+    resources = set()
+    expandable = serializer_class.get_expandable_fields()
+    for name, subtree in tree.items():
+        nested_class, resource, _ = expandable[name]
+        resources.add(resource)
+        resources |= expanded_resources(nested_class, subtree)
+    return resources
+
+
+def optimize_queryset(queryset, serializer_class, tree, prefix=''):
+    """
+    Adds the select_related and prefetch_related calls that load `tree`.
+    """
+    expandable = serializer_class.get_expandable_fields()
+    for name, subtree in tree.items():
+        nested_class, _, many = expandable[name]
+        lookup = f'{prefix}{name}'
+        nested = nested_class.get_expand_queryset()
+        if many or nested is not None:
+            nested = optimize_queryset(
+                nested_class.Meta.model.objects.all() if nested is None else nested, nested_class, subtree
+            )
+            queryset = queryset.prefetch_related(Prefetch(lookup, queryset=nested))
+        else:
+            queryset = optimize_queryset(queryset.select_related(lookup), nested_class, subtree, f'{lookup}__')
+    return queryset
+
+
+class ExpandableViewSetMixin:
+    """
+    Passes the parsed `?fields=` / `?expand=` of read requests to the
+    serializer and loads the expanded relations with the queryset. Place it
+    before ConditionalGetMixin.
+    """
+
+    def get_field_selection(self):
+        if not hasattr(self, '_field_selection'):
+            fields, expand = None, {}
+            if self.request.method in SAFE_METHODS:
+                if self.request.query_params.get('fields'):
+                    fields = parse_paths(self.request.query_params['fields'])
+                expand = parse_paths(self.request.query_params.get('expand', ''))
+                if _depth(expand) > MAX_EXPAND_DEPTH:
+                    raise serializers.ValidationError({'expand': f'At most {MAX_EXPAND_DEPTH} levels can be expanded.'})
+                check_expand(self.get_serializer_class(), expand)
+            self._field_selection = fields, expand
+        return self._field_selection
+
+    def get_serializer(self, *args, **kwargs):
+        fields, expand = self.get_field_selection()
+        kwargs.setdefault('fields', fields)
+        kwargs.setdefault('expand', expand)
+        return super().get_serializer(*args, **kwargs)
+
+    def filter_queryset(self, queryset):
+        queryset = super().filter_queryset(queryset)
+        _, expand = self.get_field_selection()
+        return optimize_queryset(queryset, self.get_serializer_class(), expand)
+
+    def get_version_resources(self):
+        _, expand = self.get_field_selection()
+        extra = expanded_resources(self.get_serializer_class(), expand)
+        return tuple(super().get_version_resources()) + tuple(sorted(extra - set(super().get_version_resources())))
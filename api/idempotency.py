@@ -0,0 +1,136 @@
+"""
+Idempotency-Key support for creating endpoints.
+
+The first request with a key inserts a lock row; the unique constraint on
+(company, key) makes that insert the single-flight lock. Its response is
+stored in the same transaction as the changes it made, and retries with the
+same key replay it without running the view again. Concurrent duplicates wait
+for the first request to finish.
+"""
+import hashlib
+import json
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.response import Response
+
+from .models import IdempotencyKey
+from .routing import exclude_read_only
+from .versioning import coalesced_bumps
+
+HEADER = 'Idempotency-Key'
+POLL_INTERVAL = 0.05
+
+
+class KeyReused(Exception):
+    """
+    The key was already used for a request with a different payload.
+    """
+
+
+class KeyInFlight(Exception):
+    """
+    Another request with the key did not finish within IDEMPOTENCY_LOCK_TIMEOUT.
+    """
+
+
+def payload_fingerprint(payload):
+    encoded = json.dumps(payload, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha256(encoded.encode()).hexdigest()
+
+
+def request_fingerprint(request):
+    return payload_fingerprint({'method': request.method, 'path': request.path, 'user': request.user.pk, 'data': request.data})
+
+
+def acquire(company, key, fingerprint):
+    """
+    Returns (record, replay). `replay` is True when `record` holds a finished
+    response to return as is; otherwise the caller holds the lock on `record`.
+    """
+    stale_after = timedelta(seconds=settings.IDEMPOTENCY_STALE_LOCK_SECONDS)
+    deadline = time.monotonic() + settings.IDEMPOTENCY_LOCK_TIMEOUT
+    while True:
+        now = timezone.now()
+        try:
+            with transaction.atomic():
+                record = IdempotencyKey.objects.create(
+                    company=company, key=key, fingerprint=fingerprint,
+                    expires_at=now + timedelta(seconds=settings.IDEMPOTENCY_KEY_TTL),
+                )
+            return record, False
+        except IntegrityError:
+            pass
+
+        record = IdempotencyKey.objects.filter(company=company, key=key).first()
+        if record is None:
+            # The holder failed and released the key; try to take it.
+            continue
+        stale = record.status_code is None and record.created_at <= now - stale_after
+        if record.expires_at <= now or stale:
+            IdempotencyKey.objects.filter(pk=record.pk, created_at=record.created_at).delete()
+            continue
+        if record.fingerprint != fingerprint:
+            raise KeyReused()
+        if record.status_code is not None:
+            return record, True
+        if time.monotonic() >= deadline:
+            raise KeyInFlight()
+        time.sleep(POLL_INTERVAL)
+
+
+def purge_expired(database):
+    expired = IdempotencyKey.objects.using(database).filter(expires_at__lte=timezone.now())
+    return exclude_read_only(expired).delete()[0]
+
+
+class IdempotentCreateMixin:
+    """
+    Makes `create` honour the Idempotency-Key header. Only successful
+    responses are stored; a failed request releases the key so the client
+    can correct it and retry.
+    """
+
+    def create(self, request, *args, **kwargs):
+        key = request.headers.get(HEADER)
+        if key is None or not hasattr(request.user, 'profile'):
+            return super().create(request, *args, **kwargs)
+        if not key or len(key) > 255:
+            return Response(
+                {'error': f'{HEADER} must be between 1 and 255 characters.'}, status=status.HTTP_400_BAD_REQUEST
+            )
+
+        try:
+            record, replay = acquire(request.user.profile.company, key, request_fingerprint(request))
+        except KeyReused:
+            return Response(
+                {'error': f'This {HEADER} was already used with a different request.'},
+                status=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            )
+        except KeyInFlight:
+            return Response(
+                {'error': f'A request with this {HEADER} is still being processed.'},
+                status=status.HTTP_409_CONFLICT,
+                headers={'Retry-After': '1'},
+            )
+        if replay:
+            return Response(record.response, status=record.status_code, headers={'Idempotent-Replayed': 'true'})
+
+        try:
+            # Version bumps wait for the key's transaction to commit.
+            with coalesced_bumps(), transaction.atomic():
+                response = super().create(request, *args, **kwargs)
+                if status.is_success(response.status_code):
+                    record.status_code = response.status_code
+                    record.response = response.data
+                    record.save(update_fields=['status_code', 'response'])
+        except Exception:
+            record.delete()
+            raise
+        if record.status_code is None:
+            record.delete()
+        return response
@@ -0,0 +1,401 @@
+"""
+Concurrent load testing against the app in-process or a local server.
+
+A scenario file in api/loadtest_scenarios/ describes a fixture company and a
+list of weighted tasks. Each simulated client runs in its own thread. For the
+length of the run it picks tasks by weight and records the status and
+latency of every request. Afterwards, the stock of every fixture material is
+checked against the inward entries and production orders the run created.
+"""
+import http.client
+import json
+import os
+import random
+import threading
+import time
+import urllib.parse
+from collections import Counter, defaultdict
+from datetime import timedelta
+from decimal import Decimal
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import connections, transaction
+from django.db.models import Sum
+
+from .models import (
+    ArchivedInwardEntry, ArchivedProductionOrder, Company, InwardEntry, Material, MaterialStockStripe, Product,
+    ProductionOrder, ProductMaterialMapping, StockReservation, UserProfile,
+)
+from . import stock_stripes
+from .ops_views import percentile
+
+SCENARIO_DIR = os.path.join(os.path.dirname(__file__), 'loadtest_scenarios')
+FIXTURE_DEFAULTS = {
+    'users': 5,
+    'products': 5,
+    'materials': 20,
+    'bom_size': 4,
+    'shared_materials': 0,
+    # Stock stripes for the shared materials (0: unstriped; see api/stock_stripes.py).
+    'stripes': 0,
+    'stock': '100000',
+    'password': 'loadtest-password',
+}
+USERNAME_PREFIX = 'loadtest-'
+
+
+class ScenarioError(ValueError):
+    pass
+
+
+class FixtureError(Exception):
+    pass
+
+
+class Scenario:
+    """
+    A parsed scenario file.
+    """
+
+    def __init__(self, name, data):
+        self.name = name
+        self.description = data.get('description', '')
+        self.clients = int(data.get('clients', 4))
+        self.duration = float(data.get('duration', 10))
+        self.think_ms = tuple(data.get('think_ms', (0, 0)))
+        self.fixture = {**FIXTURE_DEFAULTS, **data.get('fixture', {})}
+        self.tasks = data.get('tasks') or []
+        if not self.tasks:
+            raise ScenarioError(f"Scenario '{name}' has no tasks.")
+        for task in self.tasks:
+            missing = {'name', 'method', 'path'} - set(task)
+            if missing:
+                raise ScenarioError(f"A task in '{name}' is missing {', '.join(sorted(missing))}.")
+            if task.get('weight', 1) <= 0:
+                raise ScenarioError(f"Task '{task['name']}' needs a positive weight.")
+
+    @classmethod
+    def load(cls, name_or_path):
+        path = name_or_path if os.path.isfile(name_or_path) else os.path.join(SCENARIO_DIR, f'{name_or_path}.json')
+        try:
+            with open(path) as handle:
+                data = json.load(handle)
+        except FileNotFoundError:
+            raise ScenarioError(f"No scenario '{name_or_path}'. Available: {', '.join(available_scenarios())}.")
+        except json.JSONDecodeError as exc:
+            raise ScenarioError(f'{path} is not valid JSON: {exc}')
+        return cls(os.path.splitext(os.path.basename(path))[0], data)
+
+
+def available_scenarios():
+    return sorted(name[:-5] for name in os.listdir(SCENARIO_DIR) if name.endswith('.json'))
+
+
+class Fixture:
+    """
+    The company a run works on, and the stock it started with.
+    """
+
+    def __init__(self, company, users, products, materials, shared_materials, password):
+        self.company = company
+        self.users = users
+        self.products = products
+        self.materials = materials
+        self.shared_materials = shared_materials or materials
+        self.password = password
+        self.initial_stock = dict(Material.objects.filter(company=company).with_stock().values_list('pk', 'on_hand_quantity'))
+        self.initial_inward = inward_totals(company)
+        self.initial_inward_rows = InwardEntry.objects.filter(company=company).count()
+
+    def token(self, user, lifetime):
+        from rest_framework_simplejwt.tokens import AccessToken
+
+        token = AccessToken.for_user(user)
+        token.set_exp(lifetime=lifetime)
+        return str(token)
+
+
+def inward_totals(company):
+    return dict(
+        InwardEntry.objects.filter(company=company).values('material_id').annotate(total=Sum('quantity'))
+        .values_list('material_id', 'total')
+    )
+
+
+def build_fixture(name, spec, seed=None, allow_production=False):
+    """
+    Replaces the load-test company called `name` (and its users) with a fresh
+    one built from the scenario's fixture spec. Raises FixtureError outside
+    DEBUG unless `allow_production` is set, and when `name` or one of the
+    usernames belongs to a company the fixture did not build.
+    """
+    if not settings.DEBUG and not allow_production:
+        raise FixtureError('Load tests replace data; run them with DEBUG on, or pass --allow-production.')
+    rng = random.Random(seed)
+    stock = Decimal(str(spec['stock']))
+    slug = name.lower().replace(' ', '-')
+    user_model = get_user_model()
+    if Company.objects.filter(name=name, load_test=False).exists():
+        raise FixtureError(f"Company '{name}' was not created by a load test; refusing to replace it.")
+    previous = list(Company.objects.filter(name=name, load_test=True).values_list('pk', flat=True))
+    usernames = user_model.objects.filter(username__startswith=f'{USERNAME_PREFIX}{slug}-')
+    if usernames.exclude(profile__company_id__in=previous).exists():
+        raise FixtureError(f"Users named '{USERNAME_PREFIX}{slug}-*' belong to another company; refusing to replace them.")
+    if previous:
+        # History rows protect products and materials, and a cascaded delete of
+        # a versioned row would bump (re-create) the company's versions while
+        # the company itself is going away, so these go first without signals.
+        for model in (ProductionOrder, InwardEntry, ArchivedProductionOrder, ArchivedInwardEntry, StockReservation,
+                      MaterialStockStripe, ProductMaterialMapping, Product, Material):
+            rows = model.objects.filter(company_id__in=previous)
+            rows._raw_delete(rows.db)
+        user_model.objects.filter(profile__company_id__in=previous).delete()
+        Company.objects.filter(pk__in=previous).delete()
+
+    with transaction.atomic():
+        company = Company.objects.create(name=name, load_test=True)
+        users = []
+        for index in range(spec['users']):
+            user = user_model.objects.create_user(username=f'{USERNAME_PREFIX}{slug}-{index}', password=spec['password'])
+            UserProfile.objects.create(user=user, company=company, role='staff')
+            users.append(user)
+        materials = [
+            Material.objects.create(company=company, name=f'Load material {index}', unit='pcs', quantity=stock)
+            for index in range(spec['materials'])
+        ]
+        # Production orders need an inward history for every mapped material.
+        InwardEntry.objects.bulk_create([InwardEntry(company=company, material=material, quantity=stock) for material in materials])
+        shared = materials[:spec['shared_materials']]
+        products = []
+        for index in range(spec['products']):
+            product = Product.objects.create(company=company, name=f'Load product {index}')
+            others = rng.sample(materials[len(shared):], min(spec['bom_size'], len(materials) - len(shared)))
+            ProductMaterialMapping.objects.bulk_create([
+                ProductMaterialMapping(company=company, product=product, material=material, fixed_quantity=1)
+                for material in shared + others
+            ])
+            products.append(product)
+    if spec['stripes']:
+        for material in shared:
+            stock_stripes.configure(material, spec['stripes'])
+    return Fixture(
+        company, users, [product.pk for product in products], [material.pk for material in materials],
+        [material.pk for material in shared], spec['password'],
+    )
+
+
+def allowed_host():
+    return next((host.lstrip('.') for host in settings.ALLOWED_HOSTS if host.strip('.*')), 'localhost')
+
+
+class InProcessTransport:
+    """
+    Sends requests through Django's request handler in this process.
+    """
+
+    def __init__(self):
+        from django.test import Client
+
+        self.client = Client(raise_request_exception=False, HTTP_HOST=allowed_host())
+
+    def request(self, method, path, body, token):
+        headers = {'HTTP_AUTHORIZATION': f'Bearer {token}'} if token else {}
+        data = json.dumps(body) if body is not None else ''
+        response = self.client.generic(method, path, data, content_type='application/json', secure=True, **headers)
+        return response.status_code, response.content
+
+    def close(self):
+        connections.close_all()
+
+
+class HttpTransport:
+    """
+    Sends requests to a running server over one keep-alive connection.
+    """
+
+    def __init__(self, base_url):
+        parsed = urllib.parse.urlsplit(base_url)
+        connection_class = http.client.HTTPSConnection if parsed.scheme == 'https' else http.client.HTTPConnection
+        self.prefix = parsed.path.rstrip('/')
+        self.connection = connection_class(parsed.hostname, parsed.port, timeout=30)
+
+    def request(self, method, path, body, token):
+        # The server shares these settings, so its ALLOWED_HOSTS are ours.
+        headers = {'Content-Type': 'application/json', 'Host': allowed_host()}
+        if token:
+            headers['Authorization'] = f'Bearer {token}'
+        try:
+            self.connection.request(method, self.prefix + path, json.dumps(body) if body is not None else None, headers)
+            response = self.connection.getresponse()
+            return response.status, response.read()
+        except (OSError, http.client.HTTPException):
+            self.connection.close()
+            return 0, b''
+
+    def close(self):
+        self.connection.close()
+
+
+def render(value, context, rng):
+    """
+    Fills in "{product}", "{material}", "{shared_material}", "{username}" and
+    "{password}" placeholders. A placeholder that is the whole value keeps the
+    placeholder's type.
+    """
+    if isinstance(value, dict):
+        return {key: render(item, context, rng) for key, item in value.items()}
+    if isinstance(value, list):
+        return [render(item, context, rng) for item in value]
+    if isinstance(value, str):
+        for name, choices in context.items():
+            placeholder = '{' + name + '}'
+            if value == placeholder:
+                return rng.choice(choices) if isinstance(choices, list) else choices
+            if placeholder in value:
+                value = value.replace(placeholder, str(rng.choice(choices) if isinstance(choices, list) else choices))
+    return value
+
+
+def run_client(index, scenario, fixture, transport_factory, deadline, token_lifetime, seed):
+    """
+    One simulated client. Returns [(task name, status, seconds)].
+    """
+    rng = random.Random(None if seed is None else seed + index)
+    user = fixture.users[index % len(fixture.users)]
+    token = fixture.token(user, token_lifetime)
+    context = {
+        'product': fixture.products, 'material': fixture.materials, 'shared_material': fixture.shared_materials,
+        'username': user.username, 'password': fixture.password,
+    }
+    weights = [task.get('weight', 1) for task in scenario.tasks]
+    records = []
+    transport = transport_factory()
+    try:
+        while time.monotonic() < deadline:
+            task = rng.choices(scenario.tasks, weights)[0]
+            body = render(task.get('body'), context, rng)
+            path = render(task['path'], context, rng)
+            started = time.perf_counter()
+            status, content = transport.request(task['method'], path, body, token if task.get('auth', True) else None)
+            records.append((task['name'], status, time.perf_counter() - started))
+            if task.get('store_token') and status == 200:
+                token = json.loads(content)[task['store_token']]
+            if scenario.think_ms[1]:
+                time.sleep(rng.uniform(*scenario.think_ms) / 1000)
+    finally:
+        transport.close()
+    return records
+
+
+def summarize(records, elapsed):
+    """
+    Returns per-task and overall throughput, latency percentiles and errors.
+    """
+    by_task = defaultdict(list)
+    for name, status, seconds in records:
+        by_task[name].append((status, seconds))
+    by_task['all'] = [(status, seconds) for _, status, seconds in records]
+
+    summary = {}
+    for name, entries in by_task.items():
+        if not entries:
+            continue
+        latencies = [seconds * 1000 for _, seconds in entries]
+        errors = sum(1 for status, _ in entries if status == 0 or status >= 400)
+        summary[name] = {
+            'requests': len(entries),
+            'throughput': len(entries) / elapsed if elapsed else 0.0,
+            'error_rate': errors / len(entries),
+            'p50_ms': percentile(latencies, 0.50),
+            'p95_ms': percentile(latencies, 0.95),
+            'p99_ms': percentile(latencies, 0.99),
+            'max_ms': max(latencies),
+            'statuses': dict(sorted(Counter(str(status) for status, _ in entries).items())),
+        }
+    return summary
+
+
+def check_stock(fixture, scenario, records):
+    """
+    Returns the violated stock invariants (an empty list when all hold): no
+    material or stock stripe went negative, every material's stock equals
+    its starting stock plus the run's inward entries minus what its
+    production orders consumed, and the database holds exactly the rows the
+    clients saw created.
+    """
+    problems = []
+    company = fixture.company
+    inward = inward_totals(company)
+    produced = dict(
+        ProductionOrder.objects.filter(company=company).values('product_id').annotate(total=Sum('quantity'))
+        .values_list('product_id', 'total')
+    )
+    consumed = defaultdict(Decimal)
+    for product_id, material_id, fixed_quantity in ProductMaterialMapping.objects.filter(company=company).values_list(
+        'product_id', 'material_id', 'fixed_quantity'
+    ):
+        consumed[material_id] += fixed_quantity * produced.get(product_id, 0)
+
+    for material_id, base, quantity in Material.objects.filter(company=company).with_stock().values_list(
+        'pk', 'quantity', 'on_hand_quantity'
+    ):
+        added = inward.get(material_id, 0) - fixture.initial_inward.get(material_id, 0)
+        expected = fixture.initial_stock[material_id] + added - consumed[material_id]
+        if base < 0:
+            problems.append(f'Material {material_id} went negative: {base}.')
+        if quantity != expected:
+            problems.append(f'Material {material_id} holds {quantity}, expected {expected}.')
+    for material_id, stripe, quantity in MaterialStockStripe.objects.filter(company=company, quantity__lt=0).values_list(
+        'material_id', 'stripe', 'quantity'
+    ):
+        problems.append(f'Stripe {stripe} of material {material_id} went negative: {quantity}.')
+
+    created = Counter(
+        task['creates'] for task in scenario.tasks for name, status, _ in records
+        if task.get('creates') and name == task['name'] and status == 201
+    )
+    rows = {
+        'production_order': ProductionOrder.objects.filter(company=company).count(),
+        'inward_entry': InwardEntry.objects.filter(company=company).count() - fixture.initial_inward_rows,
+    }
+    for kind, count in rows.items():
+        if count != created[kind]:
+            problems.append(f'{count} {kind} rows exist but clients saw {created[kind]} created.')
+    return problems
+
+
+def run(scenario, clients, duration, transport_factory, fixture, seed=None):
+    """
+    Runs `clients` concurrent clients for `duration` seconds and returns
+    {'clients', 'elapsed', 'summary', 'problems'}.
+    """
+    deadline = time.monotonic() + duration
+    token_lifetime = timedelta(seconds=duration + 600)
+    results = [None] * clients
+    errors = []
+
+    def target(index):
+        try:
+            results[index] = run_client(index, scenario, fixture, transport_factory, deadline, token_lifetime, seed)
+        except Exception as exc:
+            errors.append(exc)
+            results[index] = []
+
+    threads = [threading.Thread(target=target, args=(index,), name=f'loadtest-{index}') for index in range(clients)]
+    started = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+    if errors:
+        raise errors[0]
+
+    records = [record for client_records in results for record in client_records]
+    return {
+        'clients': clients,
+        'elapsed': elapsed,
+        'summary': summarize(records, elapsed),
+        'problems': check_stock(fixture, scenario, records),
+    }
@@ -0,0 +1,36 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from api.archiving import ARCHIVES, move_all
+from api.routing import exclude_read_only, tenant_databases
+
+
+class Command(BaseCommand):
+    help = (
+        'Moves production orders and inward entries older than ARCHIVE_HORIZON_DAYS into the archive tables. '
+        'Each batch is copied and deleted in one transaction, so reports never count a row twice or miss it.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--horizon-days', type=int, default=None, help='Defaults to ARCHIVE_HORIZON_DAYS.')
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--dry-run', action='store_true', help='Only report how many rows would be moved.')
+
+    def handle(self, *args, **options):
+        horizon = settings.ARCHIVE_HORIZON_DAYS if options['horizon_days'] is None else options['horizon_days']
+        if horizon < 1:
+            raise CommandError('The archive horizon must be at least one day.')
+        cutoff = timezone.now() - timedelta(days=horizon)
+
+        for database in tenant_databases():
+            for model in ARCHIVES:
+                # Companies that are being moved are archived on the next run.
+                pending = exclude_read_only(model.objects.using(database).filter(created_at__lt=cutoff))
+                if options['dry_run']:
+                    self.stdout.write(f'{database}: {pending.count()} {model._meta.verbose_name_plural} would be archived')
+                    continue
+                moved = move_all(pending, options['batch_size'])
+                self.stdout.write(f'{database}: archived {moved} {model._meta.verbose_name_plural}')
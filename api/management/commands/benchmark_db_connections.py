@@ -0,0 +1,112 @@
+import copy
+import statistics
+import threading
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections, connections
+
+
+class Command(BaseCommand):
+    help = (
+        'Measures request latency under concurrent load with per-request connections, '
+        'persistent connections and (on PostgreSQL with psycopg 3) the native pool.'
+    )
+
+    MODES = ('per-request', 'persistent', 'pooled')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', default='default', help='Database alias to benchmark.')
+        parser.add_argument('--threads', type=int, default=8, help='Concurrent simulated clients.')
+        parser.add_argument('--requests', type=int, default=200, help='Requests per client.')
+        parser.add_argument('--think-ms', type=float, default=0.0, help='Idle time between requests.')
+        parser.add_argument(
+            '--modes', default=','.join(self.MODES),
+            help='Comma-separated modes to run: ' + ', '.join(self.MODES),
+        )
+
+    def handle(self, *args, **options):
+        alias = options['database']
+        if alias not in connections.settings:
+            raise CommandError(f"Unknown database alias '{alias}'.")
+        modes = [mode.strip() for mode in options['modes'].split(',') if mode.strip()]
+        unknown = set(modes) - set(self.MODES)
+        if unknown:
+            raise CommandError(f"Unknown mode(s): {', '.join(sorted(unknown))}")
+
+        settings_dict = connections.settings[alias]
+        original = copy.deepcopy(settings_dict)
+        connections[alias].close()
+        try:
+            for mode in modes:
+                if mode == 'pooled' and connections[alias].vendor != 'postgresql':
+                    self.stdout.write(self.style.WARNING(f'{mode}: skipped, pooling requires PostgreSQL.'))
+                    continue
+                self._configure(settings_dict, original, mode, options['threads'])
+                latencies, errors, elapsed = self._run(alias, options)
+                self._report(mode, latencies, errors, elapsed)
+                if mode == 'pooled':
+                    connections[alias].close_pool()
+        finally:
+            settings_dict.clear()
+            settings_dict.update(original)
+
+    def _configure(self, settings_dict, original, mode, threads):
+        settings_dict.clear()
+        settings_dict.update(copy.deepcopy(original))
+        options = settings_dict.setdefault('OPTIONS', {})
+        options.pop('pool', None)
+        if mode == 'per-request':
+            settings_dict['CONN_MAX_AGE'] = 0
+        elif mode == 'persistent':
+            settings_dict['CONN_MAX_AGE'] = None
+        else:
+            settings_dict['CONN_MAX_AGE'] = 0
+            options['pool'] = {'min_size': 1, 'max_size': threads}
+
+    def _run(self, alias, options):
+        latencies = []
+        errors = []
+        lock = threading.Lock()
+
+        def client():
+            local_latencies = []
+            local_errors = 0
+            for _ in range(options['requests']):
+                started = time.perf_counter()
+                try:
+                    with connections[alias].cursor() as cursor:
+                        cursor.execute('SELECT 1')
+                        cursor.fetchone()
+                except Exception:
+                    local_errors += 1
+                else:
+                    local_latencies.append(time.perf_counter() - started)
+                # What request_finished does at the end of every request.
+                close_old_connections()
+                if options['think_ms']:
+                    time.sleep(options['think_ms'] / 1000)
+            connections[alias].close()
+            with lock:
+                latencies.extend(local_latencies)
+                errors.append(local_errors)
+
+        workers = [threading.Thread(target=client) for _ in range(options['threads'])]
+        started = time.perf_counter()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        return latencies, sum(errors), time.perf_counter() - started
+
+    def _report(self, mode, latencies, errors, elapsed):
+        if not latencies:
+            self.stdout.write(self.style.ERROR(f'{mode}: all requests failed ({errors} errors).'))
+            return
+        latencies_ms = sorted(latency * 1000 for latency in latencies)
+        quantiles = statistics.quantiles(latencies_ms, n=100) if len(latencies_ms) > 1 else latencies_ms * 99
+        self.stdout.write(
+            f'{mode:>12}: {len(latencies_ms) / elapsed:8.1f} req/s  '
+            f'p50 {quantiles[49]:7.2f} ms  p95 {quantiles[94]:7.2f} ms  p99 {quantiles[98]:7.2f} ms  '
+            f'max {latencies_ms[-1]:7.2f} ms  errors {errors}'
+        )
@@ -0,0 +1,89 @@
+import json
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import override_settings
+
+from api import loadtest
+
+
+class Command(BaseCommand):
+    help = (
+        'Measures write throughput on hot materials with and without stock stripes: runs a load-test scenario '
+        '(hot_material by default) once with the shared materials unstriped and once striped, and compares them.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('scenario', nargs='?', default='hot_material', help='Scenario name or path to a scenario file.')
+        parser.add_argument('--stripes', type=int, default=8, help='Stripes per shared material in the striped run.')
+        parser.add_argument('--clients', help='Concurrent clients; a comma-separated list runs one round per value.')
+        parser.add_argument('--duration', type=float, help='Seconds per round (default: from the scenario).')
+        parser.add_argument('--url', help='Base URL of a running server sharing this database; in-process when omitted.')
+        parser.add_argument('--company', default='Stripe Benchmark', help='Name of the fixture company.')
+        parser.add_argument('--seed', type=int, help='Seed for the fixture and the task choices.')
+        parser.add_argument(
+            '--allow-production', action='store_true', help='Run even with DEBUG off (the fixture company is replaced).'
+        )
+        parser.add_argument('--json', action='store_true', help='Print the results as JSON.')
+
+    def handle(self, *args, **options):
+        try:
+            scenario = loadtest.Scenario.load(options['scenario'])
+        except loadtest.ScenarioError as exc:
+            raise CommandError(str(exc))
+        if not scenario.fixture['shared_materials']:
+            raise CommandError(f"Scenario '{scenario.name}' has no shared materials to stripe.")
+        if options['stripes'] < 1:
+            raise CommandError('--stripes must be at least 1.')
+        try:
+            levels = [int(value) for value in (options['clients'] or str(scenario.clients)).split(',')]
+        except ValueError:
+            raise CommandError('--clients takes integers, e.g. 4,16.')
+        duration = options['duration'] or scenario.duration
+        if options['url']:
+            transport_factory = lambda: loadtest.HttpTransport(options['url'])  # noqa: E731
+        else:
+            transport_factory = loadtest.InProcessTransport
+
+        variants = {'unstriped': 0, 'striped': options['stripes']}
+        results = []
+        # Rate limits would cap both runs at the same throughput.
+        with override_settings(API_THROTTLE={**getattr(settings, 'API_THROTTLE', {}), 'RATES': {}}):
+            for clients in levels:
+                for variant, stripes in variants.items():
+                    spec = {**scenario.fixture, 'stripes': stripes}
+                    try:
+                        fixture = loadtest.build_fixture(options['company'], spec, options['seed'], options['allow_production'])
+                    except loadtest.FixtureError as exc:
+                        raise CommandError(str(exc))
+                    result = loadtest.run(scenario, clients, duration, transport_factory, fixture, options['seed'])
+                    results.append({'variant': variant, 'stripes': stripes, **result})
+
+        if options['json']:
+            self.stdout.write(json.dumps({'scenario': scenario.name, 'rounds': results}, indent=2))
+        else:
+            self._report(scenario, results)
+        problems = [problem for result in results for problem in result['problems']]
+        if problems:
+            for problem in problems:
+                self.stderr.write(f'Stock invariant violated: {problem}')
+            raise CommandError(f'{len(problems)} stock invariant violation(s).')
+
+    def _report(self, scenario, results):
+        self.stdout.write(self.style.MIGRATE_HEADING(f'{scenario.name}: stock writes on shared materials'))
+        self.stdout.write(f"{'clients':>8} {'variant':<16} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'errors':>7}")
+        baseline = {}
+        for result in results:
+            row = result['summary'].get('all')
+            if not row:
+                continue
+            label = result['variant'] if not result['stripes'] else f"{result['variant']} (K={result['stripes']})"
+            line = (
+                f"{result['clients']:>8} {label:<16} {row['throughput']:>8.1f} {row['p50_ms']:>8.1f} "
+                f"{row['p95_ms']:>8.1f} {row['p99_ms']:>8.1f} {row['error_rate']:>7.1%}"
+            )
+            if result['stripes'] and baseline.get(result['clients']):
+                line += f"  x{row['throughput'] / baseline[result['clients']]:.2f}"
+            else:
+                baseline[result['clients']] = row['throughput']
+            self.stdout.write(line)
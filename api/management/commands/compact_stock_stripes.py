@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from api.routing import tenant_databases
+from api.stock_stripes import compact
+
+
+class Command(BaseCommand):
+    help = (
+        'Folds the stock stripes of every striped material back together and splits the unreserved stock evenly '
+        'across them again, so that deductions keep taking the fast path. Run it periodically.'
+    )
+
+    def handle(self, *args, **options):
+        for database in tenant_databases():
+            compacted = compact(database)
+            self.stdout.write(f'{database}: compacted {compacted} striped material(s).')
@@ -0,0 +1,106 @@
+import json
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import override_settings
+
+from api import loadtest
+
+
+class Command(BaseCommand):
+    help = (
+        'Drives a weighted scenario from api/loadtest_scenarios/ with concurrent clients, in-process or '
+        'against a local server, and reports throughput, latency percentiles, errors and stock invariants.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('scenario', nargs='?', default='mixed', help='Scenario name or path to a scenario file.')
+        parser.add_argument('--list', action='store_true', help='List the available scenarios.')
+        parser.add_argument(
+            '--clients', help='Concurrent clients; a comma-separated list runs one round per value (e.g. 1,4,16).'
+        )
+        parser.add_argument('--duration', type=float, help='Seconds per round (default: from the scenario).')
+        parser.add_argument('--url', help='Base URL of a running server sharing this database; in-process when omitted.')
+        parser.add_argument('--company', default='Load Test', help='Name of the fixture company (replaced on every round).')
+        parser.add_argument('--no-throttle', action='store_true', help='Disable rate limiting (in-process only).')
+        parser.add_argument('--seed', type=int, help='Seed for the fixture and the task choices.')
+        parser.add_argument(
+            '--allow-production', action='store_true', help='Run even with DEBUG off (the fixture company is replaced).'
+        )
+        parser.add_argument('--json', action='store_true', help='Print the results as JSON.')
+
+    def handle(self, *args, **options):
+        if options['list']:
+            for name in loadtest.available_scenarios():
+                scenario = loadtest.Scenario.load(name)
+                self.stdout.write(f'{name:<20} {scenario.description}')
+            return
+        try:
+            scenario = loadtest.Scenario.load(options['scenario'])
+        except loadtest.ScenarioError as exc:
+            raise CommandError(str(exc))
+        try:
+            levels = [int(value) for value in (options['clients'] or str(scenario.clients)).split(',')]
+        except ValueError:
+            raise CommandError('--clients takes integers, e.g. 1,4,16.')
+        if any(level < 1 for level in levels):
+            raise CommandError('--clients must be at least 1.')
+        duration = options['duration'] or scenario.duration
+
+        if options['url']:
+            if options['no_throttle']:
+                raise CommandError('--no-throttle only applies in-process; change the server settings instead.')
+            transport_factory = lambda: loadtest.HttpTransport(options['url'])  # noqa: E731
+        else:
+            transport_factory = loadtest.InProcessTransport
+        throttle = {**getattr(settings, 'API_THROTTLE', {}), 'RATES': {}} if options['no_throttle'] else settings.API_THROTTLE
+
+        rounds = []
+        with override_settings(API_THROTTLE=throttle):
+            for clients in levels:
+                try:
+                    fixture = loadtest.build_fixture(
+                        options['company'], scenario.fixture, options['seed'], options['allow_production']
+                    )
+                except loadtest.FixtureError as exc:
+                    raise CommandError(str(exc))
+                rounds.append(loadtest.run(scenario, clients, duration, transport_factory, fixture, options['seed']))
+                if not options['json']:
+                    self._report(scenario, rounds[-1])
+
+        if options['json']:
+            self.stdout.write(json.dumps({'scenario': scenario.name, 'rounds': rounds}, indent=2))
+        elif len(rounds) > 1:
+            self._report_scaling(rounds)
+        problems = [problem for result in rounds for problem in result['problems']]
+        if problems:
+            raise CommandError(f'{len(problems)} stock invariant violation(s).')
+
+    def _report(self, scenario, result):
+        self.stdout.write(self.style.MIGRATE_HEADING(
+            f"{scenario.name}: {result['clients']} clients for {result['elapsed']:.1f}s"
+        ))
+        self.stdout.write(
+            f"{'task':<20} {'requests':>9} {'req/s':>8} {'errors':>7} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8}  statuses"
+        )
+        for name, row in sorted(result['summary'].items(), key=lambda item: (item[0] == 'all', item[0])):
+            statuses = ' '.join(f'{status}x{count}' for status, count in row['statuses'].items())
+            self.stdout.write(
+                f"{name:<20} {row['requests']:>9} {row['throughput']:>8.1f} {row['error_rate']:>7.1%} "
+                f"{row['p50_ms']:>8.1f} {row['p95_ms']:>8.1f} {row['p99_ms']:>8.1f} {row['max_ms']:>8.1f}  {statuses}"
+            )
+        if result['problems']:
+            for problem in result['problems']:
+                self.stdout.write(self.style.ERROR(f'Stock invariant violated: {problem}'))
+        else:
+            self.stdout.write(self.style.SUCCESS('Stock invariants hold.'))
+
+    def _report_scaling(self, rounds):
+        self.stdout.write(self.style.MIGRATE_HEADING('Scaling'))
+        self.stdout.write(f"{'clients':>8} {'req/s':>8} {'p95 ms':>8} {'errors':>7}")
+        for result in rounds:
+            row = result['summary'].get('all')
+            if row:
+                self.stdout.write(
+                    f"{result['clients']:>8} {row['throughput']:>8.1f} {row['p95_ms']:>8.1f} {row['error_rate']:>7.1%}"
+                )
@@ -0,0 +1,165 @@
+import time
+
+from django.apps import apps
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.db.models import Count, DecimalField, Sum
+
+from api.models import Company, CompanyShard
+from api.routing import invalidate_shard_map, is_tenant_model, tenant_context
+from api.shard_ids import reserve_block
+from api.signals import VERSIONED_MODELS
+from api.versioning import bump_version, coalesced_bumps
+
+
+def tenant_models_in_dependency_order():
+    """
+    Returns the tenant-scoped models ordered so that every model comes after
+    the tenant models it references.
+    """
+    models = [model for model in apps.get_app_config('api').get_models() if is_tenant_model(model)]
+    ordered = []
+    pending = list(models)
+    while pending:
+        for model in pending:
+            dependencies = {
+                field.related_model for field in model._meta.concrete_fields
+                if field.is_relation and field.related_model in models and field.related_model is not model
+            }
+            if dependencies.issubset(ordered):
+                ordered.append(model)
+                pending.remove(model)
+                break
+        else:
+            raise CommandError('Circular dependency between tenant models.')
+    return ordered
+
+
+class Command(BaseCommand):
+    help = (
+        "Moves a company's data to another database shard while the rest of the service keeps running. "
+        "The company is read-only during the copy."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('company_id', type=int)
+        parser.add_argument('target', help='Database alias to move the company to.')
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument(
+            '--settle-seconds', type=float, default=None,
+            help='Time to wait for workers to see the read-only flag (defaults to TENANT_SHARD_MAP_TTL).',
+        )
+        parser.add_argument('--keep-source', action='store_true', help='Do not delete the rows from the old shard.')
+
+    def handle(self, *args, **options):
+        company_id = options['company_id']
+        target = options['target']
+        if target not in settings.DATABASES:
+            raise CommandError(f"Unknown database alias '{target}'.")
+        try:
+            company = Company.objects.using(DEFAULT_DB_ALIAS).get(pk=company_id)
+        except Company.DoesNotExist:
+            raise CommandError(f'Company {company_id} does not exist.')
+
+        shard, _ = CompanyShard.objects.using(DEFAULT_DB_ALIAS).get_or_create(
+            company=company, defaults={'database': DEFAULT_DB_ALIAS}
+        )
+        source = shard.database
+        if source == target:
+            self.stdout.write(self.style.SUCCESS(f"'{company.name}' is already on '{target}'."))
+            return
+
+        models = tenant_models_in_dependency_order()
+        # Both databases must hand out ids from their own blocks before any
+        # row is copied with its primary key.
+        try:
+            for database in (source, target):
+                reserve_block(models, database)
+        except ImproperlyConfigured as exc:
+            raise CommandError(str(exc))
+        self._set_read_only(shard, True)
+        settle = settings.TENANT_SHARD_MAP_TTL if options['settle_seconds'] is None else options['settle_seconds']
+        self.stdout.write(f"'{company.name}' is read-only; waiting {settle}s for workers to notice.")
+        time.sleep(settle)
+
+        try:
+            self._copy(company, models, source, target, options['batch_size'])
+            self._verify(company_id, models, source, target)
+        except Exception:
+            self._delete(company_id, models, target)
+            self._set_read_only(shard, False)
+            raise
+
+        shard.database = target
+        shard.read_only = False
+        shard.save(using=DEFAULT_DB_ALIAS)
+        invalidate_shard_map()
+        self.stdout.write(self.style.SUCCESS(f"'{company.name}' now lives on '{target}'."))
+
+        if not options['keep_source']:
+            self._delete(company_id, models, source)
+            self.stdout.write(f"Removed '{company.name}' rows from '{source}'.")
+
+    def _set_read_only(self, shard, read_only):
+        shard.read_only = read_only
+        shard.save(using=DEFAULT_DB_ALIAS)
+        invalidate_shard_map()
+
+    def _copy(self, company, models, source, target, batch_size):
+        # Tenant rows keep their primary keys, so leftovers from an earlier
+        # aborted move are cleared; the id blocks keep foreign ids apart.
+        self._delete(company.pk, models, target)
+        Company.objects.using(target).get_or_create(pk=company.pk, defaults={'name': company.name})
+        for model in models:
+            copied = 0
+            last_pk = None
+            while True:
+                rows = model.objects.using(source).filter(company_id=company.pk).order_by('pk')
+                if last_pk is not None:
+                    rows = rows.filter(pk__gt=last_pk)
+                batch = list(rows[:batch_size])
+                if not batch:
+                    break
+                pks = [obj.pk for obj in batch]
+                if model.objects.using(target).filter(pk__in=pks).exists():
+                    raise CommandError(
+                        f'{model._meta.label} ids {pks[0]}..{pks[-1]} already exist on the target shard. '
+                        'Check DATABASE_SHARD_INDEX: shards must use disjoint id blocks.'
+                    )
+                with transaction.atomic(using=target):
+                    model.objects.using(target).bulk_create(batch)
+                copied += len(batch)
+                last_pk = pks[-1]
+            self.stdout.write(f'  copied {copied} {model._meta.verbose_name_plural}')
+
+        # Copied rows that were created on the target earlier must stay
+        # behind its sequences.
+        reserve_block(models, target)
+
+    def _fingerprint(self, model, company_id, database):
+        aggregates = {'rows': Count('pk'), 'pk_sum': Sum('pk')}
+        for field in model._meta.concrete_fields:
+            if isinstance(field, DecimalField):
+                aggregates[f'{field.name}_sum'] = Sum(field.name)
+        return model.objects.using(database).filter(company_id=company_id).aggregate(**aggregates)
+
+    def _verify(self, company_id, models, source, target):
+        for model in models:
+            expected = self._fingerprint(model, company_id, source)
+            actual = self._fingerprint(model, company_id, target)
+            if expected != actual:
+                raise CommandError(f'Verification failed for {model._meta.label}: {expected} != {actual}')
+        self.stdout.write('  verified row counts and checksums')
+
+    def _delete(self, company_id, models, database):
+        # Raw deletes in reverse dependency order: only rows of the same
+        # company reference tenant rows, and they are gone first. A regular
+        # delete would load every row and bump the versions once per row.
+        with tenant_context(company_id), coalesced_bumps():
+            with transaction.atomic(using=database):
+                for model in reversed(models):
+                    rows = model.objects.using(database).filter(company_id=company_id)
+                    if rows._raw_delete(database) and model in VERSIONED_MODELS:
+                        bump_version(company_id, VERSIONED_MODELS[model])
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+
+from api.idempotency import purge_expired
+from api.routing import tenant_databases
+
+
+class Command(BaseCommand):
+    help = 'Deletes stored Idempotency-Key responses past IDEMPOTENCY_KEY_TTL. Run it periodically.'
+
+    def handle(self, *args, **options):
+        for database in tenant_databases():
+            deleted = purge_expired(database)
+            self.stdout.write(f'{database}: purged {deleted} expired idempotency key(s).')
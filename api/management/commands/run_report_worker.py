@@ -0,0 +1,41 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from api.report_jobs import claim_next_job, expire_jobs, run_job
+from api.routing import tenant_databases
+
+
+class Command(BaseCommand):
+    help = 'Runs queued report jobs. Start one or more of these next to the web workers.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Drain the queue once and exit.')
+        parser.add_argument('--poll-interval', type=float, default=1.0, help='Seconds to sleep when idle.')
+        parser.add_argument('--purge-interval', type=float, default=60.0, help='Seconds between expiry sweeps.')
+
+    def handle(self, *args, **options):
+        last_purge = None
+        while True:
+            now = time.monotonic()
+            if last_purge is None or now - last_purge >= options['purge_interval']:
+                for database in tenant_databases():
+                    deleted, timed_out = expire_jobs(database)
+                    if deleted or timed_out:
+                        self.stdout.write(f'{database}: purged {deleted} expired job(s), timed out {timed_out}.')
+                last_purge = now
+
+            ran = 0
+            for database in tenant_databases():
+                job = claim_next_job(database)
+                if job is not None:
+                    run_job(job)
+                    ran += 1
+                    self.stdout.write(f'Report job {job.pk} ({job.kind}) {job.status}.')
+            close_old_connections()
+
+            if not ran:
+                if options['once']:
+                    return
+                time.sleep(options['poll_interval'])
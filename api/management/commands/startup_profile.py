@@ -0,0 +1,161 @@
+import json
+import os
+import re
+import subprocess
+import sys
+from collections import defaultdict
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+
+# Runs in a fresh interpreter so that every import and lazy initialisation is
+# measured from a cold start. Prints one JSON document on stdout.
+PROBE = r'''
+import io, json, os, sys, time
+started = time.perf_counter()
+phases = {}
+
+def mark(name):
+    global started
+    now = time.perf_counter()
+    phases[name] = (now - started) * 1000
+    started = now
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
+import django
+from django.apps import config
+mark('import_django')
+
+from django.conf import settings
+settings.INSTALLED_APPS
+mark('settings')
+
+apps = {}
+create = config.AppConfig.create.__func__
+
+def timed_create(cls, entry):
+    app_config = create(cls, entry)
+    for step in ('import_models', 'ready'):
+        def timed(method=getattr(app_config, step), step=step, label=app_config.label):
+            step_started = time.perf_counter()
+            try:
+                return method()
+            finally:
+                apps.setdefault(label, {})[step] = (time.perf_counter() - step_started) * 1000
+        setattr(app_config, step, timed)
+    return app_config
+
+config.AppConfig.create = classmethod(timed_create)
+django.setup()
+mark('apps_ready')
+
+from backend.wsgi import application
+mark('wsgi_application')
+
+if os.environ['STARTUP_PROFILE_WARM'] == '1':
+    from api import warmup
+    warmup.warm_up()
+    mark('warm_up')
+
+host = next((host.lstrip('.') for host in settings.ALLOWED_HOSTS if host.strip('.*')), 'localhost')
+environ = {
+    'REQUEST_METHOD': 'GET', 'PATH_INFO': os.environ['STARTUP_PROFILE_PATH'], 'QUERY_STRING': '',
+    'SERVER_NAME': host, 'SERVER_PORT': '443', 'HTTP_HOST': host, 'HTTPS': 'on', 'REMOTE_ADDR': '127.0.0.1',
+    'wsgi.url_scheme': 'https', 'wsgi.errors': sys.stderr, 'wsgi.version': (1, 0),
+    'wsgi.multithread': False, 'wsgi.multiprocess': True, 'wsgi.run_once': False,
+}
+if os.environ.get('STARTUP_PROFILE_TOKEN'):
+    environ['HTTP_AUTHORIZATION'] = 'Bearer ' + os.environ['STARTUP_PROFILE_TOKEN']
+statuses = []
+for name in ('first_request', 'second_request'):
+    body = application(dict(environ, **{'wsgi.input': io.BytesIO()}), lambda status, headers, exc_info=None: statuses.append(status))
+    for chunk in body:
+        pass
+    body.close()
+    mark(name)
+print(json.dumps({'phases': phases, 'apps': apps, 'statuses': statuses}))
+'''
+
+IMPORT_TIME_RE = re.compile(r'^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)')
+RUNS = ('cold', 'warm')
+
+
+def parse_import_times(stderr):
+    """
+    Returns {top-level package: (self ms, modules)} from -X importtime output.
+    """
+    packages = defaultdict(lambda: [0.0, 0])
+    for line in stderr.splitlines():
+        match = IMPORT_TIME_RE.match(line)
+        if match:
+            package = packages[match.group(4).split('.')[0]]
+            package[0] += int(match.group(1)) / 1000
+            package[1] += 1
+    return {name: tuple(value) for name, value in packages.items()}
+
+
+class Command(BaseCommand):
+    help = (
+        'Profiles a cold start in a fresh interpreter: import time by package, '
+        'Django app loading, and the first request with and without the worker warm-up.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--path', default='/api/products/', help='Path of the request to time.')
+        parser.add_argument('--user', help='Authenticate the request as this user (with a JWT).')
+        parser.add_argument('--top', type=int, default=15, help='Number of packages to list.')
+        parser.add_argument('--json', action='store_true', help='Print the raw results as JSON.')
+
+    def handle(self, *args, **options):
+        token = ''
+        if options['user']:
+            from rest_framework_simplejwt.tokens import AccessToken
+
+            try:
+                user = get_user_model().objects.get(username=options['user'])
+            except get_user_model().DoesNotExist:
+                raise CommandError(f"Unknown user '{options['user']}'.")
+            token = str(AccessToken.for_user(user))
+
+        results = {run: self._probe(options['path'], token, warm=run == 'warm') for run in RUNS}
+        if options['json']:
+            self.stdout.write(json.dumps(results, indent=2))
+            return
+        self._report(results, options['top'])
+
+    def _probe(self, path, token, warm):
+        environment = dict(
+            os.environ, STARTUP_PROFILE_PATH=path, STARTUP_PROFILE_TOKEN=token, STARTUP_PROFILE_WARM='1' if warm else '0',
+            PYTHONPATH=os.pathsep.join(filter(None, [str(settings.BASE_DIR), os.environ.get('PYTHONPATH')])),
+        )
+        completed = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', PROBE],
+            capture_output=True, text=True, env=environment, cwd=settings.BASE_DIR,
+        )
+        if completed.returncode != 0:
+            raise CommandError(f'The startup probe failed:\n{completed.stderr[-2000:]}')
+        result = json.loads(completed.stdout.strip().splitlines()[-1])
+        result['imports'] = parse_import_times(completed.stderr)
+        return result
+
+    def _report(self, results, top):
+        cold, warm = results['cold'], results['warm']
+        self.stdout.write(f"{'phase':<20} {'cold ms':>10} {'warm ms':>10}")
+        for phase in warm['phases']:
+            cold_ms = cold['phases'].get(phase)
+            cold_column = f'{cold_ms:10.1f}' if cold_ms is not None else f"{'-':>10}"
+            self.stdout.write(f"{phase:<20} {cold_column} {warm['phases'][phase]:10.1f}")
+        self.stdout.write(
+            f"{'total':<20} {sum(cold['phases'].values()):10.1f} {sum(warm['phases'].values()):10.1f}"
+        )
+        self.stdout.write(f"Response status: cold {', '.join(cold['statuses'])}; warm {', '.join(warm['statuses'])}")
+
+        self.stdout.write(f"\n{'app':<20} {'models ms':>10} {'ready ms':>10}")
+        for label, steps in sorted(cold['apps'].items(), key=lambda item: -sum(item[1].values())):
+            self.stdout.write(f"{label:<20} {steps.get('import_models', 0):10.1f} {steps.get('ready', 0):10.1f}")
+
+        self.stdout.write(f"\n{'package':<28} {'import ms':>10} {'modules':>8}")
+        packages = sorted(cold['imports'].items(), key=lambda item: -item[1][0])
+        for package, (milliseconds, modules) in packages[:top]:
+            self.stdout.write(f'{package:<28} {milliseconds:10.1f} {modules:8d}')
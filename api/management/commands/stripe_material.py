@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from api.models import Material
+from api.routing import CompanyReadOnly, ensure_writable, tenant_databases
+from api.stock_stripes import configure
+
+
+class Command(BaseCommand):
+    help = (
+        'Spreads the stock of hot materials over K stripe rows so that concurrent production orders and inward '
+        'entries do not all wait for the same row. --stripes 0 folds the stock back into the material.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('material_ids', nargs='+', type=int)
+        parser.add_argument('--stripes', type=int, default=8, help='Number of stripes (0 turns striping off).')
+
+    def handle(self, *args, **options):
+        if not 0 <= options['stripes'] <= 64:
+            raise CommandError('--stripes must be between 0 and 64.')
+        found = set()
+        for database in tenant_databases():
+            for material in Material.objects.using(database).filter(pk__in=options['material_ids']):
+                try:
+                    ensure_writable(material.company_id, database)
+                except CompanyReadOnly as exc:
+                    raise CommandError(str(exc))
+                configure(material, options['stripes'])
+                found.add(material.pk)
+                self.stdout.write(f'{database}: {material.name} now has {material.stock_stripes} stripe(s), {material.on_hand} on hand.')
+        missing = sorted(set(options['material_ids']) - found)
+        if missing:
+            raise CommandError(f"Unknown material(s): {', '.join(map(str, missing))}.")
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from api.reservations import sweep_expired
+from api.routing import tenant_databases
+
+
+class Command(BaseCommand):
+    help = (
+        'Releases stock reservations past their expires_at, in batches, giving the held quantities back to '
+        'the available stock. Run it periodically.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        for database in tenant_databases():
+            swept = sweep_expired(database, options['batch_size'])
+            self.stdout.write(f'{database}: released {swept} expired reservation(s).')
@@ -0,0 +1,494 @@
+"""
+In-process metrics in the Prometheus text exposition format.
+
+Counters and histograms are plain dicts keyed by label values, each guarded by
+its own lock that is held only for the increment. Gauges and the compression
+and connection-pool totals are read from their owners when /metrics is
+scraped.
+
+With API_METRICS['MULTIPROCESS_DIR'] set (one directory shared by all
+gunicorn workers), every process writes a snapshot of its own values to
+`<dir>/metrics-<pid>-<random>.json` at most every SYNC_INTERVAL seconds and
+when it exits; the random part keeps a worker that reuses a dead worker's
+pid from overwriting its counts. When a worker exits, gunicorn's child_exit
+hook folds its counters and histograms into `<dir>/metrics-exited.json` and
+removes its snapshot, so totals never go backwards. A scrape sums the
+exited totals and the snapshots of all processes; gauges only come from
+processes that are still running. Empty the directory when the server
+starts.
+"""
+import atexit
+import bisect
+import glob
+import json
+import math
+import os
+import re
+import threading
+import time
+import uuid
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import connections
+from django.http import HttpResponse, HttpResponseForbidden
+
+DEFAULTS = {
+    'ENABLED': True,
+    'MULTIPROCESS_DIR': None,
+    'SYNC_INTERVAL': 5,
+    'TOKEN': None,
+    'LATENCY_BUCKETS': (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0),
+}
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+SNAPSHOT_RE = re.compile(r'metrics-(\d+)-[0-9a-f]+\.json$')
+EXITED_SNAPSHOT = 'metrics-exited.json'
+
+# [query count, seconds] of the request being served, set by MetricsMiddleware.
+_request_db = ContextVar('metrics_request_db', default=None)
+
+
+def get_setting(name):
+    return getattr(settings, 'API_METRICS', {}).get(name, DEFAULTS[name])
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+        REGISTRY.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def reset(self):
+        with self._lock:
+            self._values.clear()
+
+    def samples(self):
+        """
+        Returns [[label values, value]] for the snapshot.
+        """
+        with self._lock:
+            return [[list(key), value] for key, value in self._values.items()]
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=None):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets or get_setting('LATENCY_BUCKETS'))
+
+    def observe(self, amount, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, amount)
+        with self._lock:
+            value = self._values.get(key)
+            if value is None:
+                # Per-bucket (not cumulative) counts, the last one being +Inf, then the sum.
+                value = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            value[index] += 1
+            value[-1] += amount
+
+    def count(self, **labels):
+        value = self._values.get(self._key(labels))
+        return sum(value[:-1]) if value else 0
+
+    def samples(self):
+        with self._lock:
+            return [[list(key), list(value)] for key, value in self._values.items()]
+
+
+REGISTRY = []
+
+request_latency = Histogram(
+    'api_request_duration_seconds', 'Request latency by route, method and status.', ('route', 'method', 'status'),
+)
+request_db_queries = Counter('api_request_db_queries_total', 'SQL queries issued while serving each route.', ('route',))
+request_db_seconds = Counter('api_request_db_seconds_total', 'Time spent in SQL queries per route.', ('route',))
+cache_requests = Counter(
+    'api_cache_requests_total', 'Cache lookups by cache and result (hit or miss).', ('cache', 'result'),
+)
+stock_mutations = Counter('api_stock_mutations_total', 'Changes applied to material stock levels.', ('kind',))
+insufficient_stock = Counter(
+    'api_insufficient_stock_rejections_total', 'Production orders rejected for lack of a material.', ('material_id',),
+)
+
+
+def collected_samples():
+    """
+    Metrics owned by other modules, read at scrape time as
+    {name: (type, documentation, labelnames, samples)}.
+    """
+    from .compression import stats as compression_stats
+    from .db_pool import connection_ages, pool_stats
+
+    compression = compression_stats.snapshot()
+    metrics = {
+        'api_compression_responses_total': ('counter', 'Compressed responses by encoding.', 'responses'),
+        'api_compression_bytes_in_total': ('counter', 'Response bytes before compression.', 'bytes_in'),
+        'api_compression_bytes_out_total': ('counter', 'Response bytes after compression.', 'bytes_out'),
+        'api_compression_cpu_seconds_total': ('counter', 'CPU time spent compressing responses.', 'cpu_seconds'),
+    }
+    collected = {
+        name: (kind, documentation, ('encoding',), [[[encoding], totals[field]] for encoding, totals in compression.items()])
+        for name, (kind, documentation, field) in metrics.items()
+    }
+
+    gauges = {
+        'api_db_pool_size': ('Connections held by the pool.', 'size'),
+        'api_db_pool_available': ('Idle connections in the pool.', 'available'),
+        'api_db_pool_requests_waiting': ('Requests waiting for a pooled connection.', 'requests_waiting'),
+    }
+    for name, (documentation, _) in gauges.items():
+        collected[name] = ('gauge', documentation, ('database',), [])
+    collected['api_db_open_connections'] = ('gauge', 'Open database connections.', ('database',), [])
+    collected['api_db_pool_wait_seconds_total'] = (
+        'counter', 'Time requests spent waiting for a pooled connection.', ('database',), [],
+    )
+    for alias in connections:
+        pool = pool_stats(alias)
+        if pool is not None:
+            for name, (_, field) in gauges.items():
+                collected[name][3].append([[alias], pool[field]])
+            collected['api_db_pool_wait_seconds_total'][3].append([[alias], pool['wait_ms_total'] / 1000])
+        collected['api_db_open_connections'][3].append([[alias], len(connection_ages(alias))])
+    return collected
+
+
+def snapshot():
+    """
+    This process's metrics as {name: {'type', 'help', 'labels', 'buckets', 'samples'}}.
+    """
+    data = {}
+    for metric in REGISTRY:
+        data[metric.name] = {
+            'type': metric.type,
+            'help': metric.documentation,
+            'labels': list(metric.labelnames),
+            'buckets': list(getattr(metric, 'buckets', ())),
+            'samples': metric.samples(),
+        }
+    for name, (kind, documentation, labelnames, samples) in collected_samples().items():
+        data[name] = {'type': kind, 'help': documentation, 'labels': list(labelnames), 'buckets': [], 'samples': samples}
+    return data
+
+
+_last_sync = time.monotonic()
+_snapshot_name = {'pid': None, 'name': None}
+
+
+def snapshot_name():
+    """
+    This process's snapshot file name. Forked workers inherit the module, so
+    the name is chosen again whenever the pid changes.
+    """
+    pid = os.getpid()
+    if _snapshot_name['pid'] != pid:
+        _snapshot_name.update(pid=pid, name=f'metrics-{pid}-{uuid.uuid4().hex[:12]}.json')
+    return _snapshot_name['name']
+
+
+def _write_json(path, data):
+    temporary = f'{path}.tmp'
+    with open(temporary, 'w') as handle:
+        json.dump(data, handle)
+    # Readers never see a half-written file.
+    os.replace(temporary, path)
+
+
+def _read_json(path):
+    with open(path) as handle:
+        return json.load(handle)
+
+
+def write_snapshot():
+    """
+    Writes this process's snapshot to the multiprocess directory, if any.
+    """
+    global _last_sync
+    directory = get_setting('MULTIPROCESS_DIR')
+    if not directory:
+        return
+    _last_sync = time.monotonic()
+    os.makedirs(directory, exist_ok=True)
+    _write_json(os.path.join(directory, snapshot_name()), snapshot())
+
+
+def maybe_write_snapshot():
+    if get_setting('MULTIPROCESS_DIR') and time.monotonic() - _last_sync >= get_setting('SYNC_INTERVAL'):
+        write_snapshot()
+
+
+@atexit.register
+def _write_at_exit():
+    try:
+        write_snapshot()
+    except Exception:
+        pass
+
+
+def _is_running(pid):
+    if pid == os.getpid():
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _merge(into, data, include_gauges):
+    for name, metric in data.items():
+        if metric['type'] == 'gauge' and not include_gauges:
+            continue
+        merged = into.setdefault(name, {**metric, 'samples': {}})
+        for labels, value in metric['samples']:
+            key = tuple(labels)
+            current = merged['samples'].get(key)
+            if current is None:
+                merged['samples'][key] = value
+            elif isinstance(value, list):
+                merged['samples'][key] = [a + b for a, b in zip(current, value)]
+            else:
+                merged['samples'][key] = current + value
+
+
+def _as_snapshot(merged):
+    return {
+        name: {**metric, 'samples': [[list(labels), value] for labels, value in metric['samples'].items()]}
+        for name, metric in merged.items()
+    }
+
+
+def _read_exited(directory):
+    try:
+        return _read_json(os.path.join(directory, EXITED_SNAPSHOT))
+    except (OSError, ValueError):
+        return {'absorbed': [], 'metrics': {}}
+
+
+def retire_process(pid):
+    """
+    Folds the counters and histograms of an exited process into the exited
+    totals and removes its snapshots. Called from gunicorn's child_exit hook,
+    so only the master ever writes the totals.
+    """
+    directory = get_setting('MULTIPROCESS_DIR')
+    if not directory:
+        return
+    paths = glob.glob(os.path.join(directory, f'metrics-{pid}-*.json'))
+    if not paths:
+        return
+    exited = _read_exited(directory)
+    merged = {}
+    _merge(merged, exited['metrics'], include_gauges=False)
+    for path in paths:
+        try:
+            _merge(merged, _read_json(path), include_gauges=False)
+        except (OSError, ValueError):
+            pass
+    # A scrape skips absorbed snapshots that are still on disk; names whose
+    # files are gone no longer need to be listed.
+    absorbed = [name for name in exited['absorbed'] if os.path.exists(os.path.join(directory, name))]
+    absorbed += [os.path.basename(path) for path in paths]
+    _write_json(os.path.join(directory, EXITED_SNAPSHOT), {'absorbed': absorbed, 'metrics': _as_snapshot(merged)})
+    for path in paths:
+        os.remove(path)
+
+
+def _merge_directory(merged, directory):
+    """
+    Merges the exited totals and every process's snapshot into `merged`.
+    Returns False when a snapshot was folded into the totals after they were
+    read, in which case the caller starts over.
+    """
+    exited = _read_exited(directory)
+    _merge(merged, exited['metrics'], include_gauges=False)
+    absorbed = set(exited['absorbed'])
+    for path in sorted(glob.glob(os.path.join(directory, 'metrics-*.json'))):
+        match = SNAPSHOT_RE.search(path)
+        if match is None or os.path.basename(path) in absorbed:
+            continue
+        try:
+            data = _read_json(path)
+        except FileNotFoundError:
+            return False
+        except (OSError, ValueError):
+            continue
+        _merge(merged, data, include_gauges=_is_running(int(match.group(1))))
+    return True
+
+
+def aggregate():
+    """
+    Returns the merged metrics of every process sharing the multiprocess
+    directory, or of this process alone.
+    """
+    merged = {}
+    directory = get_setting('MULTIPROCESS_DIR')
+    if not directory:
+        _merge(merged, snapshot(), include_gauges=True)
+        return merged
+
+    write_snapshot()
+    for _ in range(3):
+        merged = {}
+        if _merge_directory(merged, directory):
+            break
+    return merged
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+def _labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    pairs += [f'{name}="{value}"' for name, value in extra]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _number(value):
+    if isinstance(value, float):
+        if math.isinf(value):
+            return '+Inf' if value > 0 else '-Inf'
+        return repr(value)
+    return str(value)
+
+
+def render(merged):
+    """
+    Formats merged metrics in the Prometheus text exposition format (0.0.4).
+    """
+    lines = []
+    for name in sorted(merged):
+        metric = merged[name]
+        lines.append(f"# HELP {name} {metric['help']}")
+        lines.append(f"# TYPE {name} {metric['type']}")
+        for key in sorted(metric['samples']):
+            value = metric['samples'][key]
+            if metric['type'] != 'histogram':
+                lines.append(f"{name}{_labels(metric['labels'], key)} {_number(value)}")
+                continue
+            cumulative = 0
+            bounds = [*metric['buckets'], float('inf')]
+            for bound, count in zip(bounds, value[:-1]):
+                cumulative += count
+                le = _number(float(bound))
+                lines.append(f"{name}_bucket{_labels(metric['labels'], key, [('le', le)])} {cumulative}")
+            lines.append(f"{name}_sum{_labels(metric['labels'], key)} {_number(value[-1])}")
+            lines.append(f"{name}_count{_labels(metric['labels'], key)} {cumulative}")
+    return '\n'.join(lines) + '\n'
+
+
+def reset():
+    """
+    Clears this process's counters and histograms, e.g. in a freshly forked
+    worker or between tests.
+    """
+    for metric in REGISTRY:
+        metric.reset()
+
+
+def is_authorized(request):
+    from .permissions import is_staff_user_id
+    from .routing import token_user_id
+
+    token = get_setting('TOKEN')
+    if token and request.headers.get('Authorization') == f'Bearer {token}':
+        return True
+    # The metrics cover every company, so company admins are not enough.
+    return is_staff_user_id(token_user_id(request))
+
+
+def metrics_view(request):
+    """
+    Serves the metrics to Prometheus. Scrapers authenticate with
+    `Authorization: Bearer <API_METRICS['TOKEN']>`; Django staff users may
+    use their JWT.
+    """
+    if not is_authorized(request):
+        return HttpResponseForbidden('Forbidden\n', content_type='text/plain')
+    return HttpResponse(render(aggregate()), content_type=CONTENT_TYPE)
+
+
+class QueryTimer:
+    """
+    Execute wrapper that adds each query to the current request's DB totals.
+    """
+
+    def __call__(self, execute, sql, params, many, context):
+        totals = _request_db.get()
+        if totals is None:
+            return execute(sql, params, many, context)
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            totals[0] += 1
+            totals[1] += time.perf_counter() - started
+
+
+def install(connection):
+    """
+    Adds the query timer to a connection once; called from the
+    connection_created signal.
+    """
+    if not get_setting('ENABLED'):
+        return
+    if not any(isinstance(wrapper, QueryTimer) for wrapper in connection.execute_wrappers):
+        connection.execute_wrappers.append(QueryTimer())
+
+
+class MetricsMiddleware:
+    """
+    Records latency, status and DB usage per route. Place it first so the
+    latency includes the other middleware.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not get_setting('ENABLED'):
+            return self.get_response(request)
+        totals = [0, 0.0]
+        token = _request_db.set(totals)
+        started = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            _request_db.reset(token)
+        elapsed = time.perf_counter() - started
+
+        match = getattr(request, 'resolver_match', None)
+        # URL names keep the label set small; raw paths would not.
+        route = (match.view_name or match.route) if match else 'unmatched'
+        request_latency.observe(elapsed, route=route, method=request.method, status=response.status_code)
+        if totals[0]:
+            request_db_queries.inc(totals[0], route=route)
+            request_db_seconds.inc(totals[1], route=route)
+        maybe_write_snapshot()
+        return response
@@ -0,0 +1,61 @@
+# Generated by Django 5.2.18 on 2026-10-19 16:48
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("api", "0005_material_low_stock_threshold"),
+    ]
+
+    operations = [
+        migrations.AlterUniqueTogether(
+            name="material",
+            unique_together={("company", "name")},
+        ),
+        migrations.AlterUniqueTogether(
+            name="product",
+            unique_together={("company", "name")},
+        ),
+        migrations.CreateModel(
+            name="ResourceVersion",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "resource",
+                    models.CharField(
+                        choices=[
+                            ("products", "Products"),
+                            ("materials", "Materials"),
+                            ("mappings", "Mappings"),
+                        ],
+                        max_length=32,
+                    ),
+                ),
+                ("version", models.PositiveBigIntegerField(default=0)),
+                ("updated_at", models.DateTimeField(default=django.utils.timezone.now)),
+                (
+                    "company",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="resource_versions",
+                        to="api.company",
+                    ),
+                ),
+            ],
+            options={
+                "unique_together": {("company", "resource")},
+            },
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 5.2.18 on 2026-10-19 16:55
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("api", "0006_resourceversion"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="CompanyShard",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("database", models.CharField(max_length=64)),
+                ("read_only", models.BooleanField(default=False)),
+                ("updated_at", models.DateTimeField(auto_now=True)),
+                (
+                    "company",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="shard",
+                        to="api.company",
+                    ),
+                ),
+            ],
+        ),
+    ]
@@ -0,0 +1,88 @@
+# Generated by Django 5.2.18 on 2026-10-19 17:01
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("api", "0008_reportjob"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ArchivedInwardEntry",
+            fields=[
+                ("id", models.BigIntegerField(primary_key=True, serialize=False)),
+                ("quantity", models.DecimalField(decimal_places=2, max_digits=10)),
+                ("created_at", models.DateTimeField()),
+                ("archived_at", models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name="ArchivedProductionOrder",
+            fields=[
+                ("id", models.BigIntegerField(primary_key=True, serialize=False)),
+                ("quantity", models.PositiveIntegerField()),
+                ("created_at", models.DateTimeField()),
+                ("archived_at", models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name="inwardentry",
+            index=models.Index(
+                fields=["company", "created_at"], name="api_inwarde_company_9c3f92_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="productionorder",
+            index=models.Index(
+                fields=["company", "created_at"], name="api_product_company_e22fa0_idx"
+            ),
+        ),
+        migrations.AddField(
+            model_name="archivedinwardentry",
+            name="company",
+            field=models.ForeignKey(
+                on_delete=django.db.models.deletion.CASCADE, to="api.company"
+            ),
+        ),
+        migrations.AddField(
+            model_name="archivedinwardentry",
+            name="material",
+            field=models.ForeignKey(
+                on_delete=django.db.models.deletion.PROTECT,
+                related_name="archived_inward_entries",
+                to="api.material",
+            ),
+        ),
+        migrations.AddField(
+            model_name="archivedproductionorder",
+            name="company",
+            field=models.ForeignKey(
+                on_delete=django.db.models.deletion.CASCADE, to="api.company"
+            ),
+        ),
+        migrations.AddField(
+            model_name="archivedproductionorder",
+            name="product",
+            field=models.ForeignKey(
+                on_delete=django.db.models.deletion.PROTECT,
+                related_name="archived_production_orders",
+                to="api.product",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="archivedinwardentry",
+            index=models.Index(
+                fields=["company", "created_at"], name="api_archive_company_93384c_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="archivedproductionorder",
+            index=models.Index(
+                fields=["company", "created_at"], name="api_archive_company_33b45a_idx"
+            ),
+        ),
+    ]
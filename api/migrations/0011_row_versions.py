@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-19 17:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("api", "0010_idempotencykey"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="material",
+            name="version",
+            field=models.PositiveIntegerField(default=1),
+        ),
+        migrations.AddField(
+            model_name="productmaterialmapping",
+            name="version",
+            field=models.PositiveIntegerField(default=1),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-19 17:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("api", "0011_row_versions"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="product",
+            name="bom_version",
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
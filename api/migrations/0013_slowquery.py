@@ -0,0 +1,42 @@
+# Generated by Django 5.2.18 on 2026-10-19 17:24
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("api", "0012_product_bom_version"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="SlowQuery",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("fingerprint", models.CharField(db_index=True, max_length=40)),
+                ("statement", models.TextField()),
+                ("params_shape", models.CharField(blank=True, max_length=255)),
+                ("duration_ms", models.FloatField()),
+                ("database", models.CharField(max_length=64)),
+                ("view", models.CharField(blank=True, max_length=255)),
+                ("tenant_id", models.PositiveBigIntegerField(blank=True, null=True)),
+                ("stack", models.TextField(blank=True)),
+                (
+                    "created_at",
+                    models.DateTimeField(
+                        db_index=True, default=django.utils.timezone.now
+                    ),
+                ),
+            ],
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 5.2.18 on 2026-10-19 17:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("api", "0013_slowquery"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="inwardentry",
+            index=models.Index(
+                fields=["created_at"], name="api_inwarde_created_1177f5_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="productionorder",
+            index=models.Index(
+                fields=["created_at"], name="api_product_created_fbc413_idx"
+            ),
+        ),
+    ]
@@ -0,0 +1,24 @@
+from django.db import migrations
+
+
+def create_search_indexes(apps, schema_editor):
+    from api import search
+
+    search.install(schema_editor.connection)
+
+
+def drop_search_indexes(apps, schema_editor):
+    from api import search
+
+    search.uninstall(schema_editor.connection)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("api", "0014_created_at_indexes"),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_indexes, drop_search_indexes),
+    ]
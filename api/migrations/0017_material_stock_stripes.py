@@ -0,0 +1,55 @@
+# Generated by Django 5.2.18 on 2026-10-19 18:17
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("api", "0016_stock_reservations"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="material",
+            name="stock_stripes",
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.CreateModel(
+            name="MaterialStockStripe",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("stripe", models.PositiveSmallIntegerField()),
+                (
+                    "quantity",
+                    models.DecimalField(decimal_places=2, default=0, max_digits=10),
+                ),
+                (
+                    "company",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE, to="api.company"
+                    ),
+                ),
+                (
+                    "material",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="stripes",
+                        to="api.material",
+                    ),
+                ),
+            ],
+            options={
+                "unique_together": {("material", "stripe")},
+            },
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 5.2.18 on 2026-10-19 18:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("api", "0017_material_stock_stripes"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="resourceversion",
+            name="resource",
+            field=models.CharField(
+                choices=[
+                    ("products", "Products"),
+                    ("materials", "Materials"),
+                    ("mappings", "Mappings"),
+                    ("production_orders", "Production orders"),
+                    ("inward_entries", "Inward entries"),
+                ],
+                max_length=32,
+            ),
+        ),
+    ]
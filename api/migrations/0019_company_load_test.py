@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-19 19:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("api", "0018_resource_version_history_choices"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="company",
+            name="load_test",
+            field=models.BooleanField(default=False, editable=False),
+        ),
+    ]
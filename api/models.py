@@ -1,9 +1,14 @@
 from django.db import models
+from django.db.models.functions import Coalesce
+from django.utils import timezone
 from django.contrib.auth.models import User
+from rest_framework.utils.encoders import JSONEncoder
 
 class Company(models.Model):
     name = models.CharField(max_length=255, unique=True)
     created_at = models.DateTimeField(auto_now_add=True)
+    # Set only on companies built by the loadtest fixture, which may replace them.
+    load_test = models.BooleanField(default=False, editable=False)
 
     def __str__(self):
         return self.name
@@ -20,9 +25,44 @@ class UserProfile(models.Model):
     def __str__(self):
         return f'{self.user.username} - {self.company.name} ({self.get_role_display()})'
 
+class CompanyShard(models.Model):
+    """
+    Places a company's data on a database other than the default one. Lives in
+    the default (directory) database; companies without a row stay on default.
+    """
+    company = models.OneToOneField(Company, on_delete=models.CASCADE, related_name='shard')
+    database = models.CharField(max_length=64)
+    read_only = models.BooleanField(default=False)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.company.name} -> {self.database}{' (read-only)' if self.read_only else ''}"
+
+class VersionedModel(models.Model):
+    """
+    Adds a row version for optimistic concurrency control. API updates are
+    conditional on the version (see api/versioning.py); any other save still
+    increments it so that object ETags change.
+    """
+    version = models.PositiveIntegerField(default=1)
+
+    class Meta:
+        abstract = True
+
+    def save(self, *args, **kwargs):
+        if self._state.adding:
+            return super().save(*args, **kwargs)
+        self.version = models.F('version') + 1
+        if kwargs.get('update_fields') is not None:
+            kwargs['update_fields'] = {*kwargs['update_fields'], 'version'}
+        super().save(*args, **kwargs)
+        self.refresh_from_db(fields=['version'])
+
 class Product(models.Model):
     company = models.ForeignKey(Company, on_delete=models.CASCADE)
     name = models.CharField(max_length=255)
+    # Incremented whenever the product's material mappings change.
+    bom_version = models.PositiveIntegerField(default=0)
 
     class Meta:
         unique_together = ('company', 'name')
@@ -30,21 +70,78 @@ class Product(models.Model):
     def __str__(self):
         return self.name
 
-class Material(models.Model):
+class MaterialQuerySet(models.QuerySet):
+    def with_stock(self):
+        """
+        Annotates `striped_quantity` (the sum of the stock stripes) and
+        `on_hand` (quantity plus striped_quantity) in the same query.
+        """
+        striped = MaterialStockStripe.objects.filter(material=models.OuterRef('pk')).values('material').annotate(
+            total=models.Sum('quantity')
+        ).values('total')
+        decimal = models.DecimalField(max_digits=12, decimal_places=2)
+        return self.annotate(
+            striped_quantity=Coalesce(models.Subquery(striped, output_field=decimal), models.Value(0), output_field=decimal)
+        ).annotate(on_hand_quantity=models.F('quantity') + models.F('striped_quantity'))
+
+class Material(VersionedModel):
     company = models.ForeignKey(Company, on_delete=models.CASCADE)
     name = models.CharField(max_length=255)
     style = models.CharField(max_length=100, default='', null=True, blank=True)
     unit = models.CharField(max_length=50)
     quantity = models.DecimalField(max_digits=10, decimal_places=2)
     low_stock_threshold = models.DecimalField(max_digits=10, decimal_places=2, default=10.00)
+    # Sum of the StockReservation rows held against this material, kept in
+    # step with them by api/reservations.py.
+    reserved_quantity = models.DecimalField(max_digits=10, decimal_places=2, default=0)
+    # Number of MaterialStockStripe rows that share this material's stock; 0
+    # keeps it all in `quantity` (see api/stock_stripes.py).
+    stock_stripes = models.PositiveSmallIntegerField(default=0)
+
+    objects = MaterialQuerySet.as_manager()
 
     class Meta:
         unique_together = ('company', 'name')
 
     def __str__(self):
-        return f"{self.name} ({self.quantity} {self.unit})"
+        return f"{self.name} ({self.on_hand} {self.unit})"
+
+    @property
+    def on_hand(self):
+        """
+        Stock on hand: `quantity` plus the balances of the material's stock
+        stripes, read from the with_stock() annotation when it is present.
+        """
+        if not self.stock_stripes:
+            return self.quantity
+        if getattr(self, 'striped_quantity', None) is None:
+            self.striped_quantity = self.stripes.aggregate(total=models.Sum('quantity'))['total'] or 0
+        return self.quantity + self.striped_quantity
+
+    @property
+    def available_quantity(self):
+        """
+        Stock that is on hand and not held by a reservation.
+        """
+        return self.on_hand - self.reserved_quantity
+
+class MaterialStockStripe(models.Model):
+    """
+    One share of a striped material's stock. Stock changes land on a random
+    stripe so that they do not all wait for the material row.
+    """
+    company = models.ForeignKey(Company, on_delete=models.CASCADE)
+    material = models.ForeignKey(Material, on_delete=models.CASCADE, related_name='stripes')
+    stripe = models.PositiveSmallIntegerField()
+    quantity = models.DecimalField(max_digits=10, decimal_places=2, default=0)
+
+    class Meta:
+        unique_together = ('material', 'stripe')
+
+    def __str__(self):
+        return f"{self.material.name} stripe {self.stripe}: {self.quantity}"
 
-class ProductMaterialMapping(models.Model):
+class ProductMaterialMapping(VersionedModel):
     company = models.ForeignKey(Company, on_delete=models.CASCADE)
     product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='mappings')
     material = models.ForeignKey(Material, on_delete=models.CASCADE, related_name='mappings')
@@ -62,6 +159,10 @@ class ProductionOrder(models.Model):
     quantity = models.PositiveIntegerField()
     created_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        # The created_at index serves the admin's date hierarchy across companies.
+        indexes = [models.Index(fields=['company', 'created_at']), models.Index(fields=['created_at'])]
+
     def __str__(self):
         return f"Production Order for {self.quantity} of {self.product.name} at {self.created_at}"
 
@@ -71,5 +172,176 @@ class InwardEntry(models.Model):
     quantity = models.DecimalField(max_digits=10, decimal_places=2)
     created_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        # The created_at index serves the admin's date hierarchy across companies.
+        indexes = [models.Index(fields=['company', 'created_at']), models.Index(fields=['created_at'])]
+
     def __str__(self):
         return f"Inward entry for {self.quantity} of {self.material.name} at {self.created_at}"
+
+class StockReservation(models.Model):
+    """
+    Material held for planned production without deducting it. Counted in
+    Material.reserved_quantity until it is released, consumed by a
+    production order, or swept after expires_at.
+    """
+    company = models.ForeignKey(Company, on_delete=models.CASCADE)
+    material = models.ForeignKey(Material, on_delete=models.CASCADE, related_name='reservations')
+    quantity = models.DecimalField(max_digits=10, decimal_places=2)
+    note = models.CharField(max_length=255, blank=True, default='')
+    created_at = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField()
+
+    class Meta:
+        indexes = [models.Index(fields=['expires_at'])]
+
+    def __str__(self):
+        return f"Reservation of {self.quantity} {self.material.name} until {self.expires_at}"
+
+class ArchivedProductionOrder(models.Model):
+    """
+    A production order older than ARCHIVE_HORIZON_DAYS, moved out of the hot
+    table by the archive_history command. The original id is kept.
+    """
+    id = models.BigIntegerField(primary_key=True)
+    company = models.ForeignKey(Company, on_delete=models.CASCADE)
+    product = models.ForeignKey(Product, on_delete=models.PROTECT, related_name='archived_production_orders')
+    quantity = models.PositiveIntegerField()
+    created_at = models.DateTimeField()
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['company', 'created_at'])]
+
+    def __str__(self):
+        return f"Archived Production Order for {self.quantity} of {self.product.name} at {self.created_at}"
+
+class ArchivedInwardEntry(models.Model):
+    """
+    An inward entry older than ARCHIVE_HORIZON_DAYS, moved out of the hot
+    table by the archive_history command. The original id is kept.
+    """
+    id = models.BigIntegerField(primary_key=True)
+    company = models.ForeignKey(Company, on_delete=models.CASCADE)
+    material = models.ForeignKey(Material, on_delete=models.PROTECT, related_name='archived_inward_entries')
+    quantity = models.DecimalField(max_digits=10, decimal_places=2)
+    created_at = models.DateTimeField()
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['company', 'created_at'])]
+
+    def __str__(self):
+        return f"Archived inward entry for {self.quantity} of {self.material.name} at {self.created_at}"
+
+class ResourceVersion(models.Model):
+    """
+    Per-company change counter for a cacheable resource. Bumped on every write
+    so list/detail endpoints can answer conditional GETs without querying data.
+    """
+    RESOURCE_CHOICES = (
+        ('products', 'Products'),
+        ('materials', 'Materials'),
+        ('mappings', 'Mappings'),
+        ('production_orders', 'Production orders'),
+        ('inward_entries', 'Inward entries'),
+    )
+    company = models.ForeignKey(Company, on_delete=models.CASCADE, related_name='resource_versions')
+    resource = models.CharField(max_length=32, choices=RESOURCE_CHOICES)
+    version = models.PositiveBigIntegerField(default=0)
+    updated_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        unique_together = ('company', 'resource')
+
+    def __str__(self):
+        return f"{self.company_id}:{self.resource} v{self.version}"
+
+class ReportJob(models.Model):
+    """
+    A report computed in the background by the report worker. Identical jobs
+    that are still queued or running are shared instead of being recomputed.
+    """
+    KIND_CHOICES = (
+        ('overall_report', 'Overall report'),
+        ('overall_material_usage', 'Overall material usage'),
+        ('material_usage_by_product', 'Material usage by product'),
+    )
+    STATUS_QUEUED = 'queued'
+    STATUS_RUNNING = 'running'
+    STATUS_SUCCEEDED = 'succeeded'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = (
+        (STATUS_QUEUED, 'Queued'),
+        (STATUS_RUNNING, 'Running'),
+        (STATUS_SUCCEEDED, 'Succeeded'),
+        (STATUS_FAILED, 'Failed'),
+    )
+    IN_FLIGHT = (STATUS_QUEUED, STATUS_RUNNING)
+
+    company = models.ForeignKey(Company, on_delete=models.CASCADE, related_name='report_jobs')
+    kind = models.CharField(max_length=50, choices=KIND_CHOICES)
+    params = models.JSONField(default=dict)
+    params_hash = models.CharField(max_length=64)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=STATUS_QUEUED)
+    result = models.JSONField(null=True, blank=True, encoder=JSONEncoder)
+    error = models.TextField(blank=True, default='')
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    expires_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'created_at']),
+            models.Index(fields=['company', 'kind', 'params_hash']),
+        ]
+        constraints = [
+            models.UniqueConstraint(
+                fields=['company', 'kind', 'params_hash'],
+                condition=models.Q(status__in=('queued', 'running')),
+                name='unique_in_flight_report_job',
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.get_kind_display()} for {self.company_id} ({self.status})"
+
+class IdempotencyKey(models.Model):
+    """
+    The stored outcome of a request sent with an Idempotency-Key header. A
+    row without a status code is the lock held while the first request runs.
+    """
+    company = models.ForeignKey(Company, on_delete=models.CASCADE, related_name='idempotency_keys')
+    key = models.CharField(max_length=255)
+    fingerprint = models.CharField(max_length=64)
+    status_code = models.PositiveSmallIntegerField(null=True, blank=True)
+    response = models.JSONField(null=True, blank=True, encoder=JSONEncoder)
+    created_at = models.DateTimeField(default=timezone.now)
+    expires_at = models.DateTimeField()
+
+    class Meta:
+        unique_together = ('company', 'key')
+        indexes = [models.Index(fields=['expires_at'])]
+
+    def __str__(self):
+        return f"{self.key} ({self.company.name})"
+
+class SlowQuery(models.Model):
+    """
+    A SQL statement that ran longer than SLOW_QUERY_LOG['THRESHOLD_MS'],
+    flushed from the in-process buffer in api/slow_queries.py. It has no
+    company foreign key so that the log stays on the default database.
+    """
+    fingerprint = models.CharField(max_length=40, db_index=True)
+    statement = models.TextField()
+    params_shape = models.CharField(max_length=255, blank=True)
+    duration_ms = models.FloatField()
+    database = models.CharField(max_length=64)
+    view = models.CharField(max_length=255, blank=True)
+    tenant_id = models.PositiveBigIntegerField(null=True, blank=True)
+    stack = models.TextField(blank=True)
+    created_at = models.DateTimeField(default=timezone.now, db_index=True)
+
+    def __str__(self):
+        return f"{self.duration_ms:.1f} ms: {self.statement[:80]}"
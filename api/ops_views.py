@@ -0,0 +1,98 @@
+import math
+from datetime import timedelta
+
+from django.db.models import Count, Max, Sum
+from django.http import FileResponse, Http404
+from django.utils import timezone
+from rest_framework.decorators import api_view, permission_classes as api_permission_classes
+from rest_framework.response import Response
+
+from . import slow_queries
+from .db_pool import connection_stats
+from .models import SlowQuery
+from .permissions import IsStaffUser
+from .profiling import list_profiles, profile_path
+
+
+@api_view(['GET'])
+@api_permission_classes([IsStaffUser])
+def db_connection_stats(request):
+    """
+    Reports connection mode, pool gauges and connection ages per database alias.
+    """
+    return Response(connection_stats())
+
+
+@api_view(['GET'])
+@api_permission_classes([IsStaffUser])
+def profile_list(request):
+    """
+    Lists the stored request profiles, newest first.
+    """
+    return Response(list_profiles())
+
+
+@api_view(['GET'])
+@api_permission_classes([IsStaffUser])
+def profile_download(request, name):
+    """
+    Downloads one stored request profile.
+    """
+    path = profile_path(name)
+    if path is None:
+        raise Http404
+    return FileResponse(open(path, 'rb'), as_attachment=True, filename=name)
+
+
+def percentile(values, fraction):
+    """
+    Nearest-rank percentile of a non-empty list.
+    """
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(len(ordered) * fraction) - 1)]
+
+
+@api_view(['GET'])
+@api_permission_classes([IsStaffUser])
+def slow_query_summary(request):
+    """
+    Aggregates the slow-query log by normalized statement, heaviest first.
+    Query parameters:
+    - hours: look-back window (default 24)
+    - limit: number of statements (default 50)
+    """
+    try:
+        hours = float(request.query_params.get('hours', 24))
+        limit = int(request.query_params.get('limit', 50))
+    except ValueError:
+        return Response({'error': 'hours and limit must be numbers.'}, status=400)
+    # Include what this process has not flushed yet.
+    slow_queries.flush()
+
+    entries = SlowQuery.objects.filter(created_at__gte=timezone.now() - timedelta(hours=hours))
+    top = list(
+        entries.values('fingerprint').annotate(
+            count=Count('id'), total_ms=Sum('duration_ms'), max_ms=Max('duration_ms'), statement=Max('statement'),
+        ).order_by('-total_ms')[:limit]
+    )
+    fingerprints = [row['fingerprint'] for row in top]
+    durations = {}
+    for fingerprint, duration in entries.filter(fingerprint__in=fingerprints).values_list('fingerprint', 'duration_ms'):
+        durations.setdefault(fingerprint, []).append(duration)
+    views = {}
+    view_counts = entries.filter(fingerprint__in=fingerprints).values('fingerprint', 'view').annotate(count=Count('id'))
+    for row in view_counts.order_by('-count'):
+        views.setdefault(row['fingerprint'], {})[row['view']] = row['count']
+
+    return Response([
+        {
+            'fingerprint': row['fingerprint'],
+            'statement': row['statement'],
+            'count': row['count'],
+            'total_ms': round(row['total_ms'], 3),
+            'p95_ms': round(percentile(durations[row['fingerprint']], 0.95), 3),
+            'max_ms': round(row['max_ms'], 3),
+            'views': views.get(row['fingerprint'], {}),
+        }
+        for row in top
+    ])
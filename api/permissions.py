@@ -1,3 +1,5 @@
+from django.db import DEFAULT_DB_ALIAS
+from django.db.models import Q
 from rest_framework.permissions import BasePermission
 
 class IsAdminUser(BasePermission):
@@ -6,3 +8,23 @@ class IsAdminUser(BasePermission):
     """
     def has_permission(self, request, view):
         return request.user and request.user.is_authenticated and request.user.profile.role == 'admin'
+
+class IsStaffUser(BasePermission):
+    """
+    Allows access only to the service's own staff (Django staff or superuser
+    accounts). Company admins are not enough: the operations endpoints show
+    data from every company.
+    """
+    def has_permission(self, request, view):
+        user = request.user
+        return bool(user and user.is_authenticated and (user.is_staff or user.is_superuser))
+
+def is_staff_user_id(user_id):
+    """
+    IsStaffUser for code that only has the user id from the JWT.
+    """
+    from django.contrib.auth.models import User
+
+    return user_id is not None and User.objects.using(DEFAULT_DB_ALIAS).filter(
+        Q(is_staff=True) | Q(is_superuser=True), pk=user_id, is_active=True
+    ).exists()
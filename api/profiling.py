@@ -0,0 +1,213 @@
+"""
+On-demand profiling of single requests.
+
+A staff user adds `X-Profile: pstats` (deterministic, cProfile) or
+`X-Profile: speedscope` (sampling) to a request, or the `_profile=<mode>`
+query parameter. The profile is written to API_PROFILER['DIR'] and listed
+and downloaded through the staff-only ops endpoints. Requests without the
+flag only pay for a header and query string lookup.
+"""
+import cProfile
+import json
+import os
+import re
+import sys
+import threading
+import time
+import uuid
+
+from django.conf import settings
+
+from .permissions import is_staff_user_id
+from .routing import token_user_id
+
+DEFAULTS = {
+    'DIR': os.path.join(settings.BASE_DIR, 'profiles'),
+    'MAX_FILES': 20,
+    'MAX_FILE_BYTES': 5 * 1024 * 1024,
+    'SAMPLE_INTERVAL': 0.005,
+}
+
+HEADER = 'X-Profile'
+QUERY_PARAM = '_profile'
+MODES = {'pstats': '.pstats', 'speedscope': '.speedscope.json'}
+ALIASES = {'1': 'pstats', 'true': 'pstats', 'cprofile': 'pstats', 'sample': 'speedscope', 'sampling': 'speedscope'}
+PROFILE_NAME_RE = re.compile(r'^[0-9]{8}T[0-9]{6}-[a-z]+-[A-Za-z0-9_.-]*-[0-9a-f]{8}(\.pstats|\.speedscope\.json)$')
+
+# cProfile cannot run twice at once in one process on newer Pythons, and one
+# profiled request at a time keeps the overhead bounded.
+_busy = threading.Lock()
+
+
+def get_setting(name):
+    return getattr(settings, 'API_PROFILER', {}).get(name, DEFAULTS[name])
+
+
+def requested_mode(request):
+    """
+    Returns the profiling mode asked for by the request, or None.
+    """
+    value = request.headers.get(HEADER)
+    if value is None and QUERY_PARAM in request.META.get('QUERY_STRING', ''):
+        value = request.GET.get(QUERY_PARAM)
+    if not value:
+        return None
+    value = value.strip().lower()
+    value = ALIASES.get(value, value)
+    return value if value in MODES else None
+
+
+def is_staff(request):
+    # Profiles are listed to staff only, so only staff can start one.
+    return is_staff_user_id(token_user_id(request))
+
+
+class StackSampler:
+    """
+    Samples the call stack of one thread at a fixed interval from a
+    background thread and exports the samples in speedscope's format.
+    """
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.frames = []
+        self.frame_index = {}
+        self.samples = []
+        self.weights = []
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='request-profiler', daemon=True)
+
+    def start(self):
+        self._started = self._last = time.perf_counter()
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self._elapsed = time.perf_counter() - self._started
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            now = time.perf_counter()
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                key = (code.co_name, code.co_filename, code.co_firstlineno)
+                index = self.frame_index.get(key)
+                if index is None:
+                    index = self.frame_index[key] = len(self.frames)
+                    self.frames.append({'name': code.co_name, 'file': code.co_filename, 'line': code.co_firstlineno})
+                stack.append(index)
+                frame = frame.f_back
+            stack.reverse()
+            self.samples.append(stack)
+            self.weights.append(now - self._last)
+            self._last = now
+
+    def export(self, name):
+        return {
+            '$schema': 'https://www.speedscope.app/file-format-schema.json',
+            'name': name,
+            'exporter': 'api.profiling',
+            'shared': {'frames': self.frames},
+            'profiles': [{
+                'type': 'sampled',
+                'name': name,
+                'unit': 'seconds',
+                'startValue': 0,
+                'endValue': self._elapsed,
+                'samples': self.samples,
+                'weights': self.weights,
+            }],
+        }
+
+
+def profile_path(name):
+    """
+    Returns the path of a stored profile, or None for names that are not
+    profile files (which also rules out path traversal).
+    """
+    if not PROFILE_NAME_RE.match(name):
+        return None
+    path = os.path.join(get_setting('DIR'), name)
+    return path if os.path.isfile(path) else None
+
+
+def list_profiles():
+    directory = get_setting('DIR')
+    if not os.path.isdir(directory):
+        return []
+    profiles = []
+    for name in os.listdir(directory):
+        if not PROFILE_NAME_RE.match(name):
+            continue
+        stat = os.stat(os.path.join(directory, name))
+        profiles.append({'name': name, 'size': stat.st_size, 'created_at': stat.st_mtime})
+    return sorted(profiles, key=lambda profile: profile['created_at'], reverse=True)
+
+
+def _enforce_count_limit():
+    directory = get_setting('DIR')
+    for profile in list_profiles()[get_setting('MAX_FILES'):]:
+        try:
+            os.remove(os.path.join(directory, profile['name']))
+        except FileNotFoundError:
+            pass
+
+
+class ProfilingMiddleware:
+    """
+    Profiles requests that carry the profiling flag and come from a staff user.
+    The outcome is reported in the X-Profile response header.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        mode = requested_mode(request)
+        if mode is None or not is_staff(request):
+            return self.get_response(request)
+        if not _busy.acquire(blocking=False):
+            response = self.get_response(request)
+            response[HEADER] = 'skipped: another request is being profiled'
+            return response
+        try:
+            return self._profile(request, mode)
+        finally:
+            _busy.release()
+
+    def _profile(self, request, mode):
+        slug = re.sub(r'[^A-Za-z0-9_.-]+', '_', request.path.strip('/'))[:60]
+        name = f"{time.strftime('%Y%m%dT%H%M%S', time.gmtime())}-{request.method.lower()}-{slug}-{uuid.uuid4().hex[:8]}{MODES[mode]}"
+        directory = get_setting('DIR')
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, name)
+
+        if mode == 'pstats':
+            profiler = cProfile.Profile()
+            profiler.enable()
+            try:
+                response = self.get_response(request)
+            finally:
+                profiler.disable()
+            profiler.dump_stats(path)
+        else:
+            sampler = StackSampler(threading.get_ident(), get_setting('SAMPLE_INTERVAL'))
+            sampler.start()
+            try:
+                response = self.get_response(request)
+            finally:
+                sampler.stop()
+            with open(path, 'w') as handle:
+                json.dump(sampler.export(f'{request.method} {request.path}'), handle)
+
+        if os.path.getsize(path) > get_setting('MAX_FILE_BYTES'):
+            os.remove(path)
+            response[HEADER] = 'discarded: profile exceeded MAX_FILE_BYTES'
+            return response
+        _enforce_count_limit()
+        response[HEADER] = name
+        return response
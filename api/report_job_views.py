@@ -0,0 +1,76 @@
+import time
+
+from django.conf import settings
+from rest_framework import mixins, serializers, status, viewsets
+from rest_framework.decorators import action
+from rest_framework.permissions import IsAuthenticated
+from rest_framework.response import Response
+
+from .models import ReportJob
+from .report_jobs import submit_job
+from .serializers import ReportJobSerializer
+from .throttling import ExportRateThrottle
+
+# Clients poll again after this many seconds while a job is in flight.
+RETRY_HEADERS = {'Retry-After': '2'}
+
+
+class ReportJobViewSet(mixins.CreateModelMixin, mixins.ListModelMixin, mixins.RetrieveModelMixin, viewsets.GenericViewSet):
+    """
+    API endpoint for submitting report jobs, polling their status and
+    downloading their results.
+    """
+    serializer_class = ReportJobSerializer
+    permission_classes = [IsAuthenticated]
+
+    def get_queryset(self):
+        try:
+            return ReportJob.objects.filter(
+                company=self.request.user.profile.company,
+                company__isnull=False
+            ).order_by('-created_at')
+        except AttributeError:
+            return ReportJob.objects.none()
+
+    def create(self, request, *args, **kwargs):
+        if not hasattr(request.user, 'profile'):
+            raise serializers.ValidationError("Admin user cannot create company-specific resources.")
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        job, created = submit_job(
+            request.user.profile.company, serializer.validated_data['kind'], serializer.validated_data['params']
+        )
+        return Response(
+            self.get_serializer(job).data,
+            status=status.HTTP_202_ACCEPTED if created else status.HTTP_200_OK,
+        )
+
+    @action(detail=True, methods=['get'], throttle_classes=[ExportRateThrottle])
+    def result(self, request, pk=None):
+        """
+        Returns the stored result, 202 while the job is pending, or 409 if it
+        failed. Downloads count against the company's exports budget.
+        """
+        job = self.get_object()
+        if job.status == ReportJob.STATUS_SUCCEEDED:
+            return Response(job.result)
+        if job.status == ReportJob.STATUS_FAILED:
+            return Response({'error': job.error, 'status': job.status}, status=status.HTTP_409_CONFLICT)
+        return Response({'status': job.status}, status=status.HTTP_202_ACCEPTED, headers=RETRY_HEADERS)
+
+    @action(detail=True, methods=['get'])
+    def wait(self, request, pk=None):
+        """
+        Short long-poll: returns the job as soon as its status differs from
+        ?status= (the status the client last saw), or after at most
+        REPORT_JOB_WAIT_SECONDS with Retry-After while it is still in flight.
+        The wait is kept short because it holds a worker.
+        """
+        job = self.get_object()
+        seen = request.query_params.get('status')
+        deadline = time.monotonic() + settings.REPORT_JOB_WAIT_SECONDS
+        while job.status == seen and job.status in ReportJob.IN_FLIGHT and time.monotonic() < deadline:
+            time.sleep(0.5)
+            job.refresh_from_db(fields=['status', 'error', 'started_at', 'finished_at', 'expires_at'])
+        headers = RETRY_HEADERS if job.status in ReportJob.IN_FLIGHT else None
+        return Response(self.get_serializer(job).data, headers=headers)
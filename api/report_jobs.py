@@ -0,0 +1,120 @@
+"""
+Lifecycle of background report jobs: submission with de-duplication, claiming
+under per-company concurrency limits, execution and expiry.
+"""
+import hashlib
+import json
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, IntegrityError, transaction
+from django.db.models import Count
+from django.utils import timezone
+
+from . import reports
+from .models import ReportJob
+from .routing import CompanyReadOnly, exclude_read_only, tenant_context
+
+logger = logging.getLogger(__name__)
+
+
+def params_hash(kind, params):
+    canonical = json.dumps({'kind': kind, 'params': params}, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+def submit_job(company, kind, params):
+    """
+    Returns (job, created). An identical job that is still queued or running
+    is returned instead of queueing a new one; finished jobs are never reused,
+    so a new submission always sees the data as of now.
+    """
+    digest = params_hash(kind, params)
+    reusable = ReportJob.objects.filter(
+        company=company, kind=kind, params_hash=digest, status__in=ReportJob.IN_FLIGHT
+    ).order_by('-created_at').first()
+    if reusable is not None:
+        return reusable, False
+    try:
+        with transaction.atomic():
+            return ReportJob.objects.create(company=company, kind=kind, params=params, params_hash=digest), True
+    except IntegrityError:
+        # A concurrent request queued the same job first.
+        return ReportJob.objects.get(
+            company=company, kind=kind, params_hash=digest, status__in=ReportJob.IN_FLIGHT
+        ), False
+
+
+def claim_next_job(database=DEFAULT_DB_ALIAS):
+    """
+    Claims the oldest queued job whose company is below its concurrency limit.
+    The claim is a conditional UPDATE, so concurrent workers never run the same
+    job; the per-company limit is enforced on a best-effort basis.
+    """
+    limit = settings.REPORT_JOB_COMPANY_CONCURRENCY
+    running = dict(
+        ReportJob.objects.using(database).filter(status=ReportJob.STATUS_RUNNING)
+        .values('company_id').annotate(count=Count('pk')).values_list('company_id', 'count')
+    )
+    candidates = exclude_read_only(ReportJob.objects.using(database).filter(status=ReportJob.STATUS_QUEUED))
+    candidates = candidates.order_by('created_at')
+    if running:
+        saturated = [company_id for company_id, count in running.items() if count >= limit]
+        candidates = candidates.exclude(company_id__in=saturated)
+    for job in candidates[:20]:
+        claimed = ReportJob.objects.using(database).filter(pk=job.pk, status=ReportJob.STATUS_QUEUED).update(
+            status=ReportJob.STATUS_RUNNING, started_at=timezone.now()
+        )
+        if claimed:
+            job.refresh_from_db(using=database)
+            return job
+    return None
+
+
+def run_job(job):
+    """
+    Computes the job's report and stores the result with an expiry.
+    """
+    database = job._state.db
+    with tenant_context(job.company_id):
+        try:
+            result = reports.run_report(job.company, job.kind, job.params)
+        except Exception as exc:
+            logger.exception('Report job %s failed.', job.pk)
+            job.status = ReportJob.STATUS_FAILED
+            job.error = str(exc)
+        else:
+            job.status = ReportJob.STATUS_SUCCEEDED
+            job.result = result
+        job.finished_at = timezone.now()
+        job.expires_at = job.finished_at + timedelta(seconds=settings.REPORT_JOB_RESULT_TTL)
+        try:
+            job.save(using=database, update_fields=['status', 'result', 'error', 'finished_at', 'expires_at'])
+        except CompanyReadOnly:
+            # The company started moving while the report ran; the copied job
+            # times out on the new database and the client submits it again.
+            logger.warning('Report job %s finished while its company was being moved; result dropped.', job.pk)
+    return job
+
+
+def expire_jobs(database=DEFAULT_DB_ALIAS):
+    """
+    Deletes finished jobs past their expiry and fails jobs that have been
+    running longer than REPORT_JOB_TIMEOUT (e.g. after a worker crash).
+    Returns (deleted, timed_out).
+    """
+    now = timezone.now()
+    jobs = exclude_read_only(ReportJob.objects.using(database))
+    deleted, _ = jobs.filter(expires_at__lte=now).delete()
+    timed_out = jobs.filter(
+        status=ReportJob.STATUS_RUNNING,
+        started_at__lte=now - timedelta(seconds=settings.REPORT_JOB_TIMEOUT),
+    ).update(
+        status=ReportJob.STATUS_FAILED,
+        error='Timed out.',
+        finished_at=now,
+        expires_at=now + timedelta(seconds=settings.REPORT_JOB_RESULT_TTL),
+    )
+    return deleted, timed_out
+
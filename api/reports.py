@@ -0,0 +1,125 @@
+from datetime import timedelta
+
+from django.db.models import Sum
+from django.utils import timezone
+
+from .models import (
+    ArchivedInwardEntry, ArchivedProductionOrder, InwardEntry, Product, ProductionOrder, ProductMaterialMapping
+)
+
+FREQUENCY_WINDOWS = {
+    'daily': timedelta(days=1),
+    'weekly': timedelta(weeks=1),
+    'monthly': timedelta(days=30),  # approximation
+}
+
+
+def start_date_for(frequency, now=None):
+    """
+    Returns the start of the reporting window for a frequency, or raises
+    ValueError for an unknown one.
+    """
+    try:
+        window = FREQUENCY_WINDOWS[frequency]
+    except KeyError:
+        raise ValueError('Invalid frequency parameter')
+    return (now or timezone.now()) - window
+
+
+def spans_archive(archive_model, company, start_date):
+    """
+    Returns True when archived rows fall inside a range starting at
+    `start_date`. Recent ranges never reach the archive, so this is a single
+    index probe that keeps the hot path off the archive tables.
+    """
+    return archive_model.objects.filter(company=company, created_at__gte=start_date).exists()
+
+
+def produced_quantities(company, start_date, product=None):
+    """
+    Sums produced quantities by product id since `start_date`, including
+    archived production orders when the range reaches them.
+    """
+    sources = [ProductionOrder]
+    if spans_archive(ArchivedProductionOrder, company, start_date):
+        sources.append(ArchivedProductionOrder)
+
+    produced = {}
+    for model in sources:
+        orders = model.objects.filter(company=company, created_at__gte=start_date)
+        if product is not None:
+            orders = orders.filter(product=product)
+        for product_id, quantity in orders.values('product_id').annotate(total=Sum('quantity')).values_list('product_id', 'total'):
+            produced[product_id] = produced.get(product_id, 0) + quantity
+    return produced
+
+
+def material_usage(company, start_date, product=None):
+    """
+    Sums material usage by material name for the production orders since
+    `start_date`, optionally limited to one product.
+    """
+    produced = produced_quantities(company, start_date, product=product)
+
+    usage_by_material = {}
+    mappings = ProductMaterialMapping.objects.filter(product_id__in=produced).select_related('material')
+    for mapping in mappings:
+        material_name = mapping.material.name
+        usage = mapping.fixed_quantity * produced[mapping.product_id]
+        usage_by_material[material_name] = usage_by_material.get(material_name, 0) + usage
+    return usage_by_material
+
+
+def inward_totals(company, start_date):
+    """
+    Sums inward quantities by material name since `start_date`, including
+    archived entries when the range reaches them.
+    """
+    sources = [InwardEntry]
+    if spans_archive(ArchivedInwardEntry, company, start_date):
+        sources.append(ArchivedInwardEntry)
+
+    inward_quantity = {}
+    for model in sources:
+        totals = model.objects.filter(company=company, created_at__gte=start_date).values('material__name').annotate(
+            total=Sum('quantity')
+        ).values_list('material__name', 'total')
+        for material_name, quantity in totals:
+            inward_quantity[material_name] = inward_quantity.get(material_name, 0) + quantity
+    return inward_quantity
+
+
+def overall_report(company, start_date):
+    """
+    Compares inward quantities with usage for every material touched since
+    `start_date`.
+    """
+    inward_quantity = inward_totals(company, start_date)
+    usage_by_material = material_usage(company, start_date)
+
+    report = {}
+    all_materials = set(inward_quantity.keys()) | set(usage_by_material.keys())
+    for material in all_materials:
+        inward = inward_quantity.get(material, 0)
+        usage = usage_by_material.get(material, 0)
+        report[material] = {
+            'inward': inward,
+            'usage': usage,
+            'balance': inward - usage
+        }
+    return report
+
+
+def run_report(company, kind, params):
+    """
+    Computes one of the report kinds offered by the report job API.
+    """
+    start_date = start_date_for(params['frequency'])
+    if kind == 'overall_report':
+        return overall_report(company, start_date)
+    if kind == 'overall_material_usage':
+        return material_usage(company, start_date)
+    if kind == 'material_usage_by_product':
+        product = Product.objects.get(pk=params['product_id'], company=company)
+        return material_usage(company, start_date, product=product)
+    raise ValueError(f'Unknown report kind: {kind}')
@@ -0,0 +1,153 @@
+"""
+Stock reservations: material held for planned production without being
+deducted.
+
+Material.reserved_quantity is the sum of the material's StockReservation
+rows and is kept in step with them by single conditional UPDATEs, so the
+available-to-promise quantity (on hand - reserved_quantity) needs no scan of
+the reservations. A striped material keeps its reserved stock on its own
+row (see api/stock_stripes.py), so the same conditional UPDATE applies.
+Every path that removes a reservation deletes its row first and only
+adjusts the material for rows it actually deleted, so a release racing the
+sweeper can never give the quantity back twice.
+"""
+from collections import defaultdict
+from datetime import timedelta
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, DecimalField, F, Value, When
+from django.utils import timezone
+from rest_framework import serializers
+
+from . import stock_stripes
+from .models import Material, StockReservation
+from .routing import exclude_read_only
+from .versioning import bump_version, coalesced_bumps
+
+
+def amount_case(amounts, default=None):
+    """
+    A CASE expression that picks each material's amount by primary key.
+    """
+    return Case(
+        *[When(pk=material_id, then=Value(amount)) for material_id, amount in amounts.items()],
+        default=default,
+        output_field=DecimalField(max_digits=20, decimal_places=2),
+    )
+
+
+def default_expiry():
+    return timezone.now() + timedelta(hours=settings.STOCK_RESERVATION_TTL_HOURS)
+
+
+def reserve(company, material, quantity, expires_at=None, note=''):
+    """
+    Holds `quantity` of `material` until `expires_at`. Raises ValidationError
+    when less than that is available.
+    """
+    with coalesced_bumps(), transaction.atomic():
+        # One conditional UPDATE: concurrent reservations and orders cannot
+        # promise the same stock twice.
+        held = Material.objects.filter(
+            pk=material.pk, quantity__gte=F('reserved_quantity') + quantity
+        ).update(reserved_quantity=F('reserved_quantity') + quantity, version=F('version') + 1)
+        if not held and material.stock_stripes:
+            # Most of a striped material's stock sits in its stripes; move
+            # the reserved quantity back onto the material row.
+            held, _ = stock_stripes.rebalance(material.pk, reserve=quantity)
+        if not held:
+            material.refresh_from_db(fields=['quantity', 'reserved_quantity', 'stock_stripes'])
+            material.striped_quantity = None
+            raise serializers.ValidationError(
+                f"Not enough {material.name} available to reserve. "
+                f"Requested: {quantity}, Available: {material.available_quantity}"
+            )
+        reservation = StockReservation.objects.create(
+            company=company, material=material, quantity=quantity, note=note, expires_at=expires_at or default_expiry()
+        )
+        bump_version(company.pk, 'materials')
+    return reservation
+
+
+def release(reservations, using=None):
+    """
+    Deletes the given reservations and returns their quantities to the
+    available stock. Returns (number released, {material_id: quantity})
+    for the rows this call deleted; rows already released or swept are
+    skipped. Must run inside a transaction.
+    """
+    reservations = list(reservations)
+    if not reservations:
+        return 0, {}
+    queryset = StockReservation.objects.using(using) if using else StockReservation.objects
+    locked = list(
+        queryset.select_for_update().filter(pk__in=[reservation.pk for reservation in reservations])
+        .values_list('pk', 'company_id', 'material_id', 'quantity')
+    )
+    if not locked:
+        return 0, {}
+    released = defaultdict(Decimal)
+    for _, _, material_id, quantity in locked:
+        released[material_id] += quantity
+    # A raw delete: nothing references reservations, and their quantities
+    # are given back below in one UPDATE rather than per row.
+    queryset.filter(pk__in=[row[0] for row in locked])._raw_delete(queryset.db)
+    materials = Material.objects.using(using) if using else Material.objects
+    materials.filter(pk__in=released).update(
+        reserved_quantity=F('reserved_quantity') - amount_case(released), version=F('version') + 1
+    )
+    for company_id in {row[1] for row in locked}:
+        bump_version(company_id, 'materials')
+    return len(locked), dict(released)
+
+
+def below_reserved(quantities):
+    """
+    Returns an error message when one of the new absolute quantities
+    ({material_id: quantity}) is below the stock reserved on its material,
+    else None. Locks the material rows, so no reservation can be added
+    before the write; must run inside a transaction.
+    """
+    rows = Material.objects.select_for_update().filter(pk__in=quantities).order_by('pk').values_list(
+        'pk', 'name', 'reserved_quantity'
+    )
+    return reserved_stock_error([(name, reserved) for pk, name, reserved in rows if quantities[pk] < reserved])
+
+
+def reserved_stock_error(short):
+    """
+    The error message for [(material name, reserved quantity)], or None.
+    """
+    if not short:
+        return None
+    held = '; '.join(f'{name} has {reserved} reserved' for name, reserved in short)
+    return f'Quantity cannot be set below the reserved stock ({held}). Release reservations first.'
+
+
+def sweep_batch(database, batch_size, now=None):
+    """
+    Releases up to `batch_size` expired reservations in one transaction.
+    Returns the number of reservations released.
+    """
+    with coalesced_bumps(), transaction.atomic(using=database):
+        expired = list(
+            exclude_read_only(StockReservation.objects.using(database).filter(expires_at__lte=now or timezone.now()))
+            .order_by('pk').only('pk')[:batch_size]
+        )
+        return release(expired, using=database)[0]
+
+
+def sweep_expired(database, batch_size=1000):
+    """
+    Releases every reservation that has expired, in batches. Returns the
+    number of reservations released.
+    """
+    now = timezone.now()
+    swept = 0
+    while True:
+        count = sweep_batch(database, batch_size, now)
+        if not count:
+            return swept
+        swept += count
@@ -0,0 +1,377 @@
+"""
+Database routing: tenant shards and a read replica.
+
+Companies can be placed on a shard database through CompanyShard. Every query
+for a tenant-scoped model made while serving that company's users goes to its
+shard; the directory models (companies, users, profiles, the shard map) always
+stay on the default database. While a company is being moved its rows on the
+current database are read-only: API writes get a 503, model saves and deletes
+raise CompanyReadOnly, and the periodic jobs skip the company.
+
+
+Views opt in to replica reads with a `read_replica = True` class attribute
+(viewsets) or the `use_read_replica` decorator (function views). Only safe
+requests are routed, and a user's reads stay on the primary for
+READ_REPLICA_STICKY_SECONDS after one of their own writes. The pins are kept
+in the default cache, so replica reads are only enabled when that cache is
+shared by every worker (settings.SHARED_CACHE); with a per-process cache a
+read following a write would usually reach another worker that never saw the
+pin. When the replica cannot be reached, reads fall back to the primary and
+the replica is retried after READ_REPLICA_RETRY_SECONDS.
+"""
+import contextvars
+import functools
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections
+from django.http import JsonResponse
+from rest_framework.permissions import SAFE_METHODS
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import InvalidToken, TokenError
+from rest_framework_simplejwt.settings import api_settings as jwt_settings
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+_routing_state = contextvars.ContextVar('api_routing_state', default=None)
+_replica_down_until = [0.0]
+_unshared_cache_warned = [False]
+
+DIRECTORY_MODELS = {'api.company', 'api.userprofile', 'api.companyshard'}
+
+_shard_map_lock = threading.Lock()
+_shard_map = {'loaded_at': None, 'databases': {}, 'read_only': set()}
+
+
+class RoutingState:
+    """
+    Per-request routing decision, shared by the middleware and the routers.
+    """
+
+    def __init__(self, shard=None):
+        self.use_replica = False
+        self.shard = shard
+
+
+def current_state():
+    return _routing_state.get()
+
+
+def use_read_replica(view):
+    """
+    Marks a function view as safe to serve from the read replica.
+    """
+    view.read_replica = True
+    return view
+
+
+def view_uses_replica(view_func):
+    policy = getattr(view_func, 'read_replica', None)
+    if policy is None:
+        policy = getattr(getattr(view_func, 'cls', None), 'read_replica', False)
+    return bool(policy)
+
+
+def token_user_id(request):
+    """
+    Returns the user id carried by the request's JWT without touching the
+    database, or None when there is no valid token.
+    """
+    authentication = JWTAuthentication()
+    header = authentication.get_header(request)
+    if header is None:
+        return None
+    raw_token = authentication.get_raw_token(header)
+    if raw_token is None:
+        return None
+    try:
+        token = authentication.get_validated_token(raw_token)
+    except (InvalidToken, TokenError):
+        return None
+    return token.get(jwt_settings.USER_ID_CLAIM)
+
+
+def _pin_key(user_id):
+    return f'api:primary-pin:{user_id}'
+
+
+def pin_to_primary(user_id):
+    cache.set(_pin_key(user_id), True, timeout=settings.READ_REPLICA_STICKY_SECONDS)
+
+
+def is_pinned_to_primary(user_id):
+    return user_id is not None and cache.get(_pin_key(user_id)) is not None
+
+
+def replica_enabled():
+    alias = settings.READ_REPLICA_ALIAS
+    if not (settings.READ_REPLICA_ENABLED and alias in settings.DATABASES):
+        return False
+    if not settings.SHARED_CACHE:
+        if not _unshared_cache_warned[0]:
+            _unshared_cache_warned[0] = True
+            logger.warning('Read replica disabled: primary pins need a cache shared by all workers (SHARED_CACHE).')
+        return False
+    return True
+
+
+def replica_available():
+    """
+    Checks that the replica accepts connections, remembering failures for
+    READ_REPLICA_RETRY_SECONDS so an outage does not slow every request.
+    """
+    if time.monotonic() < _replica_down_until[0]:
+        return False
+    try:
+        connections[settings.READ_REPLICA_ALIAS].ensure_connection()
+    except DatabaseError:
+        logger.warning('Read replica unavailable, falling back to the primary.', exc_info=True)
+        _replica_down_until[0] = time.monotonic() + settings.READ_REPLICA_RETRY_SECONDS
+        return False
+    return True
+
+
+def reset_replica_health():
+    _replica_down_until[0] = 0.0
+
+
+@functools.lru_cache(maxsize=None)
+def is_tenant_model(model):
+    return model._meta.app_label == 'api' and model._meta.label_lower not in DIRECTORY_MODELS and any(
+        field.name == 'company' for field in model._meta.concrete_fields
+    )
+
+
+def sharding_enabled():
+    return settings.TENANT_SHARDING_ENABLED
+
+
+def _load_shard_map():
+    from .models import CompanyShard
+
+    now = time.monotonic()
+    with _shard_map_lock:
+        loaded_at = _shard_map['loaded_at']
+        if loaded_at is not None and now - loaded_at < settings.TENANT_SHARD_MAP_TTL:
+            return _shard_map
+    rows = CompanyShard.objects.using(DEFAULT_DB_ALIAS).values_list('company_id', 'database', 'read_only')
+    databases = {}
+    read_only = set()
+    for company_id, database, is_read_only in rows:
+        databases[company_id] = database
+        if is_read_only:
+            read_only.add(company_id)
+    with _shard_map_lock:
+        _shard_map.update(loaded_at=now, databases=databases, read_only=read_only)
+        return _shard_map
+
+
+def invalidate_shard_map():
+    with _shard_map_lock:
+        _shard_map['loaded_at'] = None
+
+
+def company_shard(company_id):
+    """
+    Returns the database alias holding a company's data.
+    """
+    if company_id is None or not sharding_enabled():
+        return DEFAULT_DB_ALIAS
+    return _load_shard_map()['databases'].get(company_id, DEFAULT_DB_ALIAS)
+
+
+def tenant_databases():
+    """
+    Returns every database alias that currently holds tenant data.
+    """
+    databases = {DEFAULT_DB_ALIAS}
+    if sharding_enabled():
+        databases.update(_load_shard_map()['databases'].values())
+    return sorted(databases)
+
+
+def is_company_read_only(company_id):
+    return sharding_enabled() and company_id in _load_shard_map()['read_only']
+
+
+class CompanyReadOnly(Exception):
+    """
+    A write to the rows of a company that is being moved to another database.
+    """
+
+
+def ensure_writable(company_id, database):
+    """
+    Raises CompanyReadOnly for writes to a company's rows on its current
+    database while it is being moved. Writes to the move's target are allowed.
+    """
+    if is_company_read_only(company_id) and database == company_shard(company_id):
+        raise CompanyReadOnly(f'Company {company_id} is being moved to another database.')
+
+
+def exclude_read_only(queryset):
+    """
+    Leaves out the rows of companies that are being moved, for jobs that
+    write across every company of a database.
+    """
+    read_only = _load_shard_map()['read_only'] if sharding_enabled() else set()
+    return queryset.exclude(company_id__in=read_only) if read_only else queryset
+
+
+def user_company_id(user_id):
+    """
+    Resolves a user's company from the directory, cached for a few minutes.
+    """
+    from .models import UserProfile
+
+    key = f'api:user-company:{user_id}'
+    company_id = cache.get(key)
+    metrics.cache_requests.inc(cache='user_company', result='miss' if company_id is None else 'hit')
+    if company_id is None:
+        company_id = (
+            UserProfile.objects.using(DEFAULT_DB_ALIAS).filter(user_id=user_id).values_list('company_id', flat=True).first()
+        )
+        if company_id is not None:
+            cache.set(key, company_id, timeout=300)
+    return company_id
+
+
+@contextmanager
+def tenant_context(company_id):
+    """
+    Routes tenant queries to the company's shard outside of a request, e.g. in
+    management commands and background workers.
+    """
+    shard = company_shard(company_id)
+    token = _routing_state.set(RoutingState(shard=None if shard == DEFAULT_DB_ALIAS else shard))
+    try:
+        yield shard
+    finally:
+        _routing_state.reset(token)
+
+
+class DatabaseRoutingMiddleware:
+    """
+    Resolves the tenant shard for the request, decides whether reads may go to
+    the replica, and pins users to the primary after their writes.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        token = _routing_state.set(RoutingState())
+        try:
+            response = self.get_response(request)
+        finally:
+            _routing_state.reset(token)
+        if request.method not in SAFE_METHODS and response.status_code < 400:
+            user = getattr(request, 'user', None)
+            if user is not None and user.is_authenticated:
+                pin_to_primary(user.pk)
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        state = _routing_state.get()
+        if state is None:
+            return None
+        user_id = None
+        if sharding_enabled():
+            user_id = token_user_id(request)
+        if user_id is not None:
+            company_id = user_company_id(user_id)
+            shard = company_shard(company_id)
+            if shard != DEFAULT_DB_ALIAS:
+                state.shard = shard
+            if request.method not in SAFE_METHODS and is_company_read_only(company_id):
+                return read_only_response()
+        if (
+            state.shard is None
+            and request.method in SAFE_METHODS
+            and replica_enabled()
+            and view_uses_replica(view_func)
+            and not is_pinned_to_primary(user_id if user_id is not None else token_user_id(request))
+        ):
+            state.use_replica = True
+        return None
+
+    def process_exception(self, request, exception):
+        # Writes the request check cannot attribute to a company, e.g. from
+        # the admin.
+        if isinstance(exception, CompanyReadOnly):
+            return read_only_response()
+        return None
+
+
+def read_only_response():
+    response = JsonResponse(
+        {'detail': 'Your company is being moved to another database. Please retry shortly.'},
+        status=503,
+    )
+    response['Retry-After'] = str(settings.TENANT_SHARD_MAP_TTL)
+    return response
+
+
+class TenantShardRouter:
+    """
+    Sends tenant-scoped models to the current company's shard. Instances that
+    were loaded from a shard keep using it for related lookups and saves.
+    """
+
+    def _db_for_model(self, model, hints):
+        if not is_tenant_model(model):
+            return None
+        state = current_state()
+        if state is not None and state.shard is not None:
+            return state.shard
+        instance = hints.get('instance')
+        if instance is not None and is_tenant_model(type(instance)):
+            database = instance._state.db
+            if database not in (None, DEFAULT_DB_ALIAS, settings.READ_REPLICA_ALIAS):
+                return database
+        return None
+
+    def db_for_read(self, model, **hints):
+        return self._db_for_model(model, hints)
+
+    def db_for_write(self, model, **hints):
+        return self._db_for_model(model, hints)
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Tenant rows reference directory rows (their company) across databases.
+        if obj1._state.db in settings.DATABASES and obj2._state.db in settings.DATABASES:
+            if not is_tenant_model(type(obj1)) or not is_tenant_model(type(obj2)):
+                return True
+        return None
+
+
+class PrimaryReplicaRouter:
+    """
+    Sends replica-eligible reads to the replica and everything else to the
+    primary.
+    """
+
+    def db_for_read(self, model, **hints):
+        state = current_state()
+        if state is None or not state.use_replica:
+            return None
+        if replica_available():
+            return settings.READ_REPLICA_ALIAS
+        state.use_replica = False
+        return DEFAULT_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        # Never let an instance read from the replica be saved back to it.
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = {DEFAULT_DB_ALIAS, settings.READ_REPLICA_ALIAS}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
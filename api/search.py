@@ -0,0 +1,255 @@
+"""
+Server-side search over materials (name, style, unit) and products (name).
+
+SQLite uses an FTS5 table with the trigram tokenizer. The table holds no
+content of its own and is kept in sync by triggers. PostgreSQL uses pg_trgm
+with a GIN index on the searched expression. Other databases fall back to
+prefix matching.
+
+A search first asks for rows that contain every term (substring and prefix
+matches). If that does not fill the first page, it switches to a fuzzy match
+where each term only has to share a trigram with the row, ranked by how many
+trigrams match. Misspellings still find their target this way. Results are ordered by (score, id) and
+paged with a keyset cursor that also records which of the two modes is in
+use.
+"""
+import base64
+import json
+
+from django.db import connections
+from rest_framework import serializers
+from rest_framework.decorators import action
+from rest_framework.response import Response
+
+DEFAULT_LIMIT = 20
+MAX_LIMIT = 100
+EXACT, FUZZY, PREFIX = 'exact', 'fuzzy', 'prefix'
+
+
+class SearchIndex:
+    """
+    The searched columns of one table, with their bm25 weights on SQLite.
+    """
+
+    def __init__(self, table, columns, weights):
+        self.table = table
+        self.columns = columns
+        self.weights = weights
+
+    @property
+    def fts_table(self):
+        return f'{self.table}_search'
+
+    @property
+    def expression(self):
+        # Only IMMUTABLE functions may appear in a PostgreSQL index expression, so no concat_ws().
+        return " || ' ' || ".join(f"coalesce({column}, '')" for column in self.columns)
+
+
+MATERIALS = SearchIndex('api_material', ('name', 'style', 'unit'), (10.0, 2.0, 1.0))
+PRODUCTS = SearchIndex('api_product', ('name',), (1.0,))
+INDEXES = (MATERIALS, PRODUCTS)
+
+
+def _sqlite_triggers(index):
+    columns = ', '.join(index.columns)
+    new_values = ', '.join(f'new.{column}' for column in index.columns)
+    old_values = ', '.join(f'old.{column}' for column in index.columns)
+    fts = index.fts_table
+    delete = f"INSERT INTO {fts}({fts}, rowid, {columns}) VALUES ('delete', old.id, {old_values});"
+    insert = f'INSERT INTO {fts}(rowid, {columns}) VALUES (new.id, {new_values});'
+    return {
+        f'{fts}_ai': f'AFTER INSERT ON {index.table} BEGIN {insert} END',
+        f'{fts}_ad': f'AFTER DELETE ON {index.table} BEGIN {delete} END',
+        # Only the searched columns: stock updates must not touch the index.
+        f'{fts}_au': f'AFTER UPDATE OF {columns} ON {index.table} BEGIN {delete} {insert} END',
+    }
+
+
+def install(connection):
+    """
+    Creates the search indexes on `connection`; safe to run repeatedly. On
+    SQLite, migrations that rebuild a table drop its triggers, so missing
+    triggers are recreated and the index rebuilt from the table.
+    """
+    with connection.cursor() as cursor:
+        if connection.vendor == 'sqlite':
+            for index in INDEXES:
+                triggers = _sqlite_triggers(index)
+                cursor.execute(
+                    "SELECT name FROM sqlite_master WHERE type = 'trigger' AND name IN (%s, %s, %s)", list(triggers)
+                )
+                existing = {row[0] for row in cursor.fetchall()}
+                cursor.execute(
+                    f"CREATE VIRTUAL TABLE IF NOT EXISTS {index.fts_table} USING fts5("
+                    f"{', '.join(index.columns)}, content='{index.table}', content_rowid='id', tokenize='trigram')"
+                )
+                for name, body in triggers.items():
+                    cursor.execute(f'CREATE TRIGGER IF NOT EXISTS {name} {body}')
+                if len(existing) < len(triggers):
+                    cursor.execute(f"INSERT INTO {index.fts_table}({index.fts_table}) VALUES ('rebuild')")
+        elif connection.vendor == 'postgresql':
+            cursor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+            for index in INDEXES:
+                cursor.execute(
+                    f'CREATE INDEX IF NOT EXISTS {index.table}_search_trgm ON {index.table} '
+                    f'USING gin (({index.expression}) gin_trgm_ops)'
+                )
+
+
+def uninstall(connection):
+    with connection.cursor() as cursor:
+        for index in INDEXES:
+            if connection.vendor == 'sqlite':
+                for name in _sqlite_triggers(index):
+                    cursor.execute(f'DROP TRIGGER IF EXISTS {name}')
+                cursor.execute(f'DROP TABLE IF EXISTS {index.fts_table}')
+            elif connection.vendor == 'postgresql':
+                cursor.execute(f'DROP INDEX IF EXISTS {index.table}_search_trgm')
+
+
+def encode_cursor(mode, score, pk):
+    return base64.urlsafe_b64encode(json.dumps([mode, score, pk]).encode()).decode().rstrip('=')
+
+
+def decode_cursor(value):
+    try:
+        mode, score, pk = json.loads(base64.urlsafe_b64decode(value + '=' * (-len(value) % 4)))
+        if mode not in (EXACT, FUZZY, PREFIX):
+            raise ValueError(mode)
+        return mode, float(score), int(pk)
+    except (ValueError, TypeError):
+        raise serializers.ValidationError({'cursor': 'Invalid cursor.'})
+
+
+def _terms(query):
+    # The trigram index cannot match anything shorter than three characters.
+    return [term for term in query.lower().split() if len(term) >= 3]
+
+
+def _fts_match(terms, mode):
+    if mode == EXACT:
+        return ' AND '.join('"{}"'.format(term.replace('"', '""')) for term in terms)
+    # Every term has to share at least one trigram with the row.
+    return ' AND '.join(
+        '(' + ' OR '.join('"{}"'.format(term[i:i + 3].replace('"', '""')) for i in range(len(term) - 2)) + ')'
+        for term in terms
+    )
+
+
+def _like_pattern(term):
+    return '%' + term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+
+
+def _keyset(after):
+    if after is None:
+        return '', []
+    score, pk = after
+    return 'WHERE score < %s OR (score = %s AND id > %s)', [score, score, pk]
+
+
+def _run_sqlite(connection, index, company_id, terms, mode, after, limit):
+    keyset, keyset_params = _keyset(after)
+    weights = ', '.join(str(weight) for weight in index.weights)
+    sql = (
+        f'SELECT id, score FROM ('
+        f'SELECT t.id AS id, -bm25({index.fts_table}, {weights}) AS score '
+        f'FROM {index.fts_table} JOIN {index.table} t ON t.id = {index.fts_table}.rowid '
+        f'WHERE {index.fts_table} MATCH %s AND t.company_id = %s'
+        f') {keyset} ORDER BY score DESC, id LIMIT %s'
+    )
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [_fts_match(terms, mode), company_id, *keyset_params, limit])
+        return cursor.fetchall()
+
+
+def _run_postgresql(connection, index, company_id, terms, mode, after, limit):
+    keyset, keyset_params = _keyset(after)
+    query = ' '.join(terms)
+    if mode == EXACT:
+        condition = ' AND '.join([f'({index.expression}) ILIKE %s'] * len(terms))
+        condition_params = [_like_pattern(term) for term in terms]
+    else:
+        condition = f'%s <%% ({index.expression})'
+        condition_params = [query]
+    sql = (
+        f'SELECT id, score FROM ('
+        f'SELECT id, word_similarity(%s, {index.expression})::float8 AS score FROM {index.table} '
+        f'WHERE company_id = %s AND {condition}'
+        f') matches {keyset} ORDER BY score DESC, id LIMIT %s'
+    )
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [query, company_id, *condition_params, *keyset_params, limit])
+        return cursor.fetchall()
+
+
+def _run_prefix(queryset, query, after, limit):
+    matches = queryset.filter(name__istartswith=query.strip()).order_by('id')
+    if after is not None:
+        matches = matches.filter(id__gt=after[1])
+    return [(pk, 0.0) for pk in matches.values_list('id', flat=True)[:limit]]
+
+
+def search(queryset, index, company_id, query, limit=DEFAULT_LIMIT, cursor=None):
+    """
+    Returns ([(id, score)], next cursor or None) for the company's rows of
+    `queryset` that match `query`, best first.
+    """
+    connection = connections[queryset.db]
+    runners = {'sqlite': _run_sqlite, 'postgresql': _run_postgresql}
+    terms = _terms(query)
+    mode, after = (None, None) if cursor is None else (cursor[0], cursor[1:])
+
+    if not terms or connection.vendor not in runners:
+        mode = PREFIX
+    if mode == PREFIX:
+        rows = _run_prefix(queryset, query, after, limit + 1)
+    else:
+        run = runners[connection.vendor]
+        if mode is None:
+            rows = run(connection, index, company_id, terms, EXACT, None, limit + 1)
+            mode = EXACT
+            if len(rows) <= limit:
+                mode = FUZZY
+                rows = run(connection, index, company_id, terms, FUZZY, None, limit + 1)
+        else:
+            rows = run(connection, index, company_id, terms, mode, after, limit + 1)
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(mode, rows[-1][1], rows[-1][0])
+    return rows, next_cursor
+
+
+class SearchMixin:
+    """
+    Adds GET <list>/search/?q=...&limit=...&cursor=... to a company-scoped
+    viewset. Each result is the usual representation plus its `score`.
+    """
+    search_index = None
+
+    @action(detail=False, methods=['get'])
+    def search(self, request):
+        query = request.query_params.get('q', '').strip()
+        if not query:
+            raise serializers.ValidationError({'q': 'A search query is required.'})
+        try:
+            limit = min(max(int(request.query_params.get('limit', DEFAULT_LIMIT)), 1), MAX_LIMIT)
+        except ValueError:
+            raise serializers.ValidationError({'limit': 'Must be an integer.'})
+        cursor = request.query_params.get('cursor')
+        cursor = decode_cursor(cursor) if cursor else None
+
+        company_id = getattr(getattr(request.user, 'profile', None), 'company_id', None)
+        if company_id is None:
+            return Response({'results': [], 'next': None})
+        queryset = self.get_queryset()
+        rows, next_cursor = search(queryset, self.search_index, company_id, query, limit, cursor)
+        # filter_queryset() applies ?expand= and any other list filtering.
+        objects = self.filter_queryset(queryset).in_bulk([pk for pk, _ in rows])
+        # A row deleted since the search ran is skipped.
+        rows = [(pk, score) for pk, score in rows if pk in objects]
+        data = self.get_serializer([objects[pk] for pk, _ in rows], many=True).data
+        results = [{**item, 'score': round(score, 6)} for item, (_, score) in zip(data, rows)]
+        return Response({'results': results, 'next': next_cursor})
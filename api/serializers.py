@@ -1,29 +1,157 @@
+from decimal import Decimal
+
+from django.utils import timezone
 from rest_framework import serializers
-from .models import Product, Material, ProductMaterialMapping, ProductionOrder, InwardEntry
+from .models import Product, Material, ProductMaterialMapping, ProductionOrder, InwardEntry, ReportJob, StockReservation
+
+
+class ExpandableSerializerMixin:
+    """
+    Serializer side of `?fields=` and `?expand=` (see api/expansion.py).
+    `expandable_fields` maps a field to (serializer class or its name in this
+    module, version resource, many).
+    """
+    expandable_fields = {}
+
+    @classmethod
+    def get_expand_queryset(cls):
+        """
+        The queryset expanded rows of this serializer are loaded from. None
+        lets a foreign key be joined with select_related instead.
+        """
+        return None
+
+    @classmethod
+    def get_expandable_fields(cls):
+        return {
+            name: (globals()[serializer] if isinstance(serializer, str) else serializer, resource, many)
+            for name, (serializer, resource, many) in cls.expandable_fields.items()
+        }
+
+    def __init__(self, *args, fields=None, expand=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        expandable = self.get_expandable_fields()
+        for name, subtree in (expand or {}).items():
+            nested_class, _, many = expandable[name]
+            self.fields[name] = nested_class(many=many, read_only=True, expand=subtree, fields=(fields or {}).get(name) or None)
+        if fields:
+            unknown = sorted(set(fields) - set(self.fields))
+            if unknown:
+                raise serializers.ValidationError({'fields': f"Unknown fields: {', '.join(unknown)}."})
+            for name in list(self.fields):
+                if name not in fields:
+                    self.fields.pop(name)
+
+
+class ProductSerializer(ExpandableSerializerMixin, serializers.ModelSerializer):
+    expandable_fields = {'mappings': ('ProductMaterialMappingSerializer', 'mappings', True)}
 
-class ProductSerializer(serializers.ModelSerializer):
     class Meta:
         model = Product
-        fields = ['id', 'name']
+        fields = ['id', 'name', 'bom_version']
+        read_only_fields = ['bom_version']
+
+class MaterialSerializer(ExpandableSerializerMixin, serializers.ModelSerializer):
+    available_quantity = serializers.DecimalField(max_digits=10, decimal_places=2, read_only=True)
 
-class MaterialSerializer(serializers.ModelSerializer):
     class Meta:
         model = Material
-        fields = ['id', 'name', 'style', 'unit', 'quantity', 'low_stock_threshold']
+        fields = ['id', 'name', 'style', 'unit', 'quantity', 'reserved_quantity', 'available_quantity', 'low_stock_threshold', 'version']
+        read_only_fields = ['reserved_quantity', 'version']
+
+    @classmethod
+    def get_expand_queryset(cls):
+        # on_hand needs the stripe totals, which a join cannot annotate.
+        return Material.objects.with_stock()
+
+    def to_representation(self, instance):
+        data = super().to_representation(instance)
+        # A striped material's stock is spread over its stripes; writes of
+        # `quantity` set the whole stock (see MaterialViewSet).
+        if 'quantity' in data and instance.stock_stripes:
+            data['quantity'] = self.fields['quantity'].to_representation(instance.on_hand)
+        return data
+
+class ProductMaterialMappingSerializer(ExpandableSerializerMixin, serializers.ModelSerializer):
+    expandable_fields = {
+        'product': (ProductSerializer, 'products', False),
+        'material': (MaterialSerializer, 'materials', False),
+    }
 
-class ProductMaterialMappingSerializer(serializers.ModelSerializer):
     class Meta:
         model = ProductMaterialMapping
-        fields = ['id', 'product', 'material', 'fixed_quantity']
+        fields = ['id', 'product', 'material', 'fixed_quantity', 'version']
+        read_only_fields = ['version']
+
 
+class BomEntrySerializer(serializers.Serializer):
+    """
+    One line of a product's full bill of materials, as sent to
+    PUT /api/products/<id>/mappings/.
+    """
+    material = serializers.IntegerField()
+    fixed_quantity = serializers.DecimalField(max_digits=10, decimal_places=2, min_value=Decimal('0.01'))
+
+
+class ProductionOrderSerializer(ExpandableSerializerMixin, serializers.ModelSerializer):
+    expandable_fields = {'product': (ProductSerializer, 'products', False)}
+    # Reservations the order consumes: their quantities are released as the
+    # order deducts the stock they were holding.
+    reservations = serializers.PrimaryKeyRelatedField(
+        queryset=StockReservation.objects.all(), many=True, write_only=True, required=False
+    )
 
-class ProductionOrderSerializer(serializers.ModelSerializer):
     class Meta:
         model = ProductionOrder
-        fields = ['id', 'product', 'quantity', 'created_at']
+        fields = ['id', 'product', 'quantity', 'created_at', 'reservations']
+
+class InwardEntrySerializer(ExpandableSerializerMixin, serializers.ModelSerializer):
+    expandable_fields = {'material': (MaterialSerializer, 'materials', False)}
 
-class InwardEntrySerializer(serializers.ModelSerializer):
     class Meta:
         model = InwardEntry
         fields = ['id', 'material', 'quantity', 'created_at']
         read_only_fields = ['created_at']
+
+class StockReservationSerializer(ExpandableSerializerMixin, serializers.ModelSerializer):
+    expandable_fields = {'material': (MaterialSerializer, 'materials', False)}
+    quantity = serializers.DecimalField(max_digits=10, decimal_places=2, min_value=Decimal('0.01'))
+
+    class Meta:
+        model = StockReservation
+        fields = ['id', 'material', 'quantity', 'note', 'created_at', 'expires_at']
+        read_only_fields = ['created_at']
+        extra_kwargs = {'expires_at': {'required': False}}
+
+    def validate_expires_at(self, value):
+        if value <= timezone.now():
+            raise serializers.ValidationError('Must be in the future.')
+        return value
+
+class ReportJobSerializer(serializers.ModelSerializer):
+    FREQUENCIES = ('daily', 'weekly', 'monthly')
+
+    class Meta:
+        model = ReportJob
+        fields = ['id', 'kind', 'params', 'status', 'error', 'created_at', 'started_at', 'finished_at', 'expires_at']
+        read_only_fields = ['status', 'error', 'created_at', 'started_at', 'finished_at', 'expires_at']
+
+    def validate(self, attrs):
+        params = attrs.get('params') or {}
+        if not isinstance(params, dict):
+            raise serializers.ValidationError({'params': 'Must be an object.'})
+        frequency = str(params.get('frequency', 'daily')).lower()
+        if frequency not in self.FREQUENCIES:
+            raise serializers.ValidationError({'params': 'Invalid frequency parameter'})
+        normalized = {'frequency': frequency}
+        if attrs['kind'] == 'material_usage_by_product':
+            company = self.context['request'].user.profile.company
+            try:
+                product_id = int(params.get('product_id'))
+            except (TypeError, ValueError):
+                raise serializers.ValidationError({'params': 'product_id is required.'})
+            if not Product.objects.filter(pk=product_id, company=company).exists():
+                raise serializers.ValidationError({'params': 'Product not found in your company.'})
+            normalized['product_id'] = product_id
+        attrs['params'] = normalized
+        return attrs
@@ -0,0 +1,77 @@
+"""
+Disjoint primary-key blocks for tenant databases.
+
+move_company_shard copies a company's rows with their primary keys, so two
+databases must never hand out the same id. Each database owns the block of
+DATABASE_SHARD_ID_BLOCK ids at its DATABASE_SHARD_INDEX position, and
+reserve_block() keeps its sequences inside that block. Rows copied in from
+other databases keep ids from their own blocks, which this database's
+sequences never reach.
+"""
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connections
+from django.db.models import Max
+
+
+def id_block(database):
+    """
+    Returns the (first, last) id a database may hand out.
+    """
+    try:
+        index = settings.DATABASE_SHARD_INDEX[database]
+    except KeyError:
+        raise ImproperlyConfigured(f"Database '{database}' has no DATABASE_SHARD_INDEX entry.")
+    size = settings.DATABASE_SHARD_ID_BLOCK
+    return index * size + 1, (index + 1) * size
+
+
+def next_id(model, database):
+    """
+    Returns the id the database's sequence gives the next row of `model`.
+    """
+    connection = connections[database]
+    table = model._meta.db_table
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute('SELECT pg_get_serial_sequence(%s, %s)', [table, model._meta.pk.column])
+            cursor.execute(f'SELECT last_value, is_called FROM {cursor.fetchone()[0]}')
+            last_value, is_called = cursor.fetchone()
+            return last_value + 1 if is_called else last_value
+        if connection.vendor == 'sqlite':
+            cursor.execute('SELECT seq FROM sqlite_sequence WHERE name = %s', [table])
+            row = cursor.fetchone()
+            return (row[0] if row else 0) + 1
+    raise ImproperlyConfigured(f'Id blocks are not supported on {connection.vendor}.')
+
+
+def set_next_id(model, database, value):
+    connection = connections[database]
+    table = model._meta.db_table
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute('SELECT setval(pg_get_serial_sequence(%s, %s), %s, false)', [table, model._meta.pk.column, value])
+        elif connection.vendor == 'sqlite':
+            cursor.execute('UPDATE sqlite_sequence SET seq = %s WHERE name = %s', [value - 1, table])
+            if not cursor.rowcount:
+                cursor.execute('INSERT INTO sqlite_sequence (name, seq) VALUES (%s, %s)', [table, value - 1])
+        else:
+            raise ImproperlyConfigured(f'Id blocks are not supported on {connection.vendor}.')
+
+
+def reserve_block(models, database):
+    """
+    Moves the sequence of each model on `database` into the database's id
+    block, past any id of the block that is already used. Sequences already
+    inside the block are only ever moved forward.
+    """
+    first, last = id_block(database)
+    for model in models:
+        used = model.objects.using(database).filter(pk__gte=first, pk__lte=last).aggregate(Max('pk'))['pk__max']
+        wanted = first if used is None else used + 1
+        current = next_id(model, database)
+        if first <= current <= last and current >= wanted:
+            continue
+        if wanted > last:
+            raise ImproperlyConfigured(f'{model._meta.label} has used up its id block on {database}.')
+        set_next_id(model, database, wanted)
@@ -0,0 +1,77 @@
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.db.models import F
+from django.db.models.signals import post_delete, post_migrate, post_save, pre_delete, pre_save
+from django.dispatch import receiver
+
+from . import db_pool, metrics, search, slow_queries
+from .models import InwardEntry, Material, Product, ProductMaterialMapping, ProductionOrder
+from .routing import ensure_writable, is_tenant_model, sharding_enabled
+from .versioning import bump_version
+
+VERSIONED_MODELS = {
+    Product: 'products',
+    Material: 'materials',
+    ProductMaterialMapping: 'mappings',
+    ProductionOrder: 'production_orders',
+    InwardEntry: 'inward_entries',
+}
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_save, sender=Material)
+@receiver(post_save, sender=ProductionOrder)
+@receiver(post_save, sender=InwardEntry)
+@receiver(post_delete, sender=Product)
+@receiver(post_delete, sender=Material)
+@receiver(post_delete, sender=ProductionOrder)
+@receiver(post_delete, sender=InwardEntry)
+def bump_resource_version(sender, instance, **kwargs):
+    """
+    Keeps the per-company resource versions in step with catalogue and
+    history writes.
+    """
+    bump_version(instance.company_id, VERSIONED_MODELS[sender])
+
+
+@receiver(post_save, sender=ProductMaterialMapping)
+@receiver(post_delete, sender=ProductMaterialMapping)
+def bump_bom_version(sender, instance, **kwargs):
+    """
+    A single mapping write changes its product's BOM, and with it the
+    product's representation.
+    """
+    Product.objects.filter(pk=instance.product_id).update(bom_version=F('bom_version') + 1)
+    bump_version(instance.company_id, 'mappings', 'products')
+
+
+@receiver(pre_save)
+@receiver(pre_delete, sender=Product)
+@receiver(pre_delete, sender=Material)
+@receiver(pre_delete, sender=ProductMaterialMapping)
+@receiver(pre_delete, sender=ProductionOrder)
+@receiver(pre_delete, sender=InwardEntry)
+def refuse_writes_while_moving(sender, instance, using, **kwargs):
+    """
+    Stops saves (admin, commands, the report worker) to a company's rows while
+    move_company_shard copies them. Deletes are only checked for the models
+    that already have delete signals, so the rest keep their fast deletes.
+    """
+    if sharding_enabled() and is_tenant_model(sender):
+        ensure_writable(instance.company_id, using)
+
+
+@receiver(connection_created)
+def track_connection(sender, connection, **kwargs):
+    db_pool.register_connection(connection)
+    slow_queries.install(connection)
+    metrics.install(connection)
+
+
+@receiver(post_migrate)
+def restore_search_index(sender, using, **kwargs):
+    # SQLite migrations that rebuild api_material or api_product drop the
+    # triggers that keep the full-text index in sync.
+    connection = connections[using]
+    if sender.name == 'api' and connection.vendor == 'sqlite' and 'api_material_search' in connection.introspection.table_names():
+        search.install(connection)
@@ -0,0 +1,247 @@
+"""
+Slow-query log.
+
+An execute wrapper installed on every database connection times each
+statement. Statements slower than SLOW_QUERY_LOG['THRESHOLD_MS'] are recorded
+with their normalized SQL, parameter shape, originating view, tenant and a
+trimmed stack into a bounded in-memory ring buffer. The buffer is flushed to
+the SlowQuery table at most every FLUSH_INTERVAL seconds, after a response
+has been produced. Fast statements cost two clock reads.
+"""
+import contextvars
+import functools
+import hashlib
+import logging
+import os
+import re
+import threading
+import time
+import traceback
+from collections import deque
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+from django.utils import timezone
+from django.utils.functional import SimpleLazyObject
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    'ENABLED': True,
+    'THRESHOLD_MS': 200.0,
+    'BUFFER_SIZE': 1000,
+    'FLUSH_INTERVAL': 30,
+    'STACK_DEPTH': 8,
+    'RETENTION_DAYS': 7,
+}
+
+_NORMALIZERS = (
+    (re.compile(r"'(?:[^']|'')*'"), '?'),
+    (re.compile(r'\b\d+(?:\.\d+)?\b'), '?'),
+    (re.compile(r'%s'), '?'),
+    (re.compile(r'"s\d+_x\d+"'), '"s?"'),
+    (re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)'), '(...)'),
+    (re.compile(r'(VALUES\s*\(\.\.\.\))(?:\s*,\s*\(\.\.\.\))+', re.IGNORECASE), r'\1'),
+    (re.compile(r'\s+'), ' '),
+)
+
+# The view and request being served, set by SlowQueryMiddleware.
+_request_context = contextvars.ContextVar('slow_query_request', default=None)
+# Set while the log itself talks to the database, so it never logs itself.
+_suppressed = contextvars.ContextVar('slow_query_suppressed', default=False)
+
+
+def get_setting(name):
+    return getattr(settings, 'SLOW_QUERY_LOG', {}).get(name, DEFAULTS[name])
+
+
+@functools.lru_cache(maxsize=1024)
+def normalize(sql):
+    """
+    Returns (normalized statement, fingerprint). Literals and placeholders
+    become `?` and IN/VALUES lists collapse, so statements that differ only
+    in their values share a fingerprint.
+    """
+    normalized = sql
+    for pattern, replacement in _NORMALIZERS:
+        normalized = pattern.sub(replacement, normalized)
+    normalized = normalized.strip()
+    return normalized, hashlib.sha1(normalized.encode()).hexdigest()
+
+
+def params_shape(params, many):
+    if params is None:
+        return ''
+    if many:
+        params = list(params)
+        first = params[0] if params else ()
+        return f'{len(params)} x ({params_shape(first, False)})'
+    if isinstance(params, dict):
+        return ', '.join(f'{key}:{type(value).__name__}' for key, value in sorted(params.items()))[:255]
+    types = [type(value).__name__ for value in params]
+    if len(types) > 8:
+        return f'{len(types)} params: {", ".join(sorted(set(types)))}'
+    return ', '.join(types)
+
+
+class SlowQueryBuffer:
+    """
+    Bounded ring buffer of slow-query entries; the oldest entries are dropped
+    when it is full.
+    """
+
+    def __init__(self, size):
+        self._lock = threading.Lock()
+        self._entries = deque(maxlen=size)
+        self.dropped = 0
+        self.last_flush = time.monotonic()
+
+    def append(self, entry):
+        with self._lock:
+            if len(self._entries) == self._entries.maxlen:
+                self.dropped += 1
+            self._entries.append(entry)
+
+    def drain(self):
+        with self._lock:
+            entries = list(self._entries)
+            self._entries.clear()
+            self.last_flush = time.monotonic()
+        return entries
+
+    def __len__(self):
+        return len(self._entries)
+
+
+buffer = SlowQueryBuffer(get_setting('BUFFER_SIZE'))
+
+
+def _call_site():
+    base_dir = str(settings.BASE_DIR)
+    this_file = os.path.abspath(__file__)
+    frames = [
+        frame for frame in traceback.extract_stack()[:-3]
+        if frame.filename.startswith(base_dir) and frame.filename != this_file
+    ]
+    return '\n'.join(
+        f'{os.path.relpath(frame.filename, base_dir)}:{frame.lineno} in {frame.name}'
+        for frame in frames[-get_setting('STACK_DEPTH'):]
+    )
+
+
+def _tenant_id(request):
+    from .routing import user_company_id
+
+    user = getattr(request, 'user', None)
+    # Never force a lazy session user here: only users DRF already authenticated count.
+    if user is None or isinstance(user, SimpleLazyObject) or not user.is_authenticated:
+        return None
+    return user_company_id(user.pk)
+
+
+def record(sql, params, many, duration_ms, alias):
+    context = _request_context.get()
+    statement, fingerprint = normalize(sql)
+    token = _suppressed.set(True)
+    try:
+        tenant_id = _tenant_id(context['request']) if context else None
+    except Exception:
+        tenant_id = None
+    finally:
+        _suppressed.reset(token)
+    buffer.append({
+        'fingerprint': fingerprint,
+        'statement': statement,
+        'params_shape': params_shape(params, many),
+        'duration_ms': duration_ms,
+        'database': alias,
+        'view': context['view'] if context else '',
+        'tenant_id': tenant_id,
+        'stack': _call_site(),
+        'created_at': timezone.now(),
+    })
+
+
+class SlowQueryWrapper:
+    """
+    The execute wrapper installed on each connection.
+    """
+
+    def __init__(self, alias):
+        self.alias = alias
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            duration_ms = (time.perf_counter() - started) * 1000
+            if duration_ms >= get_setting('THRESHOLD_MS') and not _suppressed.get():
+                record(sql, params, many, duration_ms, self.alias)
+
+
+def install(connection):
+    """
+    Adds the slow-query wrapper to a connection once; called from the
+    connection_created signal.
+    """
+    if not get_setting('ENABLED'):
+        return
+    if not any(isinstance(wrapper, SlowQueryWrapper) for wrapper in connection.execute_wrappers):
+        connection.execute_wrappers.append(SlowQueryWrapper(connection.alias))
+
+
+def flush():
+    """
+    Writes the buffered entries to the SlowQuery table and prunes entries
+    older than RETENTION_DAYS. Returns the number of entries written.
+    """
+    from .models import SlowQuery
+
+    entries = buffer.drain()
+    token = _suppressed.set(True)
+    try:
+        if entries:
+            SlowQuery.objects.using(DEFAULT_DB_ALIAS).bulk_create([SlowQuery(**entry) for entry in entries])
+        cutoff = timezone.now() - timedelta(days=get_setting('RETENTION_DAYS'))
+        SlowQuery.objects.using(DEFAULT_DB_ALIAS).filter(created_at__lt=cutoff).delete()
+    except Exception:
+        logger.exception('Could not flush %d slow-query entries.', len(entries))
+        return 0
+    finally:
+        _suppressed.reset(token)
+    return len(entries)
+
+
+def view_name(view_func):
+    view_class = getattr(view_func, 'cls', None)
+    if view_class is not None:
+        return f'{view_class.__module__}.{view_class.__qualname__}'
+    return f'{view_func.__module__}.{getattr(view_func, "__qualname__", view_func.__class__.__name__)}'
+
+
+class SlowQueryMiddleware:
+    """
+    Attributes slow queries to the view being served and flushes the buffer
+    once FLUSH_INTERVAL has passed.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        token = _request_context.set({'request': request, 'view': ''})
+        try:
+            response = self.get_response(request)
+        finally:
+            _request_context.reset(token)
+        if len(buffer) and time.monotonic() - buffer.last_flush >= get_setting('FLUSH_INTERVAL'):
+            flush()
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        context = _request_context.get()
+        if context is not None:
+            context['view'] = view_name(view_func)
+        return None
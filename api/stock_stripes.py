@@ -0,0 +1,147 @@
+"""
+Striped stock counters for hot materials.
+
+A material that appears in nearly every BOM turns its row into a lock that
+every production order and inward entry queues on. A striped material
+(Material.stock_stripes = K > 0) keeps most of its stock in K
+MaterialStockStripe rows instead, and each stock change lands on one of them
+picked at random, so K writers can proceed at once.
+
+Stock on hand is Material.quantity plus the stripe balances. The material
+row keeps the reserved quantity (so reservations are still checked against
+one row) and the rounding remainder; the rest is split evenly across the
+stripes. Every balance stays non-negative:
+
+- an inward entry adds to a random stripe;
+- a deduction takes from a random stripe with a conditional UPDATE, and
+  when that stripe is short it falls back to rebalance(), which locks the
+  material and all its stripes, checks the total, applies the change and
+  splits the remainder evenly again;
+- compact() (the compact_stock_stripes command) rebalances every striped
+  material periodically, folding stripes that drifted apart back together.
+
+Stripe writes never touch the material row, so they do not increment
+Material.version; the company's materials resource version is still bumped
+by the callers, which is what list and striped detail ETags are built from.
+The callers make that bump through versioning.coalesced_bumps() after the
+stock transaction has committed, so the single version row does not become
+the next lock the writers queue on.
+"""
+import random
+from decimal import ROUND_DOWN, Decimal
+
+from django.db import transaction
+from django.db.models import F
+
+from .models import Material, MaterialStockStripe
+from .routing import exclude_read_only
+
+CENT = Decimal('0.01')
+
+
+def split(amount, stripes):
+    """
+    Splits `amount` into `stripes` equal shares rounded down to the cent.
+    Returns (share, remainder).
+    """
+    share = (amount / stripes).quantize(CENT, rounding=ROUND_DOWN) if amount > 0 else Decimal('0.00')
+    return share, amount - share * stripes
+
+
+def rebalance(material_id, take=0, reserve=0, using=None):
+    """
+    Locks the material and its stripes, removes `take` from the stock (a
+    negative `take` adds to it) and adds `reserve` to its reserved quantity,
+    then splits the unreserved stock evenly across the material's stripes.
+    Nothing changes when less than take + reserve is available. Returns
+    (applied, available before the change). Must run inside a transaction.
+    """
+    materials = Material.objects.using(using) if using else Material.objects
+    material = materials.select_for_update().only('quantity', 'reserved_quantity', 'stock_stripes', 'company_id').get(pk=material_id)
+    stripes = {stripe.stripe: stripe for stripe in material.stripes.select_for_update().order_by('stripe')}
+    total = material.quantity + sum(stripe.quantity for stripe in stripes.values())
+    available = total - material.reserved_quantity
+    if available < take + reserve:
+        return False, available
+
+    reserved = material.reserved_quantity + reserve
+    count = material.stock_stripes
+    share, remainder = split(total - take - reserved, count) if count else (None, total - take - reserved)
+    for index in range(count):
+        stripes.setdefault(index, MaterialStockStripe(company_id=material.company_id, material_id=material_id, stripe=index))
+        stripes[index].quantity = share
+    manager = MaterialStockStripe.objects.using(material._state.db)
+    manager.bulk_create([stripe for stripe in stripes.values() if stripe.pk is None])
+    manager.bulk_update([stripe for index, stripe in stripes.items() if stripe.pk is not None and index < count], ['quantity'])
+    # Stripes beyond the current count (after it was lowered) are folded in.
+    manager.filter(material_id=material_id, stripe__gte=count).delete()
+    materials.filter(pk=material_id).update(quantity=reserved + remainder, reserved_quantity=reserved)
+    return True, available
+
+
+def add(material, amount):
+    """
+    Adds `amount` to a striped material's stock.
+    """
+    added = MaterialStockStripe.objects.filter(
+        material_id=material.pk, stripe=random.randrange(material.stock_stripes)
+    ).update(quantity=F('quantity') + amount)
+    if not added:
+        # The stripes have not been created yet.
+        rebalance(material.pk, take=-amount)
+
+
+def take(material, amount):
+    """
+    Removes `amount` from a striped material's unreserved stock. Returns
+    (taken, available); nothing is taken when less than `amount` is
+    available. Must run inside a transaction.
+    """
+    taken = MaterialStockStripe.objects.filter(
+        material_id=material.pk, stripe=random.randrange(material.stock_stripes), quantity__gte=amount
+    ).update(quantity=F('quantity') - amount)
+    if taken:
+        return True, None
+    return rebalance(material.pk, take=amount)
+
+
+def discard(material_ids, using=None):
+    """
+    Zeroes the stripes of the given materials before their quantity is
+    overwritten with an absolute value, which then is the whole stock.
+    Must run inside a transaction.
+    """
+    stripes = MaterialStockStripe.objects.using(using) if using else MaterialStockStripe.objects
+    stripes.filter(material_id__in=material_ids).update(quantity=0)
+
+
+def configure(material, stripes):
+    """
+    Sets the number of stripes of `material` (0 turns striping off) and
+    moves its stock accordingly.
+    """
+    with transaction.atomic(using=material._state.db):
+        Material.objects.using(material._state.db).filter(pk=material.pk).update(stock_stripes=stripes)
+        rebalance(material.pk, using=material._state.db)
+    material.refresh_from_db(fields=['quantity', 'reserved_quantity', 'stock_stripes'])
+
+
+def compact(database):
+    """
+    Rebalances every striped material, and folds the stripes left behind
+    by materials that are no longer striped back into their rows, skipping
+    companies that are being moved. Each material is rebalanced in its own
+    short transaction. Returns the number of materials compacted.
+    """
+    striped = set(
+        exclude_read_only(Material.objects.using(database).filter(stock_stripes__gt=0)).values_list('pk', flat=True)
+    )
+    orphaned = set(
+        exclude_read_only(MaterialStockStripe.objects.using(database).filter(material__stock_stripes=0))
+        .values_list('material_id', flat=True).distinct()
+    )
+    for material_id in sorted(striped | orphaned):
+        with transaction.atomic(using=database):
+            rebalance(material_id, using=database)
+    return len(striped | orphaned)
+
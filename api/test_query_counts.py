@@ -0,0 +1,414 @@
+"""
+Query-count regression tests.
+
+Every endpoint is exercised against two datasets of different size. The number
+of SQL queries must be the same for both (no per-row queries) and stay within
+the endpoint's budget. Failures list each query with the application frames
+that issued it. The endpoints are read from the URL resolver, so a new route
+or method fails the suite until it has a budget (or an entry in EXCLUDED).
+"""
+import os
+import shutil
+import tempfile
+import traceback
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import override_settings
+from django.urls import URLResolver, get_resolver, reverse
+from django.utils import timezone
+from rest_framework.test import APITestCase
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from .models import Company, InwardEntry, Material, Product, ProductionOrder, ProductMaterialMapping, ReportJob, ResourceVersion, StockReservation, UserProfile
+from . import stock_stripes
+from .versioning import bump_version
+
+SCALES = (10, 1000)
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+TEST_FILES = {os.path.abspath(__file__), os.path.join(APP_DIR, 'tests.py')}
+
+
+# (URL name, method) pairs that need no budget.
+EXCLUDED = {
+    # The router's browsable index lists URLs and touches no tables.
+    ('api-root', 'GET'),
+}
+IGNORED_METHODS = {'HEAD', 'OPTIONS', 'TRACE'}
+
+
+def view_methods(callback):
+    """
+    Returns the HTTP methods a resolved view answers.
+    """
+    cls = getattr(callback, 'cls', None) or getattr(callback, 'view_class', None)
+    if cls is None:
+        # A plain Django function view.
+        return {'GET'}
+    allowed = {method.upper() for method in cls.http_method_names}
+    actions = getattr(callback, 'actions', None)
+    if actions is not None:
+        methods = {method.upper() for method in actions}
+    else:
+        methods = {method.upper() for method in cls.http_method_names if hasattr(cls, method)}
+    return (methods & allowed) - IGNORED_METHODS
+
+
+def api_endpoints(patterns=None):
+    """
+    Returns {(URL name, method)} for every named route outside the admin.
+    """
+    endpoints = set()
+    for pattern in get_resolver().url_patterns if patterns is None else patterns:
+        if isinstance(pattern, URLResolver):
+            if pattern.namespace != 'admin':
+                endpoints |= api_endpoints(pattern.url_patterns)
+        elif pattern.name:
+            endpoints |= {(pattern.name, method) for method in view_methods(pattern.callback)}
+    return endpoints
+
+
+class QueryRecorder:
+    """
+    Records every query with the call sites inside the project that issued it.
+    """
+
+    def __init__(self):
+        self.queries = []
+
+    def __call__(self, execute, sql, params, many, context):
+        frames = [
+            f'{os.path.relpath(frame.filename, settings.BASE_DIR)}:{frame.lineno} in {frame.name}'
+            for frame in traceback.extract_stack()[:-1]
+            if frame.filename.startswith(str(settings.BASE_DIR)) and frame.filename not in TEST_FILES
+        ]
+        self.queries.append((sql, frames))
+        return execute(sql, params, many, context)
+
+    def report(self):
+        lines = []
+        for index, (sql, frames) in enumerate(self.queries, 1):
+            lines.append(f'{index}. {sql}')
+            lines.extend(f'       at {frame}' for frame in frames[-3:])
+        return '\n'.join(lines)
+
+
+# Unlimited throttling keeps these tests independent of the rest of the suite.
+@override_settings(API_THROTTLE={'RATES': {}}, API_METRICS={'TOKEN': 'scrape-secret'})
+class QueryCountTests(APITestCase):
+    # Request label ('<URL name> <method>', plus a variant) -> maximum number
+    # of queries per request.
+    BUDGETS = {
+        'product-list GET': 2,
+        'product-list GET ?expand=mappings.material': 4,
+        'product-list POST': 3,
+        'product-detail GET': 2,
+        'product-detail PUT': 3,
+        'product-detail PATCH': 3,
+        'product-detail DELETE': 9,
+        'product-mappings GET': 2,
+        'product-mappings PUT': 12,
+        'product-search GET': 2,
+        'product-bulk-upsert POST': 5,
+        'material-list GET': 2,
+        'material-list POST': 3,
+        'material-detail GET': 3,
+        'material-detail PUT': 9,
+        'material-detail PATCH': 7,
+        'material-detail DELETE': 8,
+        'material-search GET': 2,
+        'material-bulk-upsert POST': 7,
+        'lowstockmaterial-list GET': 2,
+        'lowstockmaterial-detail GET': 2,
+        'productmaterialmapping-list GET': 2,
+        'productmaterialmapping-list GET ?expand=product,material': 3,
+        'productmaterialmapping-list POST': 6,
+        'productmaterialmapping-detail GET': 2,
+        'productmaterialmapping-detail PUT': 13,
+        'productmaterialmapping-detail PATCH': 11,
+        'productmaterialmapping-detail DELETE': 5,
+        'productionorder-list GET': 1,
+        'productionorder-list GET ?expand=product': 1,
+        'productionorder-list POST': 16,
+        'productionorder-detail GET': 1,
+        'productionorder-detail PUT': 4,
+        'productionorder-detail PATCH': 3,
+        'productionorder-detail DELETE': 3,
+        'inwardentry-list GET': 1,
+        'inwardentry-list POST': 6,
+        'inwardentry-detail GET': 1,
+        'inwardentry-detail PUT': 4,
+        'inwardentry-detail PATCH': 3,
+        'inwardentry-detail DELETE': 3,
+        'stockreservation-list GET': 1,
+        'stockreservation-list POST': 11,
+        'stockreservation-detail GET': 1,
+        'stockreservation-detail DELETE': 7,
+        'reportjob-list GET': 1,
+        'reportjob-list POST': 4,
+        'reportjob-detail GET': 1,
+        'reportjob-result GET': 1,
+        'reportjob-wait GET': 1,
+        'user-list GET': 1,
+        'user-detail GET': 1,
+        'user-detail PUT': 2,
+        'user-detail PATCH': 2,
+        'user-detail DELETE': 6,
+        'admin-create-user POST': 4,
+        'register POST': 6,
+        'current-user GET': 0,
+        'token_obtain_pair POST': 1,
+        'token_refresh POST': 1,
+        'dashboard-data GET': 5,
+        'bootstrap GET': 7,
+        'batch-apply POST': 31,
+        'material-calculator POST': 3,
+        'material-usage-by-product GET': 4,
+        'overall-material-usage GET': 3,
+        'overall-report GET': 5,
+        'db-connection-stats GET': 0,
+        'profile-list GET': 0,
+        'profile-download GET': 0,
+        'slow-query-summary GET': 2,
+        'metrics GET': 0,
+    }
+    PROFILE_NAME = '20260101T000000-cpu-GET_api_products-0123abcd.pstats'
+
+    def setUp(self):
+        profiles = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, profiles)
+        with open(os.path.join(profiles, self.PROFILE_NAME), 'wb') as handle:
+            handle.write(b'profile')
+        overrides = override_settings(API_PROFILER={'DIR': profiles})
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+
+    def build(self, scale):
+        """
+        Creates a company whose history has `scale` production orders and
+        inward entries, and a BOM that grows with it. Returns the rows the
+        requests refer to by name.
+        """
+        company = Company.objects.create(name=f'Scale {scale}')
+        # Also a Django staff user, so the operations endpoints answer too.
+        admin = User.objects.create_user(username=f'scale-admin-{scale}', password='password123', is_staff=True)
+        UserProfile.objects.create(user=admin, company=company, role='admin')
+        staff = []
+        for index in range(max(2, scale // 100)):
+            user = User.objects.create_user(username=f'scale-{scale}-user-{index}', password='password123')
+            UserProfile.objects.create(user=user, company=company, role='staff')
+            staff.append(user)
+
+        materials = Material.objects.bulk_create([
+            Material(company=company, name=f'Material {index}', unit='kg', quantity=10 ** 6, low_stock_threshold=10 ** 7)
+            for index in range(max(3, scale // 20))
+        ])
+        products = Product.objects.bulk_create([Product(company=company, name=f'Product {index}') for index in range(3)])
+        mappings = ProductMaterialMapping.objects.bulk_create([
+            ProductMaterialMapping(company=company, product=product, material=material, fixed_quantity=1)
+            for product in products for material in materials
+        ])
+        now = timezone.now()
+        orders = ProductionOrder.objects.bulk_create([
+            ProductionOrder(company=company, product=products[index % len(products)], quantity=1)
+            for index in range(scale)
+        ])
+        entries = InwardEntry.objects.bulk_create([
+            InwardEntry(company=company, material=materials[index % len(materials)], quantity=1)
+            for index in range(scale)
+        ])
+        reservations = StockReservation.objects.bulk_create([
+            StockReservation(company=company, material=materials[index % len(materials)], quantity=1, expires_at=now + timedelta(days=1))
+            for index in range(max(1, scale // 10))
+        ])
+        Material.objects.filter(pk__in=[material.pk for material in materials]).update(reserved_quantity=scale)
+        # Striped materials keep their stock on separate rows that on_hand must
+        # add up. Their number is fixed: an order writes one stripe per striped
+        # material it uses.
+        for material in materials[:2]:
+            stock_stripes.configure(material, 2)
+        ProductionOrder.objects.filter(pk__in=[order.pk for order in orders]).update(created_at=now - timedelta(hours=1))
+        InwardEntry.objects.filter(pk__in=[entry.pk for entry in entries]).update(created_at=now - timedelta(hours=1))
+        job = ReportJob.objects.create(
+            company=company, kind='overall_report', params={'frequency': 'daily'}, params_hash=f'scale-{scale}',
+            status=ReportJob.STATUS_SUCCEEDED, result={'rows': []}, finished_at=now, expires_at=now + timedelta(hours=1),
+        )
+        # Every resource has been written before, as in a running system.
+        bump_version(company.pk, *(resource for resource, _ in ResourceVersion.RESOURCE_CHOICES))
+        # Rows without history, for the DELETE requests.
+        spare_product = Product.objects.create(company=company, name='Spare Product')
+        spare_material = Material.objects.create(company=company, name='Spare Material', unit='kg', quantity=1)
+        return {
+            'scale': scale, 'admin': admin, 'staff': staff[0], 'product': products[0], 'material': materials[0],
+            'other_product': products[1], 'mapping': mappings[0], 'spare_mapping': mappings[-1], 'order': orders[0],
+            'entry': entries[0], 'reservation': reservations[0], 'job': job,
+            'spare_product': spare_product, 'spare_material': spare_material,
+        }
+
+    def requests(self, rows):
+        """
+        Returns [(label, URL name, method, path, data, headers)], reads first
+        and deletes last.
+        """
+        scale, product, material = rows['scale'], rows['product'], rows['material']
+        detail = lambda name, obj: reverse(name, kwargs={'pk': obj.pk})
+        usage = reverse('material-usage-by-product', kwargs={'product_id': product.pk}) + '?frequency=daily'
+        profile = reverse('profile-download', kwargs={'name': self.PROFILE_NAME})
+        refresh = str(RefreshToken.for_user(rows['admin']))
+        batch = {'operations': [
+            {'id': f'scale-{scale}-inward', 'type': 'inward_entry.create', 'data': {'material': material.pk, 'quantity': '1.00'}},
+            {'id': f'scale-{scale}-order', 'type': 'production_order.create', 'data': {'product': product.pk, 'quantity': 1}},
+        ]}
+        material_data = {'name': f'Renamed {scale}', 'unit': 'kg', 'quantity': '2000000.00', 'low_stock_threshold': '1.00'}
+        return [
+            ('product-list GET', 'product-list', 'get', reverse('product-list'), None),
+            ('product-list GET ?expand=mappings.material', 'product-list', 'get', reverse('product-list') + '?expand=mappings.material', None),
+            ('product-detail GET', 'product-detail', 'get', detail('product-detail', product), None),
+            ('product-mappings GET', 'product-mappings', 'get', detail('product-mappings', product), None),
+            ('product-search GET', 'product-search', 'get', reverse('product-search') + '?q=Product&limit=2', None),
+            ('material-list GET', 'material-list', 'get', reverse('material-list'), None),
+            ('material-detail GET', 'material-detail', 'get', detail('material-detail', material), None),
+            ('material-search GET', 'material-search', 'get', reverse('material-search') + '?q=Material&limit=2', None),
+            ('lowstockmaterial-list GET', 'lowstockmaterial-list', 'get', reverse('lowstockmaterial-list'), None),
+            ('lowstockmaterial-detail GET', 'lowstockmaterial-detail', 'get', detail('lowstockmaterial-detail', material), None),
+            ('productmaterialmapping-list GET', 'productmaterialmapping-list', 'get', reverse('productmaterialmapping-list'), None),
+            (
+                'productmaterialmapping-list GET ?expand=product,material', 'productmaterialmapping-list', 'get',
+                reverse('productmaterialmapping-list') + '?expand=product,material', None,
+            ),
+            ('productmaterialmapping-detail GET', 'productmaterialmapping-detail', 'get', detail('productmaterialmapping-detail', rows['mapping']), None),
+            ('productionorder-list GET', 'productionorder-list', 'get', reverse('productionorder-list'), None),
+            ('productionorder-list GET ?expand=product', 'productionorder-list', 'get', reverse('productionorder-list') + '?expand=product', None),
+            ('productionorder-detail GET', 'productionorder-detail', 'get', detail('productionorder-detail', rows['order']), None),
+            ('inwardentry-list GET', 'inwardentry-list', 'get', reverse('inwardentry-list'), None),
+            ('inwardentry-detail GET', 'inwardentry-detail', 'get', detail('inwardentry-detail', rows['entry']), None),
+            ('stockreservation-list GET', 'stockreservation-list', 'get', reverse('stockreservation-list'), None),
+            ('stockreservation-detail GET', 'stockreservation-detail', 'get', detail('stockreservation-detail', rows['reservation']), None),
+            ('reportjob-list GET', 'reportjob-list', 'get', reverse('reportjob-list'), None),
+            ('reportjob-detail GET', 'reportjob-detail', 'get', detail('reportjob-detail', rows['job']), None),
+            ('reportjob-result GET', 'reportjob-result', 'get', detail('reportjob-result', rows['job']), None),
+            ('reportjob-wait GET', 'reportjob-wait', 'get', detail('reportjob-wait', rows['job']), None),
+            ('user-list GET', 'user-list', 'get', reverse('user-list'), None),
+            ('user-detail GET', 'user-detail', 'get', detail('user-detail', rows['staff']), None),
+            ('current-user GET', 'current-user', 'get', reverse('current-user'), None),
+            ('dashboard-data GET', 'dashboard-data', 'get', reverse('dashboard-data'), None),
+            ('bootstrap GET', 'bootstrap', 'get', reverse('bootstrap'), None),
+            ('material-usage-by-product GET', 'material-usage-by-product', 'get', usage, None),
+            ('overall-material-usage GET', 'overall-material-usage', 'get', reverse('overall-material-usage') + '?frequency=daily', None),
+            ('overall-report GET', 'overall-report', 'get', reverse('overall-report') + '?frequency=daily', None),
+            ('db-connection-stats GET', 'db-connection-stats', 'get', reverse('db-connection-stats'), None),
+            ('profile-list GET', 'profile-list', 'get', reverse('profile-list'), None),
+            ('profile-download GET', 'profile-download', 'get', profile, None),
+            ('slow-query-summary GET', 'slow-query-summary', 'get', reverse('slow-query-summary'), None),
+            ('metrics GET', 'metrics', 'get', reverse('metrics'), None, {'HTTP_AUTHORIZATION': 'Bearer scrape-secret'}),
+            ('material-calculator POST', 'material-calculator', 'post', reverse('material-calculator'), {'product_id': product.pk, 'quantity': 2}),
+            ('token_obtain_pair POST', 'token_obtain_pair', 'post', reverse('token_obtain_pair'), {'username': rows['admin'].username, 'password': 'password123'}),
+            ('token_refresh POST', 'token_refresh', 'post', reverse('token_refresh'), {'refresh': refresh}),
+
+            ('product-list POST', 'product-list', 'post', reverse('product-list'), {'name': f'New Product {scale}'}),
+            ('product-detail PUT', 'product-detail', 'put', detail('product-detail', product), {'name': 'Product 0'}),
+            ('product-detail PATCH', 'product-detail', 'patch', detail('product-detail', product), {'name': 'Product 0'}),
+            (
+                'product-mappings PUT', 'product-mappings', 'put', detail('product-mappings', rows['other_product']),
+                [{'material': material.pk, 'fixed_quantity': '2.00'}],
+            ),
+            ('product-bulk-upsert POST', 'product-bulk-upsert', 'post', reverse('product-bulk-upsert'), [{'name': 'Product 0'}, {'name': f'Bulk Product {scale}'}]),
+            ('material-list POST', 'material-list', 'post', reverse('material-list'), {'name': f'New Material {scale}', 'unit': 'kg', 'quantity': '1.00'}),
+            ('material-detail PUT', 'material-detail', 'put', detail('material-detail', material), material_data),
+            ('material-detail PATCH', 'material-detail', 'patch', detail('material-detail', material), {'low_stock_threshold': '2.00'}),
+            (
+                'material-bulk-upsert POST', 'material-bulk-upsert', 'post', reverse('material-bulk-upsert'),
+                [{'name': f'Renamed {scale}', 'unit': 'kg', 'quantity': '3000000.00'}, {'name': f'Bulk Material {scale}', 'unit': 'kg', 'quantity': '1.00'}],
+            ),
+            (
+                'productmaterialmapping-list POST', 'productmaterialmapping-list', 'post', reverse('productmaterialmapping-list'),
+                {'product': rows['spare_product'].pk, 'material': material.pk, 'fixed_quantity': '1.00'},
+            ),
+            (
+                'productmaterialmapping-detail PUT', 'productmaterialmapping-detail', 'put', detail('productmaterialmapping-detail', rows['mapping']),
+                {'product': product.pk, 'material': material.pk, 'fixed_quantity': '3.00'},
+            ),
+            (
+                'productmaterialmapping-detail PATCH', 'productmaterialmapping-detail', 'patch',
+                detail('productmaterialmapping-detail', rows['mapping']), {'fixed_quantity': '4.00'},
+            ),
+            ('productionorder-list POST', 'productionorder-list', 'post', reverse('productionorder-list'), {'product': product.pk, 'quantity': 1}),
+            ('productionorder-detail PUT', 'productionorder-detail', 'put', detail('productionorder-detail', rows['order']), {'product': product.pk, 'quantity': 1}),
+            ('productionorder-detail PATCH', 'productionorder-detail', 'patch', detail('productionorder-detail', rows['order']), {'quantity': 1}),
+            ('inwardentry-list POST', 'inwardentry-list', 'post', reverse('inwardentry-list'), {'material': material.pk, 'quantity': '1.00'}),
+            ('inwardentry-detail PUT', 'inwardentry-detail', 'put', detail('inwardentry-detail', rows['entry']), {'material': material.pk, 'quantity': '1.00'}),
+            ('inwardentry-detail PATCH', 'inwardentry-detail', 'patch', detail('inwardentry-detail', rows['entry']), {'quantity': '1.00'}),
+            ('stockreservation-list POST', 'stockreservation-list', 'post', reverse('stockreservation-list'), {'material': material.pk, 'quantity': '1.00'}),
+            ('reportjob-list POST', 'reportjob-list', 'post', reverse('reportjob-list'), {'kind': 'overall_report', 'params': {'frequency': 'weekly'}}),
+            ('batch-apply POST', 'batch-apply', 'post', reverse('batch-apply'), batch),
+            ('user-detail PUT', 'user-detail', 'put', detail('user-detail', rows['staff']), {'role': 'staff'}),
+            ('user-detail PATCH', 'user-detail', 'patch', detail('user-detail', rows['staff']), {'role': 'staff'}),
+            (
+                'admin-create-user POST', 'admin-create-user', 'post', reverse('admin-create-user'),
+                {'username': f'scale-{scale}-new', 'password': 'Str0ng-Passw0rd!', 'email': '', 'role': 'staff'},
+            ),
+            (
+                'register POST', 'register', 'post', reverse('register'),
+                {'username': f'scale-{scale}-founder', 'password': 'Str0ng-Passw0rd!', 'password2': 'Str0ng-Passw0rd!', 'email': '', 'company_name': f'Founded {scale}'},
+            ),
+
+            ('stockreservation-detail DELETE', 'stockreservation-detail', 'delete', detail('stockreservation-detail', rows['reservation']), None),
+            ('productmaterialmapping-detail DELETE', 'productmaterialmapping-detail', 'delete', detail('productmaterialmapping-detail', rows['spare_mapping']), None),
+            ('productionorder-detail DELETE', 'productionorder-detail', 'delete', detail('productionorder-detail', rows['order']), None),
+            ('inwardentry-detail DELETE', 'inwardentry-detail', 'delete', detail('inwardentry-detail', rows['entry']), None),
+            ('product-detail DELETE', 'product-detail', 'delete', detail('product-detail', rows['spare_product']), None),
+            ('material-detail DELETE', 'material-detail', 'delete', detail('material-detail', rows['spare_material']), None),
+            ('user-detail DELETE', 'user-detail', 'delete', detail('user-detail', rows['staff']), None),
+        ]
+
+    def count_queries(self, scale):
+        rows = self.build(scale)
+        self.client.force_authenticate(user=rows['admin'])
+        # Warm per-user caches so every measured request starts from the same state.
+        self.client.get(reverse('product-list'))
+
+        recorded = {}
+        for label, _, method, url, data, *headers in self.requests(rows):
+            recorder = QueryRecorder()
+            with connection.execute_wrapper(recorder):
+                response = getattr(self.client, method)(url, data, format='json', **(headers[0] if headers else {}))
+            self.assertLess(response.status_code, 400, f'{label} failed at scale {scale}: {getattr(response, "content", b"")[:300]}')
+            recorded[label] = recorder
+        return recorded
+
+    def test_every_endpoint_has_a_budget(self):
+        """
+        Ensure every routed endpoint and method is measured and budgeted.
+        """
+        requests = self.requests(self.build(1))
+        self.assertEqual({request[0] for request in requests}, set(self.BUDGETS))
+        measured = {(request[1], request[2].upper()) for request in requests}
+        missing = api_endpoints() - measured - EXCLUDED
+        self.assertFalse(missing, f'Endpoints without a query budget: {sorted(missing)}')
+
+    def test_query_counts_do_not_grow_with_data(self):
+        """
+        Ensure every endpoint issues the same number of queries at every data
+        scale, within its budget.
+        """
+        results = [(scale, self.count_queries(scale)) for scale in SCALES]
+
+        for name, budget in self.BUDGETS.items():
+            small_scale, small = results[0][0], results[0][1][name]
+            for scale, recorded in results[1:]:
+                large = recorded[name]
+                with self.subTest(endpoint=name, scale=scale):
+                    self.assertEqual(
+                        len(large.queries), len(small.queries),
+                        f'{name}: {len(small.queries)} queries at scale {small_scale} but {len(large.queries)} '
+                        f'at scale {scale}.\nQueries at scale {scale}:\n{large.report()}',
+                    )
+            for scale, recorded in results:
+                with self.subTest(endpoint=name, scale=scale, budget=budget):
+                    self.assertLessEqual(
+                        len(recorded[name].queries), budget,
+                        f'{name} exceeded its budget of {budget} queries at scale {scale}:\n{recorded[name].report()}',
+                    )
@@ -1,8 +1,33 @@
+import gzip
+import json
+import os
+import pstats
+import re
+import shutil
+import tempfile
+from datetime import timedelta
+from decimal import Decimal
+from io import StringIO
+from unittest import mock
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import OperationalError, connection, connections, transaction
+from django.db.models import F
+from django.http import StreamingHttpResponse
+from django.test import RequestFactory, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+from django.utils import timezone
 from rest_framework import status
 from rest_framework.test import APITestCase
+from rest_framework_simplejwt.tokens import RefreshToken
 from django.contrib.auth.models import User
-from .models import Company, UserProfile, Product, Material, ProductMaterialMapping, InwardEntry
+from .admin import EstimatedCountPaginator
+from .models import Company, CompanyShard, UserProfile, Product, Material, ProductMaterialMapping, ProductionOrder, InwardEntry, ReportJob, ArchivedProductionOrder, ArchivedInwardEntry, IdempotencyKey, SlowQuery, StockReservation, MaterialStockStripe
+from . import metrics, slow_queries
 
 class CoreApiTests(APITestCase):
     def setUp(self):
@@ -359,3 +384,2362 @@ class ProductionOrderRuleTests(APITestCase):
         data2 = {'product': self.product_with_mapping.pk, 'quantity': 2}
         response2 = self.client.post(url, data2, format='json')
         self.assertEqual(response2.status_code, status.HTTP_201_CREATED, "Subsequent production failed")
+
+
+class ConditionalGetTests(APITestCase):
+    def setUp(self):
+        self.company = Company.objects.create(name="ETag Corp")
+        self.admin_user = User.objects.create_user(username='etagadmin', password='password123')
+        UserProfile.objects.create(user=self.admin_user, company=self.company, role='admin')
+        self.material = Material.objects.create(company=self.company, name='Etag Material', unit='kg', quantity=5)
+        self.client.force_authenticate(user=self.admin_user)
+
+    def test_list_returns_validators_and_304_on_match(self):
+        """
+        Ensure list endpoints send an ETag and answer a matching If-None-Match with 304
+        without querying the materials table.
+        """
+        url = reverse('material-list')
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        etag = response['ETag']
+        self.assertIn('Last-Modified', response)
+
+        # The profile is cached on the forced user, leaving only the version lookup.
+        with self.assertNumQueries(1):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(response['ETag'], etag)
+
+    def test_write_changes_etag(self):
+        """
+        Ensure a write to the resource invalidates previously issued ETags.
+        """
+        url = reverse('material-list')
+        etag = self.client.get(url)['ETag']
+        low_stock_etag = self.client.get(reverse('lowstockmaterial-list'))['ETag']
+
+        self.material.quantity = 50
+        self.material.save()
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response['ETag'], etag)
+        response = self.client.get(reverse('lowstockmaterial-list'), HTTP_IF_NONE_MATCH=low_stock_etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_etag_is_per_representation(self):
+        """
+        Ensure list and detail views of the same resource do not share an ETag.
+        """
+        list_etag = self.client.get(reverse('material-list'))['ETag']
+        detail_url = reverse('material-detail', kwargs={'pk': self.material.pk})
+        response = self.client.get(detail_url, HTTP_IF_NONE_MATCH=list_etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        response = self.client.get(detail_url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def test_coalesced_bumps_write_each_resource_once(self):
+        """
+        Ensure bumps collected during a write are applied once per resource, and not at all when it fails.
+        """
+        from .models import ResourceVersion
+        from .versioning import bump_version, coalesced_bumps
+
+        def versions():
+            return dict(ResourceVersion.objects.filter(company=self.company).values_list('resource', 'version'))
+
+        # Creating the material bumped 'materials' once.
+        response = self.client.post(reverse('inwardentry-list'), {'material': self.material.pk, 'quantity': '1.00'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(versions(), {'materials': 2, 'inward_entries': 1})
+
+        with self.assertNumQueries(1), coalesced_bumps():
+            bump_version(self.company.pk, 'materials')
+            bump_version(self.company.pk, 'materials', 'inward_entries')
+        self.assertEqual(versions(), {'materials': 3, 'inward_entries': 2})
+
+        with self.assertRaises(ValueError), coalesced_bumps():
+            bump_version(self.company.pk, 'materials')
+            raise ValueError()
+        self.assertEqual(versions(), {'materials': 3, 'inward_entries': 2})
+
+
+class CompressionTests(APITestCase):
+    def setUp(self):
+        self.company = Company.objects.create(name="Gzip Corp")
+        self.user = User.objects.create_user(username='gzipuser', password='password123')
+        UserProfile.objects.create(user=self.user, company=self.company, role='staff')
+        Material.objects.bulk_create([
+            Material(company=self.company, name=f'Material {i}', unit='kg', quantity=i)
+            for i in range(50)
+        ])
+        self.client.force_authenticate(user=self.user)
+
+    def test_large_response_is_gzipped(self):
+        """
+        Ensure large JSON responses are compressed when the client accepts gzip.
+        """
+        response = self.client.get(reverse('material-list'), HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', response['Vary'])
+        self.assertTrue(response['ETag'].startswith('W/'))
+        payload = json.loads(gzip.decompress(response.content))
+        self.assertEqual(len(payload), 50)
+
+    def test_no_compression_without_accept_encoding_or_below_threshold(self):
+        """
+        Ensure identity responses are sent to clients without gzip support and for small payloads.
+        """
+        response = self.client.get(reverse('material-list'))
+        self.assertFalse(response.has_header('Content-Encoding'))
+
+        with override_settings(API_COMPRESSION={'MIN_SIZE': 10 ** 6}):
+            response = self.client.get(reverse('material-list'), HTTP_ACCEPT_ENCODING='gzip')
+        self.assertFalse(response.has_header('Content-Encoding'))
+
+    def test_streaming_response_is_compressed(self):
+        """
+        Ensure streaming responses are compressed chunk by chunk.
+        """
+        from .compression import CompressionMiddleware
+
+        rows = [f'row {i},{i * 2}\n'.encode() for i in range(1000)]
+        middleware = CompressionMiddleware(lambda request: StreamingHttpResponse(iter(rows), content_type='text/csv'))
+        request = RequestFactory().get('/api/export/', HTTP_ACCEPT_ENCODING='gzip;q=1.0, identity;q=0.5')
+        response = middleware(request)
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(b''.join(response.streaming_content)), b''.join(rows))
+
+
+class DatabaseConnectionStatsTests(APITestCase):
+    def setUp(self):
+        self.company = Company.objects.create(name="Pool Corp")
+        self.admin_user = User.objects.create_user(username='pooladmin', password='password123')
+        UserProfile.objects.create(user=self.admin_user, company=self.company, role='admin')
+        self.staff_user = User.objects.create_user(username='poolstaff', password='password123')
+        UserProfile.objects.create(user=self.staff_user, company=self.company, role='staff')
+        self.operator = User.objects.create_user(username='pooloperator', password='password123', is_staff=True)
+
+    def test_operator_can_view_connection_gauges(self):
+        """
+        Ensure Django staff users can read connection mode and age gauges for each alias.
+        """
+        self.client.force_authenticate(user=self.operator)
+        response = self.client.get(reverse('db-connection-stats'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        default = response.data['default']
+        self.assertIn(default['mode'], ('per-request', 'persistent', 'pooled'))
+        self.assertGreaterEqual(default['open_connections'], 1)
+        self.assertGreaterEqual(default['connection_age_max_seconds'], 0)
+
+    def test_company_users_cannot_view_connection_gauges(self):
+        """
+        Ensure company staff and company admins are forbidden from reading connection gauges.
+        """
+        for user in (self.staff_user, self.admin_user):
+            self.client.force_authenticate(user=user)
+            response = self.client.get(reverse('db-connection-stats'))
+            self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_benchmark_command_reports_latency(self):
+        """
+        Ensure the connection benchmark runs and reports percentiles.
+        """
+        out = StringIO()
+        call_command('benchmark_db_connections', threads=2, requests=5, modes='persistent', stdout=out)
+        self.assertIn('p95', out.getvalue())
+
+
+@override_settings(READ_REPLICA_ENABLED=True, READ_REPLICA_STICKY_SECONDS=60, SHARED_CACHE=True)
+class ReadReplicaRoutingTests(APITestCase):
+    databases = {'default', 'replica'}
+
+    def setUp(self):
+        from .routing import reset_replica_health
+
+        reset_replica_health()
+        cache.clear()
+        self.company = Company.objects.create(name="Replica Corp")
+        self.admin_user = User.objects.create_user(username='replicaadmin', password='password123')
+        self.profile = UserProfile.objects.create(user=self.admin_user, company=self.company, role='admin')
+        Product.objects.create(company=self.company, name='Primary Product')
+
+        # The replica holds a copy of the tenant with a product the primary does not have,
+        # so responses show which database served them.
+        Company.objects.using('replica').create(pk=self.company.pk, name=self.company.name)
+        User.objects.using('replica').create(pk=self.admin_user.pk, username='replicaadmin')
+        UserProfile.objects.using('replica').create(
+            pk=self.profile.pk, user_id=self.admin_user.pk, company_id=self.company.pk, role='admin'
+        )
+        Product.objects.using('replica').create(company_id=self.company.pk, name='Replica Product')
+
+        access = RefreshToken.for_user(self.admin_user).access_token
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {access}')
+
+    def product_names(self):
+        response = self.client.get(reverse('product-list'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return [item['name'] for item in response.data]
+
+    def test_list_reads_are_served_by_replica(self):
+        """
+        Ensure list endpoints read from the replica.
+        """
+        self.assertEqual(self.product_names(), ['Replica Product'])
+
+    def test_reads_after_own_write_stay_on_primary(self):
+        """
+        Ensure a user's reads go to the primary within the sticky window after their write.
+        """
+        response = self.client.post(reverse('product-list'), {'name': 'Fresh Product'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertFalse(Product.objects.using('replica').filter(name='Fresh Product').exists())
+        self.assertEqual(sorted(self.product_names()), ['Fresh Product', 'Primary Product'])
+
+    def test_falls_back_to_primary_when_replica_is_unavailable(self):
+        """
+        Ensure reads fall back to the primary when the replica cannot be reached.
+        """
+        with self.assertLogs('api.routing', level='WARNING'), mock.patch.object(
+            connections['replica'], 'ensure_connection', side_effect=OperationalError
+        ) as ensure_connection:
+            self.assertEqual(self.product_names(), ['Primary Product'])
+            # The outage is remembered; the replica is not probed again.
+            self.assertEqual(self.product_names(), ['Primary Product'])
+        self.assertEqual(ensure_connection.call_count, 1)
+
+    def test_writes_and_unmarked_views_use_primary(self):
+        """
+        Ensure views that are not marked for replica reads use the primary.
+        """
+        with override_settings(READ_REPLICA_ENABLED=False):
+            self.assertEqual(self.product_names(), ['Primary Product'])
+        response = self.client.get(reverse('user-list'))
+        self.assertEqual([item['username'] for item in response.data], ['replicaadmin'])
+
+    def test_replica_is_not_used_without_shared_cache(self):
+        """
+        Ensure replica reads stay off when primary pins would only live in one process.
+        """
+        from .routing import _unshared_cache_warned
+
+        _unshared_cache_warned[0] = False
+        with override_settings(SHARED_CACHE=False), self.assertLogs('api.routing', level='WARNING'):
+            self.assertEqual(self.product_names(), ['Primary Product'])
+
+
+@override_settings(TENANT_SHARDING_ENABLED=True)
+class TenantShardingTests(APITestCase):
+    databases = {'default', 'shard_1'}
+
+    def setUp(self):
+        from .routing import invalidate_shard_map
+
+        invalidate_shard_map()
+        cache.clear()
+        self.addCleanup(invalidate_shard_map)
+        self.company = Company.objects.create(name="Shard Corp")
+        self.admin_user = User.objects.create_user(username='shardadmin', password='password123')
+        UserProfile.objects.create(user=self.admin_user, company=self.company, role='admin')
+        access = RefreshToken.for_user(self.admin_user).access_token
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {access}')
+
+    def place_on_shard(self):
+        from .routing import invalidate_shard_map
+
+        Company.objects.using('shard_1').create(pk=self.company.pk, name=self.company.name)
+        CompanyShard.objects.create(company=self.company, database='shard_1')
+        invalidate_shard_map()
+
+    def test_tenant_queries_go_to_company_shard(self):
+        """
+        Ensure a sharded company's reads and writes go to its shard only.
+        """
+        self.place_on_shard()
+        response = self.client.post(reverse('product-list'), {'name': 'Sharded Product'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertTrue(Product.objects.using('shard_1').filter(name='Sharded Product').exists())
+        self.assertFalse(Product.objects.using('default').filter(name='Sharded Product').exists())
+
+        response = self.client.get(reverse('product-list'))
+        self.assertEqual([item['name'] for item in response.data], ['Sharded Product'])
+
+    def test_unsharded_company_stays_on_default(self):
+        """
+        Ensure companies without a shard mapping keep using the default database.
+        """
+        response = self.client.post(reverse('product-list'), {'name': 'Default Product'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertTrue(Product.objects.using('default').filter(name='Default Product').exists())
+        self.assertFalse(Product.objects.using('shard_1').exists())
+
+    def test_writes_are_rejected_while_company_is_read_only(self):
+        """
+        Ensure writes are refused with 503 while a company is being moved.
+        """
+        from .routing import invalidate_shard_map
+
+        CompanyShard.objects.create(company=self.company, database='default', read_only=True)
+        invalidate_shard_map()
+        response = self.client.post(reverse('product-list'), {'name': 'Blocked'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertIn('Retry-After', response)
+        self.assertEqual(self.client.get(reverse('product-list')).status_code, status.HTTP_200_OK)
+
+    def test_move_command_copies_verifies_and_flips(self):
+        """
+        Ensure moving a company copies every tenant row, updates the map and clears the source.
+        """
+        product = Product.objects.create(company=self.company, name='Moved Product')
+        material = Material.objects.create(company=self.company, name='Moved Material', unit='kg', quantity=40)
+        ProductMaterialMapping.objects.create(company=self.company, product=product, material=material, fixed_quantity=2)
+        InwardEntry.objects.create(company=self.company, material=material, quantity=40)
+        ProductionOrder.objects.create(company=self.company, product=product, quantity=3)
+
+        out = StringIO()
+        call_command('move_company_shard', self.company.pk, 'shard_1', settle_seconds=0, batch_size=1, stdout=out)
+        self.assertIn('verified', out.getvalue())
+
+        self.assertEqual(CompanyShard.objects.get(company=self.company).database, 'shard_1')
+        for model in (Product, Material, ProductMaterialMapping, InwardEntry, ProductionOrder):
+            self.assertEqual(model.objects.using('shard_1').filter(company_id=self.company.pk).count(), 1)
+            self.assertFalse(model.objects.using('default').filter(company_id=self.company.pk).exists())
+
+        response = self.client.get(reverse('material-list'))
+        self.assertEqual([item['name'] for item in response.data], ['Moved Material'])
+
+        # New rows on the shard get ids from its own block, never the source's.
+        response = self.client.post(reverse('product-list'), {'name': 'New On Shard'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertGreater(response.data['id'], settings.DATABASE_SHARD_ID_BLOCK)
+
+    def test_move_command_deletes_without_per_row_version_bumps(self):
+        """
+        Ensure clearing the source shard bumps each resource version once, however many rows it deletes.
+        """
+        from .versioning import bump_version
+
+        product = Product.objects.create(company=self.company, name='Bulk Product')
+        materials = Material.objects.bulk_create([
+            Material(company=self.company, name=f'Bulk Material {i}', unit='kg', quantity=1) for i in range(20)
+        ])
+        ProductMaterialMapping.objects.bulk_create([
+            ProductMaterialMapping(company=self.company, product=product, material=material, fixed_quantity=1)
+            for material in materials
+        ])
+        # bulk_create skips the signals that create the version rows.
+        bump_version(self.company.pk, 'materials', 'mappings')
+        with CaptureQueriesContext(connections['default']) as source, CaptureQueriesContext(connections['shard_1']) as target:
+            call_command('move_company_shard', self.company.pk, 'shard_1', settle_seconds=0, stdout=StringIO())
+        bumps = [
+            query['sql'] for query in source.captured_queries + target.captured_queries
+            if query['sql'].startswith('UPDATE "api_resourceversion"')
+        ]
+        self.assertEqual(len(bumps), 1)
+        self.assertFalse(Material.objects.using('default').filter(company_id=self.company.pk).exists())
+
+    def test_read_only_company_refuses_model_and_job_writes(self):
+        """
+        Ensure saves, deletes and periodic jobs leave a company alone while it is being moved.
+        """
+        from .reservations import sweep_expired
+        from .routing import CompanyReadOnly, invalidate_shard_map
+
+        product = Product.objects.create(company=self.company, name='Frozen')
+        material = Material.objects.create(company=self.company, name='Frozen Material', unit='kg', quantity=10, reserved_quantity=1)
+        StockReservation.objects.create(
+            company=self.company, material=material, quantity=1, expires_at=timezone.now() - timedelta(minutes=1)
+        )
+        CompanyShard.objects.create(company=self.company, database='default', read_only=True)
+        invalidate_shard_map()
+
+        with self.assertRaises(CompanyReadOnly):
+            Product.objects.create(company=self.company, name='Blocked')
+        with self.assertRaises(CompanyReadOnly), transaction.atomic():
+            product.delete()
+        self.assertEqual(sweep_expired('default'), 0)
+        self.assertEqual(StockReservation.objects.count(), 1)
+
+
+class ReportJobTests(APITestCase):
+    def setUp(self):
+        self.company = Company.objects.create(name="Report Job Corp")
+        self.user = User.objects.create_user(username='reportuser', password='password123')
+        UserProfile.objects.create(user=self.user, company=self.company, role='staff')
+        self.product = Product.objects.create(company=self.company, name='Report Product')
+        self.material = Material.objects.create(company=self.company, name='Report Material', unit='kg', quantity=100)
+        ProductMaterialMapping.objects.create(company=self.company, product=self.product, material=self.material, fixed_quantity=2)
+        InwardEntry.objects.create(company=self.company, material=self.material, quantity=30)
+        ProductionOrder.objects.create(company=self.company, product=self.product, quantity=4)
+        self.client.force_authenticate(user=self.user)
+
+    def submit(self, kind='overall_report', **params):
+        return self.client.post(reverse('reportjob-list'), {'kind': kind, 'params': params}, format='json')
+
+    def test_job_runs_and_result_matches_synchronous_report(self):
+        """
+        Ensure a submitted job is run by the worker and its result matches the synchronous endpoint.
+        """
+        response = self.submit(frequency='weekly')
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        job_id = response.data['id']
+        result_url = reverse('reportjob-result', kwargs={'pk': job_id})
+        self.assertEqual(self.client.get(result_url).status_code, status.HTTP_202_ACCEPTED)
+
+        call_command('run_report_worker', once=True, stdout=StringIO())
+
+        detail = self.client.get(reverse('reportjob-detail', kwargs={'pk': job_id}))
+        self.assertEqual(detail.data['status'], 'succeeded')
+        self.assertIsNotNone(detail.data['expires_at'])
+        result = self.client.get(result_url)
+        expected = self.client.get(reverse('overall-report'), {'frequency': 'weekly'})
+        self.assertEqual(json.loads(result.content), json.loads(expected.content))
+
+    def test_identical_in_flight_jobs_are_deduplicated(self):
+        """
+        Ensure submitting the same parameters twice returns the same job.
+        """
+        first = self.submit(frequency='Daily')
+        second = self.submit(frequency='daily')
+        self.assertEqual(second.status_code, status.HTTP_200_OK)
+        self.assertEqual(first.data['id'], second.data['id'])
+        self.assertEqual(self.submit(frequency='monthly').status_code, status.HTTP_202_ACCEPTED)
+
+    def test_invalid_parameters_are_rejected(self):
+        """
+        Ensure unknown frequencies and foreign products are rejected at submission.
+        """
+        self.assertEqual(self.submit(frequency='yearly').status_code, status.HTTP_400_BAD_REQUEST)
+        other = Product.objects.create(company=Company.objects.create(name='Other'), name='Other Product')
+        response = self.submit(kind='material_usage_by_product', product_id=other.pk)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    @override_settings(REPORT_JOB_COMPANY_CONCURRENCY=1)
+    def test_company_concurrency_limit(self):
+        """
+        Ensure a company's queued jobs wait while it is at its concurrency limit.
+        """
+        from .report_jobs import claim_next_job
+
+        self.submit(frequency='daily')
+        self.submit(frequency='weekly')
+        running = claim_next_job()
+        self.assertIsNotNone(running)
+        self.assertIsNone(claim_next_job())
+
+    def test_expired_results_are_purged(self):
+        """
+        Ensure finished jobs are deleted once they expire.
+        """
+        from .report_jobs import expire_jobs
+
+        job_id = self.submit(frequency='daily').data['id']
+        call_command('run_report_worker', once=True, stdout=StringIO())
+        ReportJob.objects.filter(pk=job_id).update(expires_at=timezone.now())
+        expire_jobs()
+        self.assertFalse(ReportJob.objects.filter(pk=job_id).exists())
+
+    def test_finished_jobs_are_not_reused(self):
+        """
+        Ensure a submission after an identical job finished queues a fresh one.
+        """
+        first = self.submit(frequency='daily').data['id']
+        call_command('run_report_worker', once=True, stdout=StringIO())
+        response = self.submit(frequency='daily')
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertNotEqual(response.data['id'], first)
+
+    @override_settings(REPORT_JOB_WAIT_SECONDS=0)
+    def test_wait_returns_quickly_with_retry_after(self):
+        """
+        Ensure the long-poll gives up within its short window and tells the client when to retry.
+        """
+        job_id = self.submit(frequency='daily').data['id']
+        url = reverse('reportjob-wait', kwargs={'pk': job_id})
+        response = self.client.get(url, {'status': 'queued'})
+        self.assertEqual(response.data['status'], 'queued')
+        self.assertIn('Retry-After', response)
+
+        call_command('run_report_worker', once=True, stdout=StringIO())
+        response = self.client.get(url, {'status': 'queued'})
+        self.assertEqual(response.data['status'], 'succeeded')
+        self.assertNotIn('Retry-After', response)
+
+
+class ArchiveHistoryTests(APITestCase):
+    def setUp(self):
+        self.company = Company.objects.create(name="Archive Corp")
+        self.user = User.objects.create_user(username='archiveuser', password='password123')
+        UserProfile.objects.create(user=self.user, company=self.company, role='staff')
+        self.product = Product.objects.create(company=self.company, name='Archive Product')
+        self.material = Material.objects.create(company=self.company, name='Archive Material', unit='kg', quantity=500)
+        ProductMaterialMapping.objects.create(company=self.company, product=self.product, material=self.material, fixed_quantity=2)
+        self.client.force_authenticate(user=self.user)
+
+        now = timezone.now()
+        old_order = ProductionOrder.objects.create(company=self.company, product=self.product, quantity=3)
+        old_entry = InwardEntry.objects.create(company=self.company, material=self.material, quantity=40)
+        # Old enough to be archived, but still inside the monthly report window.
+        ProductionOrder.objects.filter(pk=old_order.pk).update(created_at=now - timedelta(days=20))
+        InwardEntry.objects.filter(pk=old_entry.pk).update(created_at=now - timedelta(days=20))
+        ProductionOrder.objects.create(company=self.company, product=self.product, quantity=5)
+        InwardEntry.objects.create(company=self.company, material=self.material, quantity=10)
+
+    def archive(self, **options):
+        call_command('archive_history', horizon_days=10, stdout=StringIO(), **options)
+
+    def test_old_rows_move_to_archive_tables(self):
+        """
+        Ensure only rows older than the horizon are moved, keeping their ids.
+        """
+        old_ids = set(ProductionOrder.objects.filter(quantity=3).values_list('pk', flat=True))
+        self.archive(batch_size=1)
+        self.assertEqual(ProductionOrder.objects.count(), 1)
+        self.assertEqual(InwardEntry.objects.count(), 1)
+        self.assertEqual(set(ArchivedProductionOrder.objects.values_list('pk', flat=True)), old_ids)
+        self.assertEqual(ArchivedInwardEntry.objects.get().quantity, 40)
+
+    def test_dry_run_moves_nothing(self):
+        """
+        Ensure a dry run leaves the hot tables untouched.
+        """
+        self.archive(dry_run=True)
+        self.assertEqual(ProductionOrder.objects.count(), 2)
+        self.assertFalse(ArchivedProductionOrder.objects.exists())
+
+    def test_reports_span_hot_and_archived_rows(self):
+        """
+        Ensure reports return the same totals before and after archiving.
+        """
+        monthly = {'frequency': 'monthly'}
+        before = self.client.get(reverse('overall-report'), monthly).json()
+        usage_before = self.client.get(reverse('overall-material-usage'), monthly).json()
+        self.archive()
+        self.assertEqual(self.client.get(reverse('overall-report'), monthly).json(), before)
+        self.assertEqual(self.client.get(reverse('overall-material-usage'), monthly).json(), usage_before)
+        self.assertEqual(before['Archive Material']['usage'], 16.0)
+        self.assertEqual(before['Archive Material']['inward'], 50.0)
+
+    def test_recent_reports_do_not_read_archived_rows(self):
+        """
+        Ensure a report range that ends before the archive only reads hot rows.
+        """
+        self.archive()
+        response = self.client.get(reverse('overall-report'), {'frequency': 'weekly'})
+        self.assertEqual(response.json()['Archive Material']['usage'], 10.0)
+
+    def test_archived_history_counts_for_first_production_rule(self):
+        """
+        Ensure archived inward entries still satisfy the first-production rule.
+        """
+        other = Product.objects.create(company=self.company, name='Second Product')
+        ProductMaterialMapping.objects.create(company=self.company, product=other, material=self.material, fixed_quantity=1)
+        self.archive()
+        InwardEntry.objects.all().delete()
+        response = self.client.post(reverse('productionorder-list'), {'product': other.pk, 'quantity': 1}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+
+class IdempotencyKeyTests(APITestCase):
+    def setUp(self):
+        self.company = Company.objects.create(name="Idempotent Corp")
+        self.user = User.objects.create_user(username='retryuser', password='password123')
+        UserProfile.objects.create(user=self.user, company=self.company, role='staff')
+        self.product = Product.objects.create(company=self.company, name='Retry Product')
+        self.material = Material.objects.create(company=self.company, name='Retry Material', unit='kg', quantity=100)
+        ProductMaterialMapping.objects.create(company=self.company, product=self.product, material=self.material, fixed_quantity=2)
+        InwardEntry.objects.create(company=self.company, material=self.material, quantity=1)
+        self.client.force_authenticate(user=self.user)
+
+    def order(self, key, quantity=5):
+        return self.client.post(
+            reverse('productionorder-list'), {'product': self.product.pk, 'quantity': quantity},
+            format='json', HTTP_IDEMPOTENCY_KEY=key,
+        )
+
+    def test_retry_replays_response_without_deducting_again(self):
+        """
+        Ensure a retried production order returns the original response and deducts stock once.
+        """
+        first = self.order('order-1')
+        self.assertEqual(first.status_code, status.HTTP_201_CREATED)
+        second = self.order('order-1')
+        self.assertEqual(second.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(second['Idempotent-Replayed'], 'true')
+        self.assertEqual(second.data, first.data)
+        self.assertEqual(ProductionOrder.objects.count(), 1)
+        self.material.refresh_from_db()
+        self.assertEqual(self.material.quantity, 90)
+
+    def test_inward_entry_retry_counts_stock_once(self):
+        """
+        Ensure a retried inward entry adds its quantity once.
+        """
+        for _ in range(2):
+            response = self.client.post(
+                reverse('inwardentry-list'), {'material': self.material.pk, 'quantity': '7.00'},
+                format='json', HTTP_IDEMPOTENCY_KEY='inward-1',
+            )
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.material.refresh_from_db()
+        self.assertEqual(self.material.quantity, 107)
+
+    def test_key_reused_with_different_payload_is_rejected(self):
+        """
+        Ensure a key cannot be replayed for a different request body.
+        """
+        self.order('order-2', quantity=1)
+        self.assertEqual(self.order('order-2', quantity=2).status_code, status.HTTP_422_UNPROCESSABLE_ENTITY)
+
+    def test_failed_request_releases_key(self):
+        """
+        Ensure a rejected request does not store its key, so a corrected retry can run.
+        """
+        self.assertEqual(self.order('order-3', quantity=500).status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(IdempotencyKey.objects.exists())
+        Material.objects.filter(pk=self.material.pk).update(quantity=1000)
+        self.assertEqual(self.order('order-3', quantity=500).status_code, status.HTTP_201_CREATED)
+
+    @override_settings(IDEMPOTENCY_LOCK_TIMEOUT=0)
+    def test_in_flight_duplicate_gets_conflict(self):
+        """
+        Ensure a duplicate of a request that is still running is not executed.
+        """
+        from .idempotency import request_fingerprint
+
+        request = mock.Mock(method='POST', path=reverse('productionorder-list'), user=self.user,
+                            data={'product': self.product.pk, 'quantity': 5})
+        IdempotencyKey.objects.create(
+            company=self.company, key='order-4', fingerprint=request_fingerprint(request),
+            expires_at=timezone.now() + timedelta(hours=1),
+        )
+        response = self.order('order-4')
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        self.assertEqual(response['Retry-After'], '1')
+        self.assertFalse(ProductionOrder.objects.exists())
+
+    def test_expired_keys_are_purged(self):
+        """
+        Ensure expired keys are evicted by the purge command and can be reused.
+        """
+        self.order('order-5', quantity=1)
+        IdempotencyKey.objects.update(expires_at=timezone.now())
+        call_command('purge_idempotency_keys', stdout=StringIO())
+        self.assertFalse(IdempotencyKey.objects.exists())
+        self.assertNotIn('Idempotent-Replayed', self.order('order-5', quantity=1))
+        self.assertEqual(ProductionOrder.objects.count(), 2)
+
+
+class OptimisticConcurrencyTests(APITestCase):
+    def setUp(self):
+        self.company = Company.objects.create(name="Versioned Corp")
+        self.admin = User.objects.create_user(username='versionadmin', password='password123')
+        UserProfile.objects.create(user=self.admin, company=self.company, role='admin')
+        self.material = Material.objects.create(company=self.company, name='Versioned Material', unit='kg', quantity=50)
+        self.product = Product.objects.create(company=self.company, name='Versioned Product')
+        self.mapping = ProductMaterialMapping.objects.create(
+            company=self.company, product=self.product, material=self.material, fixed_quantity=1
+        )
+        self.client.force_authenticate(user=self.admin)
+        self.url = reverse('material-detail', kwargs={'pk': self.material.pk})
+
+    def test_update_with_current_etag_succeeds(self):
+        """
+        Ensure an update carrying the current ETag is applied and returns the new ETag.
+        """
+        etag = self.client.get(self.url)['ETag']
+        response = self.client.patch(self.url, {'quantity': '60.00'}, format='json', HTTP_IF_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['version'], 2)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=response['ETag']).status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def test_update_with_stale_etag_is_rejected(self):
+        """
+        Ensure an update based on an outdated read gets 412 and changes nothing.
+        """
+        etag = self.client.get(self.url)['ETag']
+        self.client.post(reverse('inwardentry-list'), {'material': self.material.pk, 'quantity': '5.00'}, format='json')
+        response = self.client.patch(self.url, {'quantity': '0.00'}, format='json', HTTP_IF_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        self.material.refresh_from_db()
+        self.assertEqual(self.material.quantity, 55)
+
+    def test_conditional_update_detects_concurrent_write(self):
+        """
+        Ensure the conditional UPDATE fails when the row changed after it was read.
+        """
+        from .versioning import PreconditionFailed, conditional_update
+
+        Material.objects.filter(pk=self.material.pk).update(version=F('version') + 1)
+        with self.assertRaises(PreconditionFailed):
+            conditional_update(self.material, self.material.version, quantity=0)
+
+    def test_mapping_updates_use_versions(self):
+        """
+        Ensure mapping updates honour If-Match as well.
+        """
+        url = reverse('productmaterialmapping-detail', kwargs={'pk': self.mapping.pk})
+        etag = self.client.get(url)['ETag']
+        self.assertEqual(self.client.patch(url, {'fixed_quantity': '2.00'}, format='json', HTTP_IF_MATCH=etag).status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            self.client.patch(url, {'fixed_quantity': '3.00'}, format='json', HTTP_IF_MATCH=etag).status_code,
+            status.HTTP_412_PRECONDITION_FAILED,
+        )
+
+    def test_stock_changes_bump_versions(self):
+        """
+        Ensure inward entries and production orders change the material version and collection ETag.
+        """
+        list_etag = self.client.get(reverse('material-list'))['ETag']
+        self.client.post(reverse('inwardentry-list'), {'material': self.material.pk, 'quantity': '5.00'}, format='json')
+        self.client.post(reverse('productionorder-list'), {'product': self.product.pk, 'quantity': 2}, format='json')
+        self.material.refresh_from_db()
+        self.assertEqual((self.material.quantity, self.material.version), (53, 3))
+        self.assertNotEqual(self.client.get(reverse('material-list'))['ETag'], list_etag)
+
+
+THROTTLE_TEST_SETTINGS = {
+    'BACKEND': 'api.throttling.LocalTokenBucket',
+    'RATES': {'reads': '3/min', 'writes': '100/min', 'reports': '2/min', 'exports': '1/min'},
+}
+
+
+@override_settings(API_THROTTLE=THROTTLE_TEST_SETTINGS)
+class ThrottlingTests(APITestCase):
+    def setUp(self):
+        from . import throttling
+
+        throttling.reset_backend()
+        self.addCleanup(throttling.reset_backend)
+        self.company = Company.objects.create(name="Throttled Corp")
+        self.user = User.objects.create_user(username='pollinguser', password='password123')
+        UserProfile.objects.create(user=self.user, company=self.company, role='staff')
+        self.client.force_authenticate(user=self.user)
+
+    def test_reports_have_their_own_tighter_budget(self):
+        """
+        Ensure report endpoints are throttled on the reports budget with a Retry-After header.
+        """
+        url = reverse('overall-report')
+        for _ in range(2):
+            self.assertEqual(self.client.get(url).status_code, status.HTTP_200_OK)
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertTrue(0 < int(response['Retry-After']) <= 30)
+        # Catalogue reads are budgeted separately.
+        self.assertEqual(self.client.get(reverse('material-list')).status_code, status.HTTP_200_OK)
+
+    def test_budget_is_per_company(self):
+        """
+        Ensure one company exhausting its budget does not throttle another.
+        """
+        for _ in range(3):
+            self.client.get(reverse('material-list'))
+        self.assertEqual(self.client.get(reverse('material-list')).status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+
+        colleague = User.objects.create_user(username='colleague', password='password123')
+        UserProfile.objects.create(user=colleague, company=self.company, role='staff')
+        self.client.force_authenticate(user=colleague)
+        self.assertEqual(self.client.get(reverse('material-list')).status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+
+        other = User.objects.create_user(username='otheruser', password='password123')
+        UserProfile.objects.create(user=other, company=Company.objects.create(name='Quiet Corp'), role='staff')
+        self.client.force_authenticate(user=other)
+        self.assertEqual(self.client.get(reverse('material-list')).status_code, status.HTTP_200_OK)
+
+    def test_report_downloads_use_the_exports_budget(self):
+        """
+        Ensure report job result downloads are throttled on the exports budget.
+        """
+        job = ReportJob.objects.create(company=self.company, kind='overall_report', params={}, params_hash='x')
+        url = reverse('reportjob-result', kwargs={'pk': job.pk})
+        self.assertEqual(self.client.get(url).status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual(self.client.get(url).status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+
+    def test_batches_take_a_writes_token_per_operation(self):
+        """
+        Ensure a batch is charged like the single writes it replaces.
+        """
+        material = Material.objects.create(company=self.company, name='Batched', unit='kg', quantity=0)
+        operations = [
+            {'id': f'op-{index}', 'type': 'inward_entry.create', 'data': {'material': material.pk, 'quantity': '1.00'}}
+            for index in range(3)
+        ]
+        with override_settings(API_THROTTLE={**THROTTLE_TEST_SETTINGS, 'RATES': {'writes': '4/min'}}):
+            response = self.client.post(reverse('batch-apply'), {'operations': operations}, format='json')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            response = self.client.post(reverse('batch-apply'), {'operations': operations[:2]}, format='json')
+            self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+            self.assertEqual(self.client.post(reverse('inwardentry-list'), operations[0]['data'], format='json').status_code, 201)
+
+    def test_bucket_refills_over_time(self):
+        """
+        Ensure tokens are refilled at the configured rate.
+        """
+        from .throttling import LocalTokenBucket
+
+        bucket = LocalTokenBucket()
+        with mock.patch('api.throttling.time.monotonic', return_value=100.0):
+            self.assertEqual(bucket.consume('key', 1, 0.5), 0)
+            self.assertEqual(bucket.consume('key', 1, 0.5), 2.0)
+        with mock.patch('api.throttling.time.monotonic', return_value=102.0):
+            self.assertEqual(bucket.consume('key', 1, 0.5), 0)
+
+    def test_cache_backend_shares_budget(self):
+        """
+        Ensure the cache backend enforces the same budget through the shared cache.
+        """
+        from .throttling import CacheTokenBucket
+
+        cache.clear()
+        bucket, other_worker = CacheTokenBucket(), CacheTokenBucket()
+        with mock.patch('api.throttling.time.time', return_value=1000.0):
+            self.assertEqual(bucket.consume('api:throttle:test', 2, 1.0), 0)
+            self.assertEqual(other_worker.consume('api:throttle:test', 2, 1.0), 0)
+            self.assertEqual(bucket.consume('api:throttle:test', 2, 1.0), 1.0)
+
+
+class BulkUpsertTests(APITestCase):
+    def setUp(self):
+        self.company = Company.objects.create(name="Onboarding Corp")
+        self.admin = User.objects.create_user(username='onboarder', password='password123')
+        UserProfile.objects.create(user=self.admin, company=self.company, role='admin')
+        self.steel = Material.objects.create(company=self.company, name='Steel', unit='kg', quantity=10)
+        self.glue = Material.objects.create(company=self.company, name='Glue', unit='l', quantity=5)
+        self.client.force_authenticate(user=self.admin)
+        self.url = reverse('material-bulk-upsert')
+
+    def payload(self):
+        return [
+            {'name': 'Steel', 'unit': 'kg', 'quantity': '25.00'},
+            {'name': 'Glue', 'unit': 'l', 'quantity': '5.00'},
+            {'name': 'Bolts', 'unit': 'pcs', 'quantity': '100.00'},
+        ]
+
+    def test_dry_run_returns_diff_without_writing(self):
+        """
+        Ensure a dry run reports created and changed rows and writes nothing.
+        """
+        response = self.client.post(f'{self.url}?dry_run=true', self.payload(), format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual((response.data['created'], response.data['updated'], response.data['unchanged']), (1, 1, 1))
+        self.assertEqual(response.data['diff']['created'], ['Bolts'])
+        self.assertEqual(response.data['diff']['updated'][0]['name'], 'Steel')
+        self.assertIn('quantity', response.data['diff']['updated'][0]['changes'])
+        self.assertFalse(Material.objects.filter(name='Bolts').exists())
+
+    def test_upsert_creates_and_updates(self):
+        """
+        Ensure new rows are inserted, changed rows updated with a new version and unchanged rows left alone.
+        """
+        list_etag = self.client.get(reverse('material-list'))['ETag']
+        response = self.client.post(self.url, self.payload(), format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual((response.data['created'], response.data['updated']), (1, 1))
+        self.steel.refresh_from_db()
+        self.glue.refresh_from_db()
+        self.assertEqual((self.steel.quantity, self.steel.version), (25, 2))
+        self.assertEqual(self.glue.version, 1)
+        self.assertEqual(Material.objects.get(name='Bolts').company, self.company)
+        self.assertNotEqual(self.client.get(reverse('material-list'))['ETag'], list_etag)
+
+    def test_concurrent_insert_is_planned_again(self):
+        """
+        Ensure a row inserted by another request after the diff was read is updated, not reset to version 1.
+        """
+        from .views import MaterialViewSet
+
+        Material.objects.filter(pk=self.steel.pk).update(version=3)
+        plan = MaterialViewSet.plan_upsert
+        calls = []
+
+        def stale_plan(view, keys, rows, fields, lock):
+            created, updated, unchanged = plan(view, keys, rows, fields, lock)
+            if not calls:
+                # The first plan has not seen Steel yet, as if it was inserted meanwhile.
+                created += [row for current, row, _ in updated]
+                updated = []
+            calls.append(1)
+            return created, updated, unchanged
+
+        with mock.patch.object(MaterialViewSet, 'plan_upsert', stale_plan):
+            response = self.client.post(self.url, self.payload(), format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(calls), 2)
+        self.steel.refresh_from_db()
+        self.assertEqual((self.steel.quantity, self.steel.version), (25, 4))
+        self.assertTrue(Material.objects.filter(name='Bolts').exists())
+
+    def test_large_upsert_uses_few_queries(self):
+        """
+        Ensure thousands of rows are written with a handful of queries.
+        """
+        rows = [{'name': f'Material {i}', 'unit': 'kg', 'quantity': '1.00'} for i in range(2500)]
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(self.url, rows, format='json')
+        self.assertEqual(response.data['created'], 2500)
+        # Inserts are batched; SQLite's variable limit makes its batches smaller than Postgres'.
+        inserts = [query for query in queries.captured_queries if query['sql'].startswith('INSERT')]
+        self.assertLess(len(inserts), 25)
+        self.assertLessEqual(len(queries) - len(inserts), 4)
+        self.assertEqual(Material.objects.filter(company=self.company).count(), 2502)
+
+    def test_duplicate_names_are_rejected(self):
+        """
+        Ensure a payload naming the same material twice is rejected.
+        """
+        rows = [{'name': 'Nails', 'unit': 'pcs', 'quantity': '1.00'}] * 2
+        self.assertEqual(self.client.post(self.url, rows, format='json').status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_product_upsert_skips_existing_names(self):
+        """
+        Ensure product upserts only insert names the company does not have yet.
+        """
+        Product.objects.create(company=self.company, name='Chair')
+        response = self.client.post(reverse('product-bulk-upsert'), [{'name': 'Chair'}, {'name': 'Table'}], format='json')
+        self.assertEqual((response.data['created'], response.data['unchanged']), (1, 1))
+        self.assertEqual(Product.objects.filter(company=self.company).count(), 2)
+
+    def test_staff_cannot_bulk_upsert(self):
+        """
+        Ensure only admins can use the bulk endpoint.
+        """
+        staff = User.objects.create_user(username='onboardstaff', password='password123')
+        UserProfile.objects.create(user=staff, company=self.company, role='staff')
+        self.client.force_authenticate(user=staff)
+        self.assertEqual(self.client.post(self.url, self.payload(), format='json').status_code, status.HTTP_403_FORBIDDEN)
+
+
+class BomReplaceTests(APITestCase):
+    def setUp(self):
+        self.company = Company.objects.create(name="Recipe Corp")
+        self.admin = User.objects.create_user(username='recipeadmin', password='password123')
+        UserProfile.objects.create(user=self.admin, company=self.company, role='admin')
+        self.product = Product.objects.create(company=self.company, name='Desk')
+        self.wood = Material.objects.create(company=self.company, name='Wood', unit='kg', quantity=100)
+        self.screws = Material.objects.create(company=self.company, name='Screws', unit='pcs', quantity=100)
+        self.paint = Material.objects.create(company=self.company, name='Paint', unit='l', quantity=100)
+        ProductMaterialMapping.objects.create(company=self.company, product=self.product, material=self.wood, fixed_quantity=5)
+        ProductMaterialMapping.objects.create(company=self.company, product=self.product, material=self.screws, fixed_quantity=8)
+        self.client.force_authenticate(user=self.admin)
+        self.url = reverse('product-mappings', kwargs={'pk': self.product.pk})
+
+    def test_put_replaces_whole_bom(self):
+        """
+        Ensure the submitted list becomes the BOM: missing rows are deleted, changed rows updated and new rows created.
+        """
+        self.product.refresh_from_db()
+        version = self.product.bom_version
+        payload = [
+            {'material': self.wood.pk, 'fixed_quantity': '6.00'},
+            {'material': self.paint.pk, 'fixed_quantity': '0.50'},
+        ]
+        response = self.client.put(self.url, payload, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual((response.data['created'], response.data['updated'], response.data['deleted']), (1, 1, 1))
+        self.assertEqual(response.data['bom_version'], version + 1)
+        bom = {m.material_id: m.fixed_quantity for m in ProductMaterialMapping.objects.filter(product=self.product)}
+        self.assertEqual(bom, {self.wood.pk: 6, self.paint.pk: Decimal('0.50')})
+
+    def test_single_mapping_update_invalidates_bom_and_products(self):
+        """
+        Ensure PATCHing one mapping changes the BOM and product ETags, so conditional GETs do not return a stale 304.
+        """
+        bom_etag = self.client.get(self.url)['ETag']
+        product_url = reverse('product-detail', kwargs={'pk': self.product.pk})
+        product_etag = self.client.get(product_url)['ETag']
+        mapping = ProductMaterialMapping.objects.get(product=self.product, material=self.wood)
+        response = self.client.patch(
+            reverse('productmaterialmapping-detail', kwargs={'pk': mapping.pk}), {'fixed_quantity': '7.00'}, format='json'
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=bom_etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn(Decimal('7.00'), [Decimal(entry['fixed_quantity']) for entry in response.data['mappings']])
+        self.assertEqual(self.client.get(product_url, HTTP_IF_NONE_MATCH=product_etag).status_code, status.HTTP_200_OK)
+
+    def test_mapping_patch_locks_the_product_before_the_mapping(self):
+        """
+        Ensure a single-mapping PATCH takes the product lock first, like a BOM replace, and that a replace after it writes a new mapping version.
+        """
+        from . import bom, versioning
+        calls = []
+        mapping = ProductMaterialMapping.objects.get(product=self.product, material=self.wood)
+        lock_boms, conditional_update = bom.lock_boms, versioning.conditional_update
+        with mock.patch('api.views.lock_boms', side_effect=lambda ids: calls.append('product') or lock_boms(ids)), \
+                mock.patch('api.versioning.conditional_update',
+                           side_effect=lambda *args, **kwargs: calls.append('mapping') or conditional_update(*args, **kwargs)):
+            response = self.client.patch(
+                reverse('productmaterialmapping-detail', kwargs={'pk': mapping.pk}), {'fixed_quantity': '7.00'}, format='json'
+            )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(calls, ['product', 'mapping'])
+
+        patched = response.data['version']
+        response = self.client.put(self.url, [{'material': self.wood.pk, 'fixed_quantity': '9.00'}], format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        mapping.refresh_from_db()
+        self.assertEqual(mapping.version, patched + 1)
+
+    def test_invalid_bom_changes_nothing(self):
+        """
+        Ensure a BOM naming another company's material is rejected without partial writes.
+        """
+        foreign = Material.objects.create(company=Company.objects.create(name='Other'), name='Foreign', unit='kg', quantity=1)
+        payload = [{'material': self.paint.pk, 'fixed_quantity': '1.00'}, {'material': foreign.pk, 'fixed_quantity': '1.00'}]
+        self.assertEqual(self.client.put(self.url, payload, format='json').status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(ProductMaterialMapping.objects.filter(product=self.product).count(), 2)
+
+    def test_if_match_guards_concurrent_edits(self):
+        """
+        Ensure a replace based on an outdated BOM gets 412.
+        """
+        etag = self.client.get(self.url)['ETag']
+        ProductMaterialMapping.objects.create(company=self.company, product=self.product, material=self.paint, fixed_quantity=1)
+        response = self.client.put(self.url, [], format='json', HTTP_IF_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        self.assertEqual(ProductMaterialMapping.objects.filter(product=self.product).count(), 3)
+
+    def test_replace_invalidates_product_and_mapping_etags(self):
+        """
+        Ensure cached product and mapping lists are invalidated by a replace.
+        """
+        products_etag = self.client.get(reverse('product-list'))['ETag']
+        mappings_etag = self.client.get(reverse('productmaterialmapping-list'))['ETag']
+        self.client.put(self.url, [{'material': self.wood.pk, 'fixed_quantity': '5.00'}], format='json')
+        self.assertNotEqual(self.client.get(reverse('product-list'))['ETag'], products_etag)
+        self.assertNotEqual(self.client.get(reverse('productmaterialmapping-list'))['ETag'], mappings_etag)
+
+    def test_staff_can_read_but_not_replace(self):
+        """
+        Ensure staff can view a BOM but only admins can replace it.
+        """
+        staff = User.objects.create_user(username='recipestaff', password='password123')
+        UserProfile.objects.create(user=staff, company=self.company, role='staff')
+        self.client.force_authenticate(user=staff)
+        self.assertEqual(len(self.client.get(self.url).data['mappings']), 2)
+        self.assertEqual(self.client.put(self.url, [], format='json').status_code, status.HTTP_403_FORBIDDEN)
+
+
+class RequestProfilerTests(APITestCase):
+    def setUp(self):
+        self.company = Company.objects.create(name="Profiled Corp")
+        self.admin = User.objects.create_user(username='profileadmin', password='password123')
+        UserProfile.objects.create(user=self.admin, company=self.company, role='admin')
+        self.staff = User.objects.create_user(username='profilestaff', password='password123')
+        UserProfile.objects.create(user=self.staff, company=self.company, role='staff')
+        self.operator = User.objects.create_user(username='profileoperator', password='password123', is_staff=True)
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, ignore_errors=True)
+        overrides = override_settings(API_PROFILER={'DIR': self.directory, 'MAX_FILES': 2})
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+
+    def auth(self, user):
+        return {'HTTP_AUTHORIZATION': f'Bearer {RefreshToken.for_user(user).access_token}'}
+
+    def test_operator_request_is_profiled_and_downloadable(self):
+        """
+        Ensure a Django staff user's flagged request is stored as pstats and can be listed and downloaded.
+        """
+        response = self.client.get(reverse('material-list'), HTTP_X_PROFILE='pstats', **self.auth(self.operator))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        name = response['X-Profile']
+        self.assertTrue(name.endswith('.pstats'))
+        pstats.Stats(os.path.join(self.directory, name))
+
+        listing = self.client.get(reverse('profile-list'), **self.auth(self.operator))
+        self.assertEqual([profile['name'] for profile in listing.data], [name])
+        download = self.client.get(reverse('profile-download', kwargs={'name': name}), **self.auth(self.operator))
+        self.assertEqual(download.status_code, status.HTTP_200_OK)
+        self.assertGreater(len(b''.join(download.streaming_content)), 0)
+
+    def test_sampling_profile_uses_speedscope_format(self):
+        """
+        Ensure the sampling mode writes a speedscope document.
+        """
+        url = reverse('material-list') + '?_profile=speedscope'
+        name = self.client.get(url, **self.auth(self.operator))['X-Profile']
+        with open(os.path.join(self.directory, name)) as handle:
+            document = json.load(handle)
+        self.assertEqual(document['profiles'][0]['type'], 'sampled')
+        self.assertEqual(len(document['profiles'][0]['samples']), len(document['profiles'][0]['weights']))
+
+    def test_company_users_flag_is_ignored(self):
+        """
+        Ensure company staff and company admins cannot trigger profiling or list profiles.
+        """
+        for user in (self.staff, self.admin):
+            response = self.client.get(reverse('material-list'), HTTP_X_PROFILE='pstats', **self.auth(user))
+            self.assertNotIn('X-Profile', response)
+            self.assertEqual(os.listdir(self.directory), [])
+            self.assertEqual(self.client.get(reverse('profile-list'), **self.auth(user)).status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_unflagged_requests_skip_profiler(self):
+        """
+        Ensure requests without the flag never look up the caller.
+        """
+        with mock.patch('api.profiling.is_staff') as is_staff:
+            self.client.get(reverse('material-list'), **self.auth(self.operator))
+        is_staff.assert_not_called()
+
+    def test_profile_count_and_size_are_capped(self):
+        """
+        Ensure only the newest MAX_FILES profiles are kept and oversized profiles are dropped.
+        """
+        for _ in range(3):
+            self.client.get(reverse('material-list'), HTTP_X_PROFILE='1', **self.auth(self.operator))
+        self.assertEqual(len(os.listdir(self.directory)), 2)
+
+        with override_settings(API_PROFILER={'DIR': self.directory, 'MAX_FILE_BYTES': 10}):
+            response = self.client.get(reverse('material-list'), HTTP_X_PROFILE='1', **self.auth(self.operator))
+        self.assertTrue(response['X-Profile'].startswith('discarded'))
+        self.assertEqual(len(os.listdir(self.directory)), 2)
+
+    def test_download_rejects_unknown_names(self):
+        """
+        Ensure only stored profile files can be downloaded.
+        """
+        url = reverse('profile-download', kwargs={'name': 'settings.py'})
+        self.assertEqual(self.client.get(url, **self.auth(self.operator)).status_code, status.HTTP_404_NOT_FOUND)
+
+
+class SlowQueryLogTests(APITestCase):
+    def setUp(self):
+        self.company = Company.objects.create(name="Slow Corp")
+        self.admin = User.objects.create_user(username='slowadmin', password='password123')
+        UserProfile.objects.create(user=self.admin, company=self.company, role='admin')
+        self.staff = User.objects.create_user(username='slowstaff', password='password123')
+        UserProfile.objects.create(user=self.staff, company=self.company, role='staff')
+        self.operator = User.objects.create_user(username='slowoperator', password='password123', is_staff=True)
+        Material.objects.create(company=self.company, name='Wire', unit='m', quantity=5)
+        slow_queries.install(connection)
+        slow_queries.buffer.drain()
+        self.addCleanup(slow_queries.buffer.drain)
+
+    def auth(self, user):
+        return {'HTTP_AUTHORIZATION': f'Bearer {RefreshToken.for_user(user).access_token}'}
+
+    def test_statements_differing_only_in_values_share_a_fingerprint(self):
+        """
+        Ensure literals, placeholders and IN lists are normalized away.
+        """
+        first = slow_queries.normalize("SELECT * FROM api_material WHERE id IN (1, 2, 3) AND name = 'Wire'")
+        second = slow_queries.normalize("SELECT * FROM api_material WHERE id IN (%s, %s) AND name = %s")
+        self.assertEqual(first, second)
+        self.assertEqual(first[0], 'SELECT * FROM api_material WHERE id IN (...) AND name = ?')
+        self.assertNotEqual(first[1], slow_queries.normalize('SELECT * FROM api_product WHERE id = 1')[1])
+
+    def test_buffer_is_bounded(self):
+        """
+        Ensure the ring buffer keeps only the newest entries and counts the dropped ones.
+        """
+        ring = slow_queries.SlowQueryBuffer(2)
+        for index in range(3):
+            ring.append({'index': index})
+        self.assertEqual(ring.dropped, 1)
+        self.assertEqual([entry['index'] for entry in ring.drain()], [1, 2])
+        self.assertEqual(len(ring), 0)
+
+    @override_settings(SLOW_QUERY_LOG={'THRESHOLD_MS': 0})
+    def test_slow_queries_are_attributed_to_view_and_tenant(self):
+        """
+        Ensure logged statements record the view, tenant and parameter shape, and
+        flushing does not log itself.
+        """
+        response = self.client.get(reverse('material-list'), **self.auth(self.staff))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        written = slow_queries.flush()
+        self.assertGreater(written, 0)
+        self.assertEqual(SlowQuery.objects.count(), written)
+
+        entry = SlowQuery.objects.filter(statement__contains='FROM "api_material"').get()
+        self.assertEqual(entry.view, 'api.views.MaterialViewSet')
+        self.assertEqual(entry.tenant_id, self.company.pk)
+        self.assertEqual(entry.database, 'default')
+        self.assertIn('int', entry.params_shape)
+        self.assertIn(' in list', entry.stack)
+        self.assertFalse(SlowQuery.objects.filter(statement__contains='api_slowquery').exists())
+
+    def test_fast_queries_are_not_logged(self):
+        """
+        Ensure statements under the threshold never reach the buffer.
+        """
+        self.client.get(reverse('material-list'), **self.auth(self.staff))
+        self.assertEqual(len(slow_queries.buffer), 0)
+
+    def test_summary_ranks_statements_by_total_time(self):
+        """
+        Ensure the ops endpoint aggregates count, total, p95 and views per fingerprint.
+        """
+        for duration in range(1, 21):
+            SlowQuery.objects.create(
+                fingerprint='a' * 40, statement='SELECT ?', duration_ms=duration, database='default', view='api.views.A'
+            )
+        SlowQuery.objects.create(
+            fingerprint='b' * 40, statement='UPDATE ?', duration_ms=500, database='default', view='api.views.B'
+        )
+        SlowQuery.objects.create(
+            fingerprint='c' * 40, statement='SELECT old', duration_ms=900, database='default',
+            created_at=timezone.now() - timedelta(hours=48),
+        )
+
+        response = self.client.get(reverse('slow-query-summary'), **self.auth(self.operator))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([row['fingerprint'] for row in response.data], ['b' * 40, 'a' * 40])
+        top, second = response.data
+        self.assertEqual((top['count'], top['total_ms'], top['p95_ms']), (1, 500, 500))
+        self.assertEqual((second['count'], second['total_ms'], second['p95_ms'], second['max_ms']), (20, 210, 19, 20))
+        self.assertEqual(second['views'], {'api.views.A': 20})
+
+        response = self.client.get(reverse('slow-query-summary') + '?hours=72&limit=1', **self.auth(self.operator))
+        self.assertEqual([row['fingerprint'] for row in response.data], ['c' * 40])
+
+    def test_summary_is_for_operators_only(self):
+        """
+        Ensure company staff and company admins cannot read the slow-query log, which holds every company's SQL.
+        """
+        for user in (self.staff, self.admin):
+            response = self.client.get(reverse('slow-query-summary'), **self.auth(user))
+            self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+
+class MetricsEndpointTests(APITestCase):
+    def setUp(self):
+        self.company = Company.objects.create(name="Metered Corp")
+        self.admin = User.objects.create_user(username='metricsadmin', password='password123')
+        UserProfile.objects.create(user=self.admin, company=self.company, role='admin')
+        self.staff = User.objects.create_user(username='metricsstaff', password='password123')
+        UserProfile.objects.create(user=self.staff, company=self.company, role='staff')
+        self.operator = User.objects.create_user(username='metricsoperator', password='password123', is_staff=True)
+        self.material = Material.objects.create(company=self.company, name='Resin', unit='kg', quantity=1)
+        self.product = Product.objects.create(company=self.company, name='Chair')
+        ProductMaterialMapping.objects.create(company=self.company, product=self.product, material=self.material, fixed_quantity=5)
+        metrics.install(connection)
+        metrics.reset()
+        self.addCleanup(metrics.reset)
+
+    def auth(self, user):
+        return {'HTTP_AUTHORIZATION': f'Bearer {RefreshToken.for_user(user).access_token}'}
+
+    def scrape(self):
+        response = self.client.get('/metrics', **self.auth(self.operator))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        return response.content.decode()
+
+    def test_requests_are_recorded_by_route_and_status(self):
+        """
+        Ensure latency histograms and DB usage are labelled by URL name and status.
+        """
+        self.client.get(reverse('material-list'), **self.auth(self.staff))
+        self.client.get(reverse('material-detail', kwargs={'pk': 0}), **self.auth(self.staff))
+        body = self.scrape()
+
+        self.assertIn('api_request_duration_seconds_count{route="material-list",method="GET",status="200"} 1', body)
+        self.assertIn('api_request_duration_seconds_count{route="material-detail",method="GET",status="404"} 1', body)
+        self.assertIn('api_request_duration_seconds_bucket{route="material-list",method="GET",status="200",le="+Inf"} 1', body)
+        self.assertIn('# TYPE api_request_duration_seconds histogram', body)
+        self.assertGreater(metrics.request_db_queries.value(route='material-list'), 0)
+        self.assertIn('api_db_open_connections{database="default"}', body)
+
+    def test_stock_mutations_and_rejections_are_counted(self):
+        """
+        Ensure inward entries, production orders and stock rejections update their counters.
+        """
+        response = self.client.post(
+            reverse('inwardentry-list'), {'material': self.material.pk, 'quantity': '9.00'}, format='json', **self.auth(self.staff)
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.client.post(reverse('productionorder-list'), {'product': self.product.pk, 'quantity': 2}, format='json', **self.auth(self.staff))
+        response = self.client.post(
+            reverse('productionorder-list'), {'product': self.product.pk, 'quantity': 5}, format='json', **self.auth(self.staff)
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        body = self.scrape()
+        self.assertIn('api_stock_mutations_total{kind="inward"} 1', body)
+        self.assertIn('api_stock_mutations_total{kind="production"} 1', body)
+        self.assertIn(f'api_insufficient_stock_rejections_total{{material_id="{self.material.pk}"}} 1', body)
+
+    def test_etag_cache_hits_are_counted(self):
+        """
+        Ensure conditional requests answered with 304 count as cache hits.
+        """
+        etag = self.client.get(reverse('material-list'), **self.auth(self.staff))['ETag']
+        self.client.get(reverse('material-list'), HTTP_IF_NONE_MATCH=etag, **self.auth(self.staff))
+        self.assertEqual(metrics.cache_requests.value(cache='etag', result='miss'), 1)
+        self.assertEqual(metrics.cache_requests.value(cache='etag', result='hit'), 1)
+
+    @override_settings(API_METRICS={'TOKEN': 'scrape-secret'})
+    def test_scrapers_need_the_token_or_a_staff_account(self):
+        """
+        Ensure the endpoint accepts the configured bearer token and Django staff users, never company admins.
+        """
+        self.assertEqual(self.client.get('/metrics').status_code, 403)
+        self.assertEqual(self.client.get('/metrics', **self.auth(self.staff)).status_code, 403)
+        self.assertEqual(self.client.get('/metrics', **self.auth(self.admin)).status_code, 403)
+        self.assertEqual(self.client.get('/metrics', **self.auth(self.operator)).status_code, 200)
+        self.assertEqual(self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer scrape-secret').status_code, 200)
+
+    def test_multiprocess_snapshots_are_merged(self):
+        """
+        Ensure a scrape sums every worker's snapshot and ignores gauges of exited workers.
+        """
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        exited_pid = 4194304 + os.getpid()
+        buckets = list(metrics.request_latency.buckets)
+        with open(os.path.join(directory, f'metrics-{exited_pid}-0a1b2c.json'), 'w') as handle:
+            json.dump({
+                'api_stock_mutations_total': {
+                    'type': 'counter', 'help': '', 'labels': ['kind'], 'buckets': [], 'samples': [[['inward'], 5]],
+                },
+                'api_request_duration_seconds': {
+                    'type': 'histogram', 'help': '', 'labels': ['route', 'method', 'status'], 'buckets': buckets,
+                    'samples': [[['material-list', 'GET', '200'], [1] + [0] * len(buckets) + [0.001]]],
+                },
+                'api_db_open_connections': {
+                    'type': 'gauge', 'help': '', 'labels': ['database'], 'buckets': [], 'samples': [[['default'], 40]],
+                },
+            }, handle)
+
+        metrics.stock_mutations.inc(2, kind='inward')
+        metrics.request_latency.observe(0.001, route='material-list', method='GET', status=200)
+        with override_settings(API_METRICS={'MULTIPROCESS_DIR': directory}):
+            body = metrics.render(metrics.aggregate())
+        self.assertIn('api_stock_mutations_total{kind="inward"} 7', body)
+        self.assertIn('api_request_duration_seconds_count{route="material-list",method="GET",status="200"} 2', body)
+        open_connections = re.search(r'api_db_open_connections\{database="default"\} (\d+)', body)
+        self.assertLess(int(open_connections.group(1)), 40)
+        self.assertTrue(os.path.exists(os.path.join(directory, metrics.snapshot_name())))
+
+    def test_exited_workers_are_folded_into_the_totals(self):
+        """
+        Ensure a worker reusing a dead worker's pid never overwrites its counts, and retiring a worker keeps them.
+        """
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        pid = 4194304 + os.getpid()
+
+        def counter(value):
+            return {'api_stock_mutations_total': {
+                'type': 'counter', 'help': '', 'labels': ['kind'], 'buckets': [], 'samples': [[['inward'], value]],
+            }}
+
+        def scrape():
+            body = metrics.render(metrics.aggregate())
+            return int(re.search(r'api_stock_mutations_total\{kind="inward"\} (\d+)', body).group(1))
+
+        with override_settings(API_METRICS={'MULTIPROCESS_DIR': directory}):
+            with open(os.path.join(directory, f'metrics-{pid}-0a1b2c.json'), 'w') as handle:
+                json.dump(counter(5), handle)
+            # A later worker that was given the same pid.
+            with open(os.path.join(directory, f'metrics-{pid}-3d4e5f.json'), 'w') as handle:
+                json.dump(counter(2), handle)
+            self.assertEqual(scrape(), 7)
+
+            metrics.retire_process(pid)
+            self.assertEqual(
+                sorted(name for name in os.listdir(directory) if not name.startswith(f'metrics-{os.getpid()}-')),
+                ['metrics-exited.json'],
+            )
+            self.assertEqual(scrape(), 7)
+            with open(os.path.join(directory, f'metrics-{pid}-6a7b8c.json'), 'w') as handle:
+                json.dump(counter(1), handle)
+            self.assertEqual(scrape(), 8)
+
+
+class LargeTableAdminTests(APITestCase):
+    def setUp(self):
+        self.superuser = User.objects.create_superuser(username='root', password='password123', email='root@example.com')
+        self.company = Company.objects.create(name="Admin Corp")
+        self.other_company = Company.objects.create(name="Elsewhere Ltd")
+        self.product = Product.objects.create(company=self.company, name='Shelf')
+        self.other_product = Product.objects.create(company=self.other_company, name='Crate')
+        self.client.force_login(self.superuser)
+        self.url = reverse('admin:api_productionorder_changelist')
+
+    def add_orders(self, count, company=None, product=None):
+        ProductionOrder.objects.bulk_create([
+            ProductionOrder(company=company or self.company, product=product or self.product, quantity=1)
+            for _ in range(count)
+        ])
+
+    def test_changelist_queries_do_not_grow_with_rows(self):
+        """
+        Ensure the changelist joins related rows and runs a single count.
+        """
+        self.add_orders(5)
+        with CaptureQueriesContext(connection) as small:
+            self.assertEqual(self.client.get(self.url).status_code, 200)
+        self.add_orders(40)
+        with CaptureQueriesContext(connection) as large:
+            response = self.client.get(self.url)
+        self.assertEqual(len(large), len(small))
+        self.assertEqual(response.context['cl'].result_count, 45)
+        self.assertIsInstance(response.context['cl'].paginator, EstimatedCountPaginator)
+        counts = [query['sql'] for query in large.captured_queries if 'COUNT(' in query['sql'].upper()]
+        self.assertEqual(len(counts), 1)
+
+    def test_dates_are_filtered_by_range_without_scanning_distinct_dates(self):
+        """
+        Ensure the changelist offers bounded date ranges and never lists the distinct dates of the table.
+        """
+        self.add_orders(3)
+        ProductionOrder.objects.filter(pk=ProductionOrder.objects.first().pk).update(created_at=timezone.now() - timedelta(days=400))
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.client.get(self.url).status_code, 200)
+        self.assertFalse([query['sql'] for query in queries.captured_queries if 'DISTINCT' in query['sql'].upper()])
+
+        response = self.client.get(self.url, {'created_at__gte': (timezone.now() - timedelta(days=7)).isoformat()})
+        self.assertEqual(response.context['cl'].result_count, 2)
+
+    def test_count_is_bounded(self):
+        """
+        Ensure the row count stops at COUNT_LIMIT.
+        """
+        self.add_orders(15)
+        with mock.patch.object(EstimatedCountPaginator, 'COUNT_LIMIT', 10):
+            response = self.client.get(self.url + '?q=Shelf')
+        self.assertEqual(response.context['cl'].result_count, 11)
+
+    def test_company_filter_takes_an_id_instead_of_listing_companies(self):
+        """
+        Ensure the company filter neither lists every company nor ignores the typed id.
+        """
+        self.add_orders(3)
+        self.add_orders(2, company=self.other_company, product=self.other_product)
+        response = self.client.get(self.url)
+        self.assertNotContains(response, 'company__id__exact=')
+        self.assertContains(response, 'name="company__id__exact"')
+
+        response = self.client.get(self.url, {'company__id__exact': self.other_company.pk})
+        self.assertEqual(response.context['cl'].result_count, 2)
+        self.assertContains(response, f'value="{self.other_company.pk}"')
+
+    def test_archive_action_moves_rows_in_bulk(self):
+        """
+        Ensure the archive action copies the selected rows and removes them from the hot table.
+        """
+        self.add_orders(4)
+        selected = list(ProductionOrder.objects.values_list('pk', flat=True)[:3])
+        response = self.client.post(self.url, {'action': 'archive_selected', '_selected_action': selected})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(ProductionOrder.objects.count(), 1)
+        self.assertEqual(sorted(ArchivedProductionOrder.objects.values_list('pk', flat=True)), sorted(selected))
+
+    def test_delete_confirmation_is_summarised(self):
+        """
+        Ensure the delete confirmation previews a few rows instead of rendering all of them.
+        """
+        self.add_orders(30)
+        selected = list(ProductionOrder.objects.values_list('pk', flat=True))
+        response = self.client.post(self.url, {'action': 'delete_selected', '_selected_action': selected})
+        self.assertContains(response, 'and 10 more')
+
+        self.client.post(self.url, {'action': 'delete_selected', '_selected_action': selected, 'post': 'yes'})
+        self.assertEqual(ProductionOrder.objects.count(), 0)
+
+    def test_change_form_uses_autocomplete(self):
+        """
+        Ensure company and product are autocomplete widgets on the change form.
+        """
+        response = self.client.get(reverse('admin:api_productionorder_add'))
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'class="admin-autocomplete"', count=2)
+
+
+class SearchTests(APITestCase):
+    def setUp(self):
+        self.company = Company.objects.create(name="Search Corp")
+        self.user = User.objects.create_user(username='searcher', password='password123')
+        UserProfile.objects.create(user=self.user, company=self.company, role='staff')
+        other_company = Company.objects.create(name="Other Search Corp")
+        self.sheet = Material.objects.create(
+            company=self.company, name='Stainless Steel Sheet', style='Brushed', unit='kg', quantity=1
+        )
+        self.rod = Material.objects.create(company=self.company, name='Steel Rod', unit='pcs', quantity=1)
+        self.wire = Material.objects.create(company=self.company, name='Copper Wire', unit='m', quantity=1)
+        Material.objects.create(company=other_company, name='Steel Beam', unit='pcs', quantity=1)
+        Product.objects.create(company=self.company, name='Garden Bench')
+        self.client.force_authenticate(user=self.user)
+
+    def search(self, query, resource='material', **params):
+        response = self.client.get(reverse(f'{resource}-search'), {'q': query, **params})
+        self.assertEqual(response.status_code, status.HTTP_200_OK, response.content)
+        return response.data
+
+    def names(self, data):
+        return [item['name'] for item in data['results']]
+
+    def test_substring_search_is_scoped_to_company(self):
+        """
+        Ensure substring matches come back ranked, with scores, for the user's company only.
+        """
+        data = self.search('steel')
+        self.assertEqual(sorted(self.names(data)), ['Stainless Steel Sheet', 'Steel Rod'])
+        self.assertIn('score', data['results'][0])
+        self.assertGreaterEqual(data['results'][0]['score'], data['results'][1]['score'])
+        self.assertIsNone(data['next'])
+        self.assertEqual(self.names(self.search('stain sheet')), ['Stainless Steel Sheet'])
+
+    def test_style_and_unit_are_searchable(self):
+        """
+        Ensure style and unit are part of the index.
+        """
+        self.assertEqual(self.names(self.search('brushed')), ['Stainless Steel Sheet'])
+
+    def test_misspellings_fall_back_to_fuzzy_matching(self):
+        """
+        Ensure a typo still finds the closest material first.
+        """
+        self.assertEqual(self.names(self.search('coper'))[0], 'Copper Wire')
+        self.assertNotIn('Copper Wire', self.names(self.search('stele')))
+
+    def test_short_queries_match_prefixes(self):
+        """
+        Ensure queries too short for trigrams match name prefixes.
+        """
+        self.assertEqual(self.names(self.search('co')), ['Copper Wire'])
+
+    def test_keyset_pagination_visits_every_match_once(self):
+        """
+        Ensure following `next` pages through all matches without repeats.
+        """
+        Material.objects.bulk_create([
+            Material(company=self.company, name=f'Hex Bolt M{index}', unit='pcs', quantity=1) for index in range(25)
+        ])
+        seen, cursor, pages = [], None, 0
+        while True:
+            params = {'limit': 10, **({'cursor': cursor} if cursor else {})}
+            data = self.search('bolt', **params)
+            seen += self.names(data)
+            pages += 1
+            cursor = data['next']
+            if cursor is None:
+                break
+        self.assertEqual(pages, 3)
+        self.assertEqual(len(seen), 25)
+        self.assertEqual(len(set(seen)), 25)
+
+    def test_index_follows_writes(self):
+        """
+        Ensure renames, bulk updates and deletes are reflected in the index.
+        """
+        Material.objects.filter(pk=self.wire.pk).update(name='Brass Wire')
+        self.assertEqual(self.names(self.search('brass')), ['Brass Wire'])
+        self.assertEqual(self.names(self.search('copper')), [])
+        self.rod.delete()
+        self.assertEqual(self.names(self.search('steel')), ['Stainless Steel Sheet'])
+
+    def test_products_are_searchable(self):
+        """
+        Ensure the product search endpoint matches product names.
+        """
+        self.assertEqual(self.names(self.search('bench', resource='product')), ['Garden Bench'])
+
+    def test_invalid_requests_are_rejected(self):
+        """
+        Ensure a missing query or a tampered cursor is a 400.
+        """
+        url = reverse('material-search')
+        self.assertEqual(self.client.get(url).status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.client.get(url, {'q': 'steel', 'cursor': 'nonsense'}).status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class FieldSelectionTests(APITestCase):
+    def setUp(self):
+        self.company = Company.objects.create(name="Expand Corp")
+        self.user = User.objects.create_user(username='expander', password='password123')
+        UserProfile.objects.create(user=self.user, company=self.company, role='staff')
+        self.product = Product.objects.create(company=self.company, name='Table')
+        self.materials = [
+            Material.objects.create(company=self.company, name=f'Leg {index}', unit='pcs', quantity=100) for index in range(3)
+        ]
+        for material in self.materials:
+            ProductMaterialMapping.objects.create(company=self.company, product=self.product, material=material, fixed_quantity=4)
+        self.client.force_authenticate(user=self.user)
+
+    def test_fields_trim_the_payload(self):
+        """
+        Ensure ?fields= returns only the requested fields and rejects unknown ones.
+        """
+        response = self.client.get(reverse('material-list'), {'fields': 'id,name'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual({key for item in response.data for key in item}, {'id', 'name'})
+        response = self.client.get(reverse('material-list'), {'fields': 'id,colour'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_expand_embeds_related_objects(self):
+        """
+        Ensure ?expand= embeds related objects and nested ?fields= trims them.
+        """
+        response = self.client.get(
+            reverse('productmaterialmapping-list'), {'expand': 'product,material', 'fields': 'id,product,material.name'}
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        first = response.data[0]
+        self.assertEqual(set(first), {'id', 'product', 'material'})
+        self.assertEqual(first['product']['name'], 'Table')
+        self.assertEqual(set(first['material']), {'name'})
+
+        response = self.client.get(reverse('product-detail', kwargs={'pk': self.product.pk}), {'expand': 'mappings.material'})
+        self.assertEqual(sorted(mapping['material']['name'] for mapping in response.data['mappings']), ['Leg 0', 'Leg 1', 'Leg 2'])
+
+    def test_unknown_expansions_are_rejected(self):
+        """
+        Ensure only declared relations can be expanded.
+        """
+        response = self.client.get(reverse('productionorder-list'), {'expand': 'company'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('product', str(response.data['expand']))
+
+    def test_expansion_query_count_is_constant(self):
+        """
+        Ensure expanded lists cost the same number of queries for any number of rows.
+        """
+        def count(url, params):
+            with CaptureQueriesContext(connection) as queries:
+                self.assertEqual(self.client.get(url, params).status_code, status.HTTP_200_OK)
+            return len(queries)
+
+        ProductionOrder.objects.create(company=self.company, product=self.product, quantity=1)
+        small = (
+            count(reverse('productionorder-list'), {'expand': 'product'}),
+            count(reverse('product-list'), {'expand': 'mappings.material'}),
+        )
+        extra_product = Product.objects.create(company=self.company, name='Stool')
+        for index in range(5):
+            material = Material.objects.create(company=self.company, name=f'Seat {index}', unit='pcs', quantity=1)
+            ProductMaterialMapping.objects.create(company=self.company, product=extra_product, material=material, fixed_quantity=1)
+            ProductionOrder.objects.create(company=self.company, product=extra_product, quantity=1)
+        large = (
+            count(reverse('productionorder-list'), {'expand': 'product'}),
+            count(reverse('product-list'), {'expand': 'mappings.material'}),
+        )
+        self.assertEqual(small, large)
+
+    def test_etag_covers_expanded_resources(self):
+        """
+        Ensure changing an embedded material invalidates the expanded list's ETag only.
+        """
+        url = reverse('productmaterialmapping-list')
+        expanded = self.client.get(url, {'expand': 'material'})['ETag']
+        plain = self.client.get(url)['ETag']
+        self.assertNotEqual(expanded, plain)
+
+        material = self.materials[0]
+        material.name = 'Oak Leg'
+        material.save()
+
+        self.assertEqual(self.client.get(url, {'expand': 'material'}, HTTP_IF_NONE_MATCH=expanded).status_code, status.HTTP_200_OK)
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=plain).status_code, status.HTTP_304_NOT_MODIFIED)
+
+
+class BootstrapTests(APITestCase):
+    def setUp(self):
+        self.company = Company.objects.create(name="Bootstrap Corp")
+        self.user = User.objects.create_user(username='starter', password='password123', email='starter@example.com')
+        UserProfile.objects.create(user=self.user, company=self.company, role='staff')
+        self.product = Product.objects.create(company=self.company, name='Desk')
+        self.materials = [
+            Material.objects.create(company=self.company, name=f'Board {index}', unit='pcs', quantity=index * 10, low_stock_threshold=15)
+            for index in range(3)
+        ]
+        for material in self.materials:
+            ProductMaterialMapping.objects.create(company=self.company, product=self.product, material=material, fixed_quantity=1)
+        self.client.force_authenticate(user=self.user)
+
+    def test_snapshot_matches_the_individual_endpoints(self):
+        """
+        Ensure one bootstrap response carries what the six startup calls return.
+        """
+        response = self.client.get(reverse('bootstrap'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = response.json()
+        self.assertEqual(data['user'], self.client.get(reverse('current-user')).json())
+        self.assertEqual(data['products'], self.client.get(reverse('product-list')).json())
+        self.assertEqual(data['materials'], self.client.get(reverse('material-list')).json())
+        self.assertEqual(data['mappings'], self.client.get(reverse('productmaterialmapping-list')).json())
+        self.assertEqual(data['low_stock_materials'], self.client.get(reverse('lowstockmaterial-list')).json())
+        dashboard = self.client.get(reverse('dashboard-data')).json()
+        self.assertEqual(
+            data['dashboard'], {key: value for key, value in dashboard.items() if key != 'low_stock_materials'}
+        )
+        self.assertEqual(data['sections'], ['dashboard', 'products', 'materials', 'mappings', 'low_stock_materials'])
+        self.assertTrue(data['sync_token'])
+
+    def test_etag_changes_with_any_section(self):
+        """
+        Ensure the snapshot answers 304 until one of its resources changes.
+        """
+        etag = self.client.get(reverse('bootstrap'))['ETag']
+        self.assertEqual(self.client.get(reverse('bootstrap'), HTTP_IF_NONE_MATCH=etag).status_code, status.HTTP_304_NOT_MODIFIED)
+
+        ProductionOrder.objects.create(company=self.company, product=self.product, quantity=1)
+        response = self.client.get(reverse('bootstrap'), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data['dashboard']['recent_production_orders']), 1)
+
+    def test_sync_token_returns_only_changed_sections(self):
+        """
+        Ensure ?since= sends just the sections whose resources changed.
+        """
+        token = self.client.get(reverse('bootstrap')).data['sync_token']
+        response = self.client.get(reverse('bootstrap'), {'since': token})
+        self.assertEqual(response.data['sections'], [])
+        self.assertNotIn('materials', response.data)
+        self.assertEqual(response.data['sync_token'], token)
+
+        admin = User.objects.create_user(username='starter-admin', password='password123')
+        UserProfile.objects.create(user=admin, company=self.company, role='admin')
+        self.client.force_authenticate(user=admin)
+        self.client.post(reverse('inwardentry-list'), {'material': self.materials[0].pk, 'quantity': '50.00'}, format='json')
+        self.client.force_authenticate(user=self.user)
+
+        response = self.client.get(reverse('bootstrap'), {'since': token})
+        self.assertEqual(response.data['sections'], ['dashboard', 'materials', 'low_stock_materials'])
+        self.assertNotIn('products', response.data)
+        self.assertEqual(len(response.data['low_stock_materials']), 1)
+        self.assertEqual(response.data['dashboard']['product_count'], 1)
+        self.assertNotEqual(response.data['sync_token'], token)
+
+    def test_foreign_or_malformed_tokens_are_rejected(self):
+        """
+        Ensure a token from another company or garbage is a 400.
+        """
+        other = Company.objects.create(name="Other Corp")
+        other_user = User.objects.create_user(username='other-starter', password='password123')
+        UserProfile.objects.create(user=other_user, company=other, role='staff')
+        self.client.force_authenticate(user=other_user)
+        token = self.client.get(reverse('bootstrap')).data['sync_token']
+
+        self.client.force_authenticate(user=self.user)
+        for since in (token, 'not-a-token', 'W10'):
+            response = self.client.get(reverse('bootstrap'), {'since': since})
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST, since)
+
+    def test_snapshot_is_compressed(self):
+        """
+        Ensure large snapshots are gzip-encoded for clients that accept it.
+        """
+        Material.objects.bulk_create([
+            Material(company=self.company, name=f'Screw {index}', unit='pcs', quantity=100) for index in range(50)
+        ])
+        response = self.client.get(reverse('bootstrap'), HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(len(json.loads(gzip.decompress(response.content))['materials']), 53)
+
+    def test_archiving_bumps_the_history_version_once(self):
+        """
+        Ensure archiving a batch of orders bumps the version once, without per-row signals.
+        """
+        from .archiving import move_all
+        from .models import ResourceVersion
+
+        ProductionOrder.objects.bulk_create([
+            ProductionOrder(company=self.company, product=self.product, quantity=1) for _ in range(5)
+        ])
+        self.assertEqual(move_all(ProductionOrder.objects.all()), 5)
+        self.assertEqual(
+            ResourceVersion.objects.get(company=self.company, resource='production_orders').version, 1
+        )
+
+
+class BatchApplyTests(APITestCase):
+    def setUp(self):
+        self.company = Company.objects.create(name="Offline Corp")
+        self.user = User.objects.create_user(username='fielduser', password='password123')
+        UserProfile.objects.create(user=self.user, company=self.company, role='staff')
+        self.product = Product.objects.create(company=self.company, name='Crate')
+        self.material = Material.objects.create(company=self.company, name='Plank', unit='pcs', quantity=0)
+        ProductMaterialMapping.objects.create(company=self.company, product=self.product, material=self.material, fixed_quantity=2)
+        self.client.force_authenticate(user=self.user)
+
+    def batch(self, operations, atomic=False):
+        return self.client.post(reverse('batch-apply'), {'atomic': atomic, 'operations': operations}, format='json')
+
+    def test_operations_apply_in_order(self):
+        """
+        Ensure a later operation sees the stock written by an earlier one.
+        """
+        response = self.batch([
+            {'id': 'op-1', 'type': 'inward_entry.create', 'data': {'material': self.material.pk, 'quantity': '10.00'}},
+            {'id': 'op-2', 'type': 'production_order.create', 'data': {'product': self.product.pk, 'quantity': 3}},
+        ])
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.data['applied'])
+        self.assertEqual([result['status'] for result in response.data['results']], [201, 201])
+        self.material.refresh_from_db()
+        self.assertEqual(self.material.quantity, Decimal('4.00'))
+
+    def test_versions_are_bumped_once_after_the_batch(self):
+        """
+        Ensure the version rows are written once per resource, after every operation of the batch.
+        """
+        from .versioning import bump_version
+
+        bump_version(self.company.pk, 'inward_entries', 'production_orders')
+        with CaptureQueriesContext(connection) as queries:
+            response = self.batch([
+                {'id': 'op-1', 'type': 'inward_entry.create', 'data': {'material': self.material.pk, 'quantity': '10.00'}},
+                {'id': 'op-2', 'type': 'production_order.create', 'data': {'product': self.product.pk, 'quantity': 1}},
+                {'id': 'op-3', 'type': 'inward_entry.create', 'data': {'material': self.material.pk, 'quantity': '2.00'}},
+            ])
+        self.assertTrue(response.data['applied'])
+        statements = [query['sql'] for query in queries.captured_queries]
+        last_write = max(index for index, sql in enumerate(statements) if sql.startswith('INSERT INTO "api_inwardentry"'))
+        bumps = [index for index, sql in enumerate(statements) if 'api_resourceversion' in sql]
+        self.assertEqual(len(bumps), 1)
+        self.assertGreater(bumps[0], last_write)
+
+    def test_failed_operation_rolls_back_alone(self):
+        """
+        Ensure a failing operation is reported and the others still apply.
+        """
+        response = self.batch([
+            {'id': 'op-1', 'type': 'production_order.create', 'data': {'product': self.product.pk, 'quantity': 1}},
+            {'id': 'op-2', 'type': 'inward_entry.create', 'data': {'material': self.material.pk, 'quantity': '5.00'}},
+            {'id': 'op-3', 'type': 'material.update', 'object_id': self.material.pk, 'data': {'quantity': '1.00'}},
+        ])
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertFalse(response.data['applied'])
+        self.assertEqual([result['status'] for result in response.data['results']], [400, 201, 403])
+        self.assertIn('errors', response.data['results'][0])
+        self.assertEqual(ProductionOrder.objects.count(), 0)
+        self.material.refresh_from_db()
+        self.assertEqual(self.material.quantity, Decimal('5.00'))
+
+    def test_database_errors_fail_only_their_operation(self):
+        """
+        Ensure integrity and model validation errors are reported per operation instead of failing the batch.
+        """
+        from django.core.exceptions import ValidationError as DjangoValidationError
+        from django.db import IntegrityError
+        from .views import ProductionOrderViewSet
+
+        for error, code in ((IntegrityError('duplicate key'), 409), (DjangoValidationError('Bad quantity.'), 400)):
+            with self.subTest(error=type(error).__name__):
+                with mock.patch.object(ProductionOrderViewSet, 'perform_create', side_effect=error):
+                    response = self.batch([
+                        {'id': f'{code}-1', 'type': 'production_order.create', 'data': {'product': self.product.pk, 'quantity': 1}},
+                        {'id': f'{code}-2', 'type': 'inward_entry.create', 'data': {'material': self.material.pk, 'quantity': '1.00'}},
+                    ])
+                self.assertEqual(response.status_code, status.HTTP_200_OK)
+                self.assertEqual([result['status'] for result in response.data['results']], [code, 201])
+        self.assertEqual(InwardEntry.objects.count(), 2)
+        self.assertFalse(IdempotencyKey.objects.filter(key__in=['batch:409-1', 'batch:400-1']).exists())
+
+    def test_atomic_batch_rolls_back_everything(self):
+        """
+        Ensure one failure in an atomic batch leaves no trace of the others.
+        """
+        response = self.batch([
+            {'id': 'op-1', 'type': 'inward_entry.create', 'data': {'material': self.material.pk, 'quantity': '1.00'}},
+            {'id': 'op-2', 'type': 'production_order.create', 'data': {'product': self.product.pk, 'quantity': 5}},
+            {'id': 'op-3', 'type': 'inward_entry.create', 'data': {'material': self.material.pk, 'quantity': '1.00'}},
+        ], atomic=True)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(response.data['applied'])
+        self.assertEqual([result['status'] for result in response.data['results']], [424, 400, 424])
+        self.assertEqual(InwardEntry.objects.count(), 0)
+        self.assertFalse(IdempotencyKey.objects.exists())
+
+        # Nothing was recorded, so the corrected batch applies in full.
+        response = self.batch([
+            {'id': 'op-1', 'type': 'inward_entry.create', 'data': {'material': self.material.pk, 'quantity': '10.00'}},
+            {'id': 'op-2', 'type': 'production_order.create', 'data': {'product': self.product.pk, 'quantity': 5}},
+        ], atomic=True)
+        self.assertTrue(response.data['applied'])
+
+    def test_replayed_batch_applies_nothing_twice(self):
+        """
+        Ensure operations are deduplicated by their client ids.
+        """
+        operations = [
+            {'id': 'a1b2', 'type': 'inward_entry.create', 'data': {'material': self.material.pk, 'quantity': '7.00'}},
+        ]
+        first = self.batch(operations)
+        second = self.batch(operations)
+        self.assertEqual(second.data['results'][0]['data'], first.data['results'][0]['data'])
+        self.assertTrue(second.data['results'][0]['replayed'])
+        self.assertEqual(InwardEntry.objects.count(), 1)
+
+        operations[0]['data']['quantity'] = '8.00'
+        self.assertEqual(self.batch(operations).data['results'][0]['status'], 422)
+
+    def test_material_update_honours_version(self):
+        """
+        Ensure an update queued against an old version is rejected with 412.
+        """
+        admin = User.objects.create_user(username='fieldadmin', password='password123')
+        UserProfile.objects.create(user=admin, company=self.company, role='admin')
+        self.client.force_authenticate(user=admin)
+        operation = {'type': 'material.update', 'object_id': self.material.pk, 'data': {'name': 'Oak Plank'}}
+        stale = self.batch([{**operation, 'id': 'u1', 'version': self.material.version + 1}])
+        self.assertEqual(stale.data['results'][0]['status'], 412)
+        current = self.batch([{**operation, 'id': 'u2', 'version': self.material.version}])
+        self.assertEqual(current.data['results'][0]['status'], 200)
+        self.assertEqual(current.data['results'][0]['data']['name'], 'Oak Plank')
+
+    def test_envelope_is_validated(self):
+        """
+        Ensure duplicate ids, unknown types and missing object ids are rejected up front.
+        """
+        entry = {'type': 'inward_entry.create', 'data': {'material': self.material.pk, 'quantity': '1.00'}}
+        for operations in (
+            [],
+            [{**entry, 'id': 'x'}, {**entry, 'id': 'x'}],
+            [{**entry, 'id': 'x', 'type': 'product.delete'}],
+            [{'id': 'x', 'type': 'material.update', 'data': {}}],
+        ):
+            self.assertEqual(self.batch(operations).status_code, status.HTTP_400_BAD_REQUEST, operations)
+        with override_settings(BATCH_MAX_OPERATIONS=2):
+            operations = [{**entry, 'id': str(index)} for index in range(3)]
+            self.assertEqual(self.batch(operations).status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(InwardEntry.objects.count(), 0)
+
+
+class WarmupTests(APITestCase):
+    databases = '__all__'
+
+    def test_warm_up_runs_every_step_cleanly(self):
+        """
+        Ensure the pre-fork and per-worker warm-up steps all succeed.
+        """
+        from . import warmup
+
+        with self.assertNoLogs('api.warmup', level='WARNING'):
+            timings = warmup.warm_up()
+        self.assertEqual(list(timings), [name for name, _ in warmup.PREPARE_STEPS + warmup.CONNECT_STEPS])
+
+    def test_failing_step_does_not_stop_the_others(self):
+        """
+        Ensure a broken connection is logged and the remaining steps still run.
+        """
+        from . import warmup
+
+        steps = (('databases', mock.Mock(side_effect=OperationalError('down'))), ('caches', warmup.connect_caches))
+        with mock.patch.object(warmup, 'CONNECT_STEPS', steps), self.assertLogs('api.warmup', level='WARNING') as logs:
+            timings = warmup.connect()
+        self.assertEqual(len(logs.output), 1)
+        self.assertIn('databases', logs.output[0])
+        self.assertEqual(list(timings), ['databases', 'caches'])
+
+    def test_startup_profile_compares_cold_and_warm_starts(self):
+        """
+        Ensure the startup profiler reports phases, apps and imports for both runs.
+        """
+        out = StringIO()
+        call_command('startup_profile', '--json', stdout=out)
+        results = json.loads(out.getvalue())
+        self.assertEqual(set(results), {'cold', 'warm'})
+        self.assertNotIn('warm_up', results['cold']['phases'])
+        self.assertIn('warm_up', results['warm']['phases'])
+        for run in results.values():
+            self.assertIn('first_request', run['phases'])
+            self.assertEqual(run['statuses'], ['401 Unauthorized', '401 Unauthorized'])
+            self.assertIn('api', run['apps'])
+            self.assertIn('django', run['imports'])
+
+
+class LoadTestTests(TransactionTestCase):
+    databases = '__all__'
+
+    def test_scenarios_load(self):
+        """
+        Ensure every shipped scenario parses and names only known tasks.
+        """
+        from . import loadtest
+
+        for name in loadtest.available_scenarios():
+            scenario = loadtest.Scenario.load(name)
+            self.assertTrue(scenario.tasks, name)
+        with self.assertRaises(loadtest.ScenarioError):
+            loadtest.Scenario.load('no-such-scenario')
+
+    def test_rounds_report_latencies_and_keep_stock_consistent(self):
+        """
+        Ensure a short concurrent run reports every task and rebuilding the
+        fixture between rounds leaves the stock invariants intact.
+        """
+        out = StringIO()
+        call_command(
+            'loadtest', 'hot_material', '--clients', '1,2', '--duration', '0.5', '--no-throttle', '--seed', '1',
+            '--allow-production', '--json', stdout=out,
+        )
+        results = json.loads(out.getvalue())
+        self.assertEqual([result['clients'] for result in results['rounds']], [1, 2])
+        for result in results['rounds']:
+            self.assertEqual(result['problems'], [])
+            self.assertGreater(result['summary']['all']['requests'], 0)
+        # The in-memory test database locks whole tables between connections,
+        # so only the single-client round is expected to be free of errors.
+        self.assertEqual(results['rounds'][0]['summary']['all']['error_rate'], 0)
+        self.assertEqual(Company.objects.filter(name='Load Test').count(), 1)
+
+    def test_fixture_only_replaces_its_own_companies(self):
+        """
+        Ensure the fixture refuses to run outside DEBUG without the flag, and never replaces a real company or user.
+        """
+        from . import loadtest
+
+        spec = loadtest.Scenario.load('hot_material').fixture
+        with self.assertRaisesMessage(CommandError, '--allow-production'):
+            call_command('loadtest', 'hot_material', '--clients', '1', '--duration', '0.1', stdout=StringIO())
+
+        customer = Company.objects.create(name='Acme')
+        Product.objects.create(company=customer, name='Anvil')
+        with self.assertRaises(loadtest.FixtureError):
+            loadtest.build_fixture('Acme', spec, allow_production=True)
+        self.assertEqual(Product.objects.filter(company=customer).count(), 1)
+
+        user = User.objects.create_user(username='loadtest-lt-0', password='password123')
+        UserProfile.objects.create(user=user, company=customer, role='staff')
+        with self.assertRaises(loadtest.FixtureError):
+            loadtest.build_fixture('LT', spec, allow_production=True)
+        self.assertTrue(User.objects.filter(pk=user.pk).exists())
+        self.assertFalse(Company.objects.filter(name='LT').exists())
+
+        user.delete()
+        with override_settings(DEBUG=True):
+            first = loadtest.build_fixture('LT', spec)
+            second = loadtest.build_fixture('LT', spec)
+        self.assertTrue(second.company.load_test)
+        self.assertFalse(Company.objects.filter(pk=first.company.pk).exists())
+
+
+class StockReservationTests(APITestCase):
+    def setUp(self):
+        self.company = Company.objects.create(name="Planning Corp")
+        self.user = User.objects.create_user(username='planner', password='password123')
+        UserProfile.objects.create(user=self.user, company=self.company, role='staff')
+        self.product = Product.objects.create(company=self.company, name='Cabinet')
+        self.material = Material.objects.create(
+            company=self.company, name='Board', unit='pcs', quantity=10, low_stock_threshold=3
+        )
+        ProductMaterialMapping.objects.create(company=self.company, product=self.product, material=self.material, fixed_quantity=2)
+        InwardEntry.objects.create(company=self.company, material=self.material, quantity=10)
+        self.client.force_authenticate(user=self.user)
+
+    def reserve(self, quantity, **extra):
+        return self.client.post(
+            reverse('stockreservation-list'), {'material': self.material.pk, 'quantity': quantity, **extra}, format='json'
+        )
+
+    def test_reservation_holds_stock_without_deducting_it(self):
+        """
+        Ensure a reservation lowers the available quantity but not the stock.
+        """
+        response = self.reserve('6.00', note='Order for Friday')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.material.refresh_from_db()
+        self.assertEqual(self.material.quantity, Decimal('10.00'))
+        self.assertEqual(self.material.reserved_quantity, Decimal('6.00'))
+        data = self.client.get(reverse('material-detail', kwargs={'pk': self.material.pk})).data
+        self.assertEqual(Decimal(data['available_quantity']), Decimal('4.00'))
+
+        # Only the remaining four boards can still be promised.
+        self.assertEqual(self.reserve('5.00').status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.post(reverse('productionorder-list'), {'product': self.product.pk, 'quantity': 3}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('Available: 4.00', str(response.data))
+
+    def test_quantity_cannot_be_set_below_the_reserved_stock(self):
+        """
+        Ensure updates, bulk upserts and the admin refuse an absolute quantity below what is reserved.
+        """
+        self.reserve('6.00')
+        manager = User.objects.create_user(username='planning-admin', password='password123')
+        UserProfile.objects.create(user=manager, company=self.company, role='admin')
+        self.client.force_authenticate(user=manager)
+        url = reverse('material-detail', kwargs={'pk': self.material.pk})
+        response = self.client.patch(url, {'quantity': '5.00'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('reserved', str(response.data['quantity']))
+        response = self.client.post(reverse('material-bulk-upsert'), [{'name': 'Board', 'unit': 'pcs', 'quantity': '4.00'}], format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.material.refresh_from_db()
+        self.assertEqual(self.material.quantity, Decimal('10.00'))
+        self.assertEqual(self.client.patch(url, {'quantity': '6.00'}, format='json').status_code, status.HTTP_200_OK)
+
+        superuser = User.objects.create_superuser(username='root', password='password123', email='root@example.com')
+        self.client.force_login(superuser)
+        change_url = reverse('admin:api_material_change', args=[self.material.pk])
+        self.material.refresh_from_db()
+        form = {
+            'company': self.company.pk, 'name': 'Board', 'style': '', 'unit': 'pcs', 'low_stock_threshold': '3.00',
+            'version': self.material.version,
+        }
+        response = self.client.post(change_url, {**form, 'quantity': '2.00'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertContains(response, 'release reservations')
+        self.assertEqual(self.client.post(change_url, {**form, 'quantity': '8.00'}).status_code, status.HTTP_302_FOUND)
+        self.material.refresh_from_db()
+        self.assertEqual((self.material.quantity, self.material.reserved_quantity), (Decimal('8.00'), Decimal('6.00')))
+
+    def test_admin_reports_a_reservation_made_after_form_validation(self):
+        """
+        Ensure the admin's locked re-check shows an error message and leaves the quantity alone instead of failing with a 500.
+        """
+        superuser = User.objects.create_superuser(username='root', password='password123', email='root@example.com')
+        self.client.force_login(superuser)
+        self.material.refresh_from_db()
+        form = {
+            'company': self.company.pk, 'name': 'Board', 'style': '', 'unit': 'pcs', 'low_stock_threshold': '3.00',
+            'version': self.material.version, 'quantity': '2.00',
+        }
+
+        def reserve_while_saving(admin_form):
+            # The reservation lands between form validation and the save.
+            Material.objects.filter(pk=self.material.pk).update(reserved_quantity=6)
+            return admin_form.cleaned_data['quantity']
+
+        with mock.patch('api.admin.MaterialAdminForm.clean_quantity', reserve_while_saving):
+            response = self.client.post(reverse('admin:api_material_change', args=[self.material.pk]), form, follow=True)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertContains(response, 'Board has 6.00 reserved')
+        self.material.refresh_from_db()
+        self.assertEqual((self.material.quantity, self.material.reserved_quantity), (Decimal('10.00'), Decimal('6.00')))
+
+    def test_reads_use_available_quantity(self):
+        """
+        Ensure the calculator and low-stock lists count reserved stock as gone.
+        """
+        self.reserve('8.00')
+        rows = self.client.post(reverse('material-calculator'), {'product_id': self.product.pk, 'quantity': 2}, format='json').data
+        self.assertEqual(rows[0]['current_stock'], 10.0)
+        self.assertEqual(rows[0]['available_stock'], 2.0)
+        self.assertEqual(rows[0]['shortfall'], 2.0)
+        low_stock = self.client.get(reverse('lowstockmaterial-list')).data
+        self.assertEqual([material['id'] for material in low_stock], [self.material.pk])
+        dashboard = self.client.get(reverse('dashboard-data')).data
+        self.assertEqual(len(dashboard['low_stock_materials']), 1)
+
+    def test_production_order_consumes_its_reservations(self):
+        """
+        Ensure an order placed against its reservations can use the held stock
+        and releases them.
+        """
+        reservation = self.reserve('8.00').data['id']
+        response = self.client.post(
+            reverse('productionorder-list'), {'product': self.product.pk, 'quantity': 4, 'reservations': [reservation]},
+            format='json',
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED, response.data)
+        self.material.refresh_from_db()
+        self.assertEqual(self.material.quantity, Decimal('2.00'))
+        self.assertEqual(self.material.reserved_quantity, Decimal('0.00'))
+        self.assertFalse(StockReservation.objects.exists())
+
+    def test_release_and_sweep_return_reserved_stock(self):
+        """
+        Ensure deleting a reservation and sweeping expired ones give the
+        quantity back exactly once.
+        """
+        first = self.reserve('3.00').data['id']
+        self.reserve('4.00', expires_at=(timezone.now() + timedelta(minutes=5)).isoformat())
+        response = self.client.delete(reverse('stockreservation-detail', kwargs={'pk': first}))
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        self.material.refresh_from_db()
+        self.assertEqual(self.material.reserved_quantity, Decimal('4.00'))
+
+        StockReservation.objects.update(expires_at=timezone.now() - timedelta(seconds=1))
+        out = StringIO()
+        call_command('sweep_reservations', stdout=out)
+        self.assertIn('default: released 1 expired reservation(s).', out.getvalue())
+        self.material.refresh_from_db()
+        self.assertEqual(self.material.reserved_quantity, Decimal('0.00'))
+        call_command('sweep_reservations', stdout=StringIO())
+        self.material.refresh_from_db()
+        self.assertEqual(self.material.reserved_quantity, Decimal('0.00'))
+
+    def test_invalid_reservations_are_rejected(self):
+        """
+        Ensure reservations are validated and scoped to the user's company.
+        """
+        other = Company.objects.create(name="Elsewhere")
+        foreign = Material.objects.create(company=other, name='Board', unit='pcs', quantity=100)
+        response = self.client.post(reverse('stockreservation-list'), {'material': foreign.pk, 'quantity': '1.00'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.reserve('0.00').status_code, status.HTTP_400_BAD_REQUEST)
+        past = (timezone.now() - timedelta(hours=1)).isoformat()
+        self.assertEqual(self.reserve('1.00', expires_at=past).status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(StockReservation.objects.count(), 0)
+        foreign_reservation = StockReservation.objects.create(
+            company=other, material=foreign, quantity=1, expires_at=timezone.now() + timedelta(hours=1)
+        )
+        response = self.client.post(
+            reverse('productionorder-list'),
+            {'product': self.product.pk, 'quantity': 1, 'reservations': [foreign_reservation.pk]}, format='json',
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(
+            self.client.delete(reverse('stockreservation-detail', kwargs={'pk': foreign_reservation.pk})).status_code,
+            status.HTTP_404_NOT_FOUND,
+        )
+
+
+class StockStripeTests(APITestCase):
+    def setUp(self):
+        self.company = Company.objects.create(name="Packaging Corp")
+        self.admin = User.objects.create_user(username='stripeadmin', password='password123')
+        UserProfile.objects.create(user=self.admin, company=self.company, role='admin')
+        self.product = Product.objects.create(company=self.company, name='Boxed widget')
+        self.material = Material.objects.create(company=self.company, name='Label', unit='pcs', quantity=100)
+        ProductMaterialMapping.objects.create(company=self.company, product=self.product, material=self.material, fixed_quantity=5)
+        InwardEntry.objects.create(company=self.company, material=self.material, quantity=100)
+        call_command('stripe_material', str(self.material.pk), '--stripes', '4', stdout=StringIO())
+        self.material.refresh_from_db()
+        self.client.force_authenticate(user=self.admin)
+
+    def stripes(self):
+        return list(MaterialStockStripe.objects.filter(material=self.material).order_by('stripe').values_list('quantity', flat=True))
+
+    def on_hand(self):
+        return Decimal(self.client.get(reverse('material-detail', kwargs={'pk': self.material.pk})).data['quantity'])
+
+    def order(self, quantity, **extra):
+        return self.client.post(
+            reverse('productionorder-list'), {'product': self.product.pk, 'quantity': quantity, **extra}, format='json'
+        )
+
+    def test_expanded_striped_materials_are_read_in_one_query(self):
+        """
+        Ensure nested materials carry their stripe totals instead of summing them per row.
+        """
+        from . import stock_stripes
+
+        for index in range(3):
+            material = Material.objects.create(company=self.company, name=f'Sleeve {index}', unit='pcs', quantity=40)
+            ProductMaterialMapping.objects.create(company=self.company, product=self.product, material=material, fixed_quantity=1)
+            stock_stripes.configure(material, 2)
+        url = reverse('productmaterialmapping-list') + '?expand=material'
+        self.client.get(url)
+        with self.assertNumQueries(3):
+            rows = self.client.get(url).data
+        self.assertEqual(sorted(Decimal(row['material']['quantity']) for row in rows), [40, 40, 40, 100])
+
+    def test_version_bump_follows_the_stock_transaction(self):
+        """
+        Ensure the company-wide version row is written after the stripe write has been committed.
+        """
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(reverse('inwardentry-list'), {'material': self.material.pk, 'quantity': '4.00'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        statements = [query['sql'] for query in queries.captured_queries]
+        stripe_write = next(index for index, sql in enumerate(statements) if 'api_materialstockstripe' in sql)
+        committed = next(index for index, sql in enumerate(statements) if index > stripe_write and sql.startswith('RELEASE SAVEPOINT'))
+        bumps = [index for index, sql in enumerate(statements) if 'api_resourceversion' in sql]
+        self.assertEqual(len(bumps), 1)
+        self.assertGreater(bumps[0], committed)
+
+    def test_stock_is_spread_over_stripes_and_read_as_a_total(self):
+        """
+        Ensure striping moves the stock into the stripes and reads sum them.
+        """
+        self.assertEqual(self.stripes(), [Decimal('25.00')] * 4)
+        self.assertEqual(self.material.quantity, Decimal('0.00'))
+        self.assertEqual(self.on_hand(), Decimal('100.00'))
+        materials = self.client.get(reverse('material-list')).data
+        self.assertEqual(Decimal(materials[0]['quantity']), Decimal('100.00'))
+
+    def test_stock_changes_land_on_stripes_without_touching_the_material_row(self):
+        """
+        Ensure inward entries and orders only write a stripe, and the list ETag
+        still changes.
+        """
+        version = self.material.version
+        etag = self.client.get(reverse('material-list'))['ETag']
+        self.assertEqual(self.client.post(
+            reverse('inwardentry-list'), {'material': self.material.pk, 'quantity': '10.00'}, format='json'
+        ).status_code, status.HTTP_201_CREATED)
+        self.assertEqual(self.order(2).status_code, status.HTTP_201_CREATED)
+        self.material.refresh_from_db()
+        self.assertEqual(self.material.version, version)
+        self.assertEqual(self.material.quantity, Decimal('0.00'))
+        self.assertEqual(sum(self.stripes()), Decimal('100.00'))
+        self.assertEqual(self.on_hand(), Decimal('100.00'))
+        self.assertNotEqual(self.client.get(reverse('material-list'))['ETag'], etag)
+        response = self.client.get(reverse('material-detail', kwargs={'pk': self.material.pk}), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_deductions_never_drive_a_stripe_negative(self):
+        """
+        Ensure a short stripe falls back to rebalancing, and the total stock
+        is still enforced.
+        """
+        # 60 of the 100 labels: more than any single stripe holds.
+        self.assertEqual(self.order(12).status_code, status.HTTP_201_CREATED)
+        self.assertEqual(self.on_hand(), Decimal('40.00'))
+        self.assertEqual(self.stripes(), [Decimal('10.00')] * 4)
+        response = self.order(9)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('Available: 40.00', str(response.data))
+        self.assertEqual(self.order(8).status_code, status.HTTP_201_CREATED)
+        self.assertEqual(self.on_hand(), Decimal('0.00'))
+        self.assertTrue(all(quantity >= 0 for quantity in self.stripes()))
+
+    def test_reservations_hold_striped_stock(self):
+        """
+        Ensure reserved stock is moved onto the material row and kept from
+        other orders.
+        """
+        response = self.client.post(
+            reverse('stockreservation-list'), {'material': self.material.pk, 'quantity': '70.00'}, format='json'
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.material.refresh_from_db()
+        self.assertEqual(self.material.quantity, Decimal('70.00'))
+        self.assertEqual(sum(self.stripes()), Decimal('30.00'))
+        self.assertEqual(self.order(7).status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.order(20, reservations=[response.data['id']]).status_code, status.HTTP_201_CREATED)
+        self.assertEqual(self.on_hand(), Decimal('0.00'))
+
+    def test_absolute_writes_and_compaction(self):
+        """
+        Ensure setting the quantity replaces the striped stock, and compaction
+        folds the stripes of a material that is no longer striped.
+        """
+        response = self.client.patch(
+            reverse('material-detail', kwargs={'pk': self.material.pk}), {'quantity': '40.00'}, format='json'
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(Decimal(response.data['quantity']), Decimal('40.00'))
+        self.assertEqual(self.stripes(), [Decimal('0.00')] * 4)
+
+        out = StringIO()
+        call_command('compact_stock_stripes', stdout=out)
+        self.assertIn('compacted 1 striped material(s)', out.getvalue())
+        self.assertEqual(self.stripes(), [Decimal('10.00')] * 4)
+
+        Material.objects.filter(pk=self.material.pk).update(stock_stripes=0)
+        call_command('compact_stock_stripes', stdout=StringIO())
+        self.material.refresh_from_db()
+        self.assertEqual(self.stripes(), [])
+        self.assertEqual(self.material.quantity, Decimal('40.00'))
+
+
+class StockStripeBenchmarkTests(TransactionTestCase):
+    databases = '__all__'
+
+    def test_benchmark_compares_unstriped_and_striped_runs(self):
+        """
+        Ensure the benchmark runs the scenario both ways and the stock adds up.
+        """
+        out = StringIO()
+        call_command(
+            'benchmark_stock_stripes', '--clients', '1', '--duration', '0.5', '--stripes', '3', '--seed', '1',
+            '--allow-production', '--json', stdout=out,
+        )
+        rounds = json.loads(out.getvalue())['rounds']
+        self.assertEqual([(result['variant'], result['stripes']) for result in rounds], [('unstriped', 0), ('striped', 3)])
+        for result in rounds:
+            self.assertEqual(result['problems'], [])
+            self.assertEqual(result['summary']['all']['error_rate'], 0)
+        self.assertEqual(MaterialStockStripe.objects.values('material').distinct().count(), 2)
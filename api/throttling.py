@@ -0,0 +1,193 @@
+"""
+Per-company request throttling.
+
+Requests are limited per tenant and endpoint class (reads, writes, reports,
+exports) with a token bucket: a class with rate 'N/period' allows bursts of N
+requests and refills at N per period. The bucket state lives in a pluggable
+backend, configured in settings.API_THROTTLE:
+
+- LocalTokenBucket keeps buckets in process memory. It costs one dict lookup
+  under a lock, but every worker process enforces its own budget, so a
+  company can make up to rate x WEB_CONCURRENCY requests per period.
+- CacheTokenBucket keeps them in a Django cache shared by all workers. It is
+  the default when settings.SHARED_CACHE is on.
+"""
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.module_loading import import_string
+from rest_framework.throttling import BaseThrottle
+
+DURATIONS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+DEFAULTS = {
+    'BACKEND': 'api.throttling.LocalTokenBucket',
+    'CACHE_ALIAS': 'default',
+    'RATES': {},
+}
+
+
+def get_setting(name):
+    return getattr(settings, 'API_THROTTLE', {}).get(name, DEFAULTS[name])
+
+
+def parse_rate(rate):
+    """
+    Parses 'N/period' (period: s, m, h or d, optionally spelt out) into
+    (capacity, tokens per second). Returns None for an unlimited class.
+    """
+    if rate is None:
+        return None
+    count, period = rate.split('/')
+    capacity = int(count)
+    return capacity, capacity / DURATIONS[period[0]]
+
+
+class LocalTokenBucket:
+    """
+    Token buckets held in this process.
+    """
+    MAX_BUCKETS = 10000
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buckets = {}
+
+    def consume(self, key, capacity, refill_rate, cost=1):
+        """
+        Takes `cost` tokens. Returns 0 if the request may proceed, otherwise
+        the number of seconds until enough tokens are available.
+        """
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - updated) * refill_rate)
+            if tokens < cost:
+                self._buckets[key] = (tokens, now)
+                return (cost - tokens) / refill_rate
+            if len(self._buckets) >= self.MAX_BUCKETS and key not in self._buckets:
+                self._prune(now, capacity / refill_rate)
+            self._buckets[key] = (tokens - cost, now)
+            return 0
+
+    def _prune(self, now, idle_seconds):
+        # Buckets idle long enough to have refilled carry no state worth keeping.
+        self._buckets = {
+            key: (tokens, updated) for key, (tokens, updated) in self._buckets.items()
+            if now - updated < idle_seconds
+        }
+
+    def reset(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+class CacheTokenBucket:
+    """
+    Token buckets shared through a Django cache, stored as a single "bucket
+    full again at" timestamp per key (the GCRA form of a token bucket). The
+    read-modify-write is not atomic, so concurrent workers may occasionally
+    let a request or two over the budget.
+    """
+
+    def __init__(self):
+        self.cache = caches[get_setting('CACHE_ALIAS')]
+
+    def consume(self, key, capacity, refill_rate, cost=1):
+        now = time.time()
+        interval = 1 / refill_rate
+        full_at = max(self.cache.get(key, now), now)
+        # Tokens in the bucket = (capacity interval - (full_at - now)) / interval.
+        wait = full_at + cost * interval - now - capacity * interval
+        if wait > 0:
+            return wait
+        self.cache.set(key, full_at + cost * interval, timeout=int(capacity * interval) + 1)
+        return 0
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                _backend = import_string(get_setting('BACKEND'))()
+    return _backend
+
+
+def reset_backend():
+    global _backend
+    _backend = None
+
+
+class CompanyRateThrottle(BaseThrottle):
+    """
+    Throttles by company and endpoint class. The class is `scope` when set on
+    a subclass, else the view's `throttle_scope`, else reads for safe methods
+    and writes for everything else.
+    """
+    scope = None
+
+    def get_scope(self, request, view):
+        if self.scope is not None:
+            return self.scope
+        scope = getattr(view, 'throttle_scope', None)
+        if scope is not None:
+            return scope
+        return 'reads' if request.method in ('GET', 'HEAD', 'OPTIONS') else 'writes'
+
+    def get_cost(self, request, view):
+        """
+        Returns the number of tokens the request takes.
+        """
+        return 1
+
+    def get_tenant(self, request):
+        user = request.user
+        if not user or not user.is_authenticated:
+            return f'ip:{self.get_ident(request)}'
+        try:
+            return f'company:{user.profile.company_id}'
+        except AttributeError:
+            return f'user:{user.pk}'
+
+    def allow_request(self, request, view):
+        self.wait_seconds = None
+        scope = self.get_scope(request, view)
+        rate = parse_rate(get_setting('RATES').get(scope))
+        if rate is None:
+            return True
+        capacity, refill_rate = rate
+        key = f'api:throttle:{scope}:{self.get_tenant(request)}'
+        # A request costing more than a full bucket would never be allowed.
+        cost = min(self.get_cost(request, view), capacity)
+        self.wait_seconds = get_backend().consume(key, capacity, refill_rate, cost) or None
+        return self.wait_seconds is None
+
+    def wait(self):
+        return self.wait_seconds
+
+
+class ReportRateThrottle(CompanyRateThrottle):
+    scope = 'reports'
+
+
+class ExportRateThrottle(CompanyRateThrottle):
+    scope = 'exports'
+
+
+class BatchRateThrottle(CompanyRateThrottle):
+    """
+    Charges POST /api/batch/ one writes token per operation, as if each had
+    been sent on its own.
+    """
+    scope = 'writes'
+
+    def get_cost(self, request, view):
+        operations = request.data.get('operations') if isinstance(request.data, dict) else None
+        return max(len(operations), 1) if isinstance(operations, list) else 1
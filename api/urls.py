@@ -7,6 +7,7 @@ from .views import (
     ProductionOrderViewSet,
     InwardEntryViewSet,
     LowStockMaterialViewSet,
+    StockReservationViewSet,
     material_usage_by_product,
     overall_material_usage,
     overall_report,
@@ -14,6 +15,10 @@ from .views import (
     material_calculator
 )
 from .user_views import RegisterView, AdminUserCreateView, UserListView, UserDetailView
+from .ops_views import db_connection_stats, profile_download, profile_list, slow_query_summary
+from .report_job_views import ReportJobViewSet
+from .bootstrap import bootstrap
+from .batch import batch_apply
 
 router = DefaultRouter()
 router.register(r'products', ProductViewSet, basename='product')
@@ -22,6 +27,8 @@ router.register(r'mappings', ProductMaterialMappingViewSet, basename='productmat
 router.register(r'production-orders', ProductionOrderViewSet, basename='productionorder')
 router.register(r'inward-entries', InwardEntryViewSet, basename='inwardentry')
 router.register(r'low-stock-materials', LowStockMaterialViewSet, basename='lowstockmaterial')
+router.register(r'reservations', StockReservationViewSet, basename='stockreservation')
+router.register(r'report-jobs', ReportJobViewSet, basename='reportjob')
 
 urlpatterns = [
     path('register/', RegisterView.as_view(), name='register'),
@@ -30,8 +37,14 @@ urlpatterns = [
     path('users/', UserListView.as_view(), name='user-list'),
     path('', include(router.urls)),
     path('dashboard/', dashboard_data, name='dashboard-data'),
+    path('bootstrap/', bootstrap, name='bootstrap'),
+    path('batch/', batch_apply, name='batch-apply'),
     path('calculator/', material_calculator, name='material-calculator'),
     path('reports/material-usage/<int:product_id>/', material_usage_by_product, name='material-usage-by-product'),
     path('reports/overall-material-usage/', overall_material_usage, name='overall-material-usage'),
     path('reports/overall-report/', overall_report, name='overall-report'),
+    path('ops/db-connections/', db_connection_stats, name='db-connection-stats'),
+    path('ops/profiles/', profile_list, name='profile-list'),
+    path('ops/profiles/<str:name>/', profile_download, name='profile-download'),
+    path('ops/slow-queries/', slow_query_summary, name='slow-query-summary'),
 ]
@@ -47,7 +47,7 @@ class UserListView(generics.ListAPIView):
             return User.objects.filter(
                 profile__company=self.request.user.profile.company,
                 profile__company__isnull=False
-            )
+            ).select_related('profile__company')
         except AttributeError:
             return User.objects.none()
 
@@ -59,7 +59,7 @@ class UserDetailView(generics.RetrieveUpdateDestroyAPIView):
             return User.objects.filter(
                 profile__company=self.request.user.profile.company,
                 profile__company__isnull=False
-            )
+            ).select_related('profile__company')
         except AttributeError:
             return User.objects.none()
 
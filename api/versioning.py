@@ -0,0 +1,257 @@
+import hashlib
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.db import OperationalError, transaction
+from django.db.models import F
+from django.utils import timezone
+from django.utils.http import http_date, parse_etags, parse_http_date_safe
+from rest_framework import status
+from rest_framework.exceptions import APIException
+from rest_framework.response import Response
+
+from . import metrics
+from .models import ResourceVersion
+
+
+_pending_bumps = ContextVar('versioning_pending_bumps', default=None)
+BUMP_ATTEMPTS = 5
+
+
+def bump_version(company_id, *resources):
+    """
+    Increments the change version of each resource for the given company,
+    with one UPDATE for all of them. Runs inside the caller's transaction, so
+    a rolled back write never invalidates client caches. Inside
+    coalesced_bumps() the resources are only recorded.
+    """
+    if company_id is None or not resources:
+        return
+    pending = _pending_bumps.get()
+    if pending is not None:
+        pending.setdefault(company_id, set()).update(resources)
+        return
+    resources = sorted(set(resources))
+    now = timezone.now()
+    rows = ResourceVersion.objects.filter(company_id=company_id, resource__in=resources)
+    if rows.update(version=F('version') + 1, updated_at=now) == len(resources):
+        return
+    # First write of some resource: create its row at 0 (another request may
+    # do the same), then bump it.
+    missing = set(resources) - set(rows.values_list('resource', flat=True))
+    ResourceVersion.objects.bulk_create(
+        [ResourceVersion(company_id=company_id, resource=resource, version=0, updated_at=now) for resource in missing],
+        ignore_conflicts=True,
+    )
+    ResourceVersion.objects.filter(company_id=company_id, resource__in=missing).update(
+        version=F('version') + 1, updated_at=now
+    )
+
+
+@contextmanager
+def coalesced_bumps():
+    """
+    Collects the bump_version() calls made inside the block (including the
+    post_save signals) and writes them with one bump_version() per company
+    when the block exits without an error; nested blocks leave the write to
+    the outermost one. Wrapped around a write transaction, this keeps the
+    company-wide version rows out of it: they are locked only after it has
+    committed. The data is committed by then, so a bump that fails on a lock
+    error is retried rather than reported as a failed write.
+    """
+    if _pending_bumps.get() is not None:
+        yield
+        return
+    pending = {}
+    token = _pending_bumps.set(pending)
+    try:
+        yield
+    finally:
+        _pending_bumps.reset(token)
+    for company_id, resources in pending.items():
+        if transaction.get_connection().in_atomic_block:
+            # Still inside an outer transaction, which a failure rolls back.
+            bump_version(company_id, *resources)
+            continue
+        for attempt in range(BUMP_ATTEMPTS):
+            try:
+                bump_version(company_id, *resources)
+                break
+            except OperationalError:
+                if attempt == BUMP_ATTEMPTS - 1:
+                    raise
+                time.sleep(0.05 * (attempt + 1))
+
+
+def get_versions(company_id, resources):
+    """
+    Returns {resource: (version, updated_at)} for the given company in one query.
+    Resources that were never written report version 0 and no timestamp.
+    """
+    versions = {resource: (0, None) for resource in resources}
+    rows = ResourceVersion.objects.filter(company_id=company_id, resource__in=resources).values_list(
+        'resource', 'version', 'updated_at'
+    )
+    for resource, version, updated_at in rows:
+        versions[resource] = (version, updated_at)
+    return versions
+
+
+def build_validators(company_id, resources, scope=''):
+    """
+    Computes a strong ETag and Last-Modified value for the given resources.
+    `scope` distinguishes representations of the same data (view, object id,
+    query string) so they never share an ETag.
+    """
+    return validators_for(company_id, get_versions(company_id, resources), scope)
+
+
+def validators_for(company_id, versions, scope=''):
+    """
+    build_validators() for versions the caller has already read.
+    """
+    token = ';'.join(f'{resource}={versions[resource][0]}' for resource in sorted(versions))
+    digest = hashlib.sha1(f'{company_id}|{token}|{scope}'.encode()).hexdigest()
+    timestamps = [updated_at for _, updated_at in versions.values() if updated_at is not None]
+    return f'"{digest}"', max(timestamps) if timestamps else None
+
+
+def is_not_modified(request, etag, last_modified):
+    """
+    Evaluates If-None-Match (preferred) or If-Modified-Since against the
+    current validators.
+    """
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match:
+        # Weak comparison: compression middleware may weaken the stored tag.
+        client_etags = [tag.removeprefix('W/') for tag in parse_etags(if_none_match)]
+        return '*' in client_etags or etag in client_etags
+    if_modified_since = parse_http_date_safe(request.headers.get('If-Modified-Since', ''))
+    if if_modified_since is not None and last_modified is not None:
+        return int(last_modified.timestamp()) <= if_modified_since
+    return False
+
+
+def set_validators(response, etag, last_modified):
+    response['ETag'] = etag
+    if last_modified is not None:
+        response['Last-Modified'] = http_date(last_modified.timestamp())
+    return response
+
+
+class PreconditionFailed(APIException):
+    status_code = status.HTTP_412_PRECONDITION_FAILED
+    default_detail = 'The resource was modified by another request. Fetch it again and retry.'
+    default_code = 'precondition_failed'
+
+
+def object_etag(model, pk, version):
+    """
+    The ETag of a single versioned object; it changes with every write.
+    """
+    return f'"{model._meta.model_name}-{pk}-v{version}"'
+
+
+def expected_version(request, instance):
+    """
+    Returns the version an update must apply to. With If-Match, the object's
+    current ETag must be listed, otherwise PreconditionFailed is raised;
+    without it, the version read by this request is used.
+    """
+    if_match = request.headers.get('If-Match')
+    if if_match:
+        client_etags = [tag.removeprefix('W/') for tag in parse_etags(if_match)]
+        if '*' not in client_etags and object_etag(type(instance), instance.pk, instance.version) not in client_etags:
+            raise PreconditionFailed()
+    return instance.version
+
+
+def conditional_update(instance, version, **fields):
+    """
+    Writes `fields` with UPDATE ... WHERE version = `version`, incrementing the
+    version. Raises PreconditionFailed if another write got there first.
+    """
+    updated = type(instance)._base_manager.using(instance._state.db).filter(pk=instance.pk, version=version).update(
+        version=F('version') + 1, **fields
+    )
+    if not updated:
+        raise PreconditionFailed()
+    instance.refresh_from_db()
+    return instance
+
+
+class ConditionalGetMixin:
+    """
+    Adds ETag / Last-Modified support to the list and retrieve actions of a
+    company-scoped viewset. The validators are derived from the per-company
+    resource versions, so a matching conditional request is answered with 304
+    before the main queryset or serializer runs.
+    """
+    version_resources = ()
+
+    def get_version_resources(self):
+        return self.version_resources
+
+    def get_validators(self, request, **kwargs):
+        try:
+            company_id = request.user.profile.company_id
+        except AttributeError:
+            return None
+        query = '&'.join(sorted(f'{key}={value}' for key, value in request.query_params.items()))
+        scope = f"{type(self).__name__}|{self.action}|{kwargs.get(self.lookup_field, '')}|{query}"
+        return build_validators(company_id, self.get_version_resources(), scope)
+
+    def conditional_response(self, handler, request, *args, **kwargs):
+        # Read the versions before the data: a concurrent write can only make
+        # the ETag older than the body, never newer.
+        validators = self.get_validators(request, **kwargs)
+        if validators is None:
+            return handler(request, *args, **kwargs)
+        etag, last_modified = validators
+        if is_not_modified(request, etag, last_modified):
+            metrics.cache_requests.inc(cache='etag', result='hit')
+            return set_validators(Response(status=status.HTTP_304_NOT_MODIFIED), etag, last_modified)
+        metrics.cache_requests.inc(cache='etag', result='miss')
+        response = handler(request, *args, **kwargs)
+        if response.status_code == status.HTTP_200_OK:
+            set_validators(response, etag, last_modified)
+        return response
+
+    def list(self, request, *args, **kwargs):
+        return self.conditional_response(super().list, request, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.conditional_response(super().retrieve, request, *args, **kwargs)
+
+
+class OptimisticUpdateMixin:
+    """
+    Optimistic concurrency for viewsets of versioned models. Retrieve
+    responses carry a per-object ETag, updates honour If-Match and are
+    applied with a conditional UPDATE that answers 412 on conflict. Place it
+    before ConditionalGetMixin.
+    """
+
+    def get_validators(self, request, **kwargs):
+        # An expanded representation also changes with the embedded rows.
+        if self.action != 'retrieve' or request.query_params.get('expand'):
+            return super().get_validators(request, **kwargs)
+        lookup = kwargs.get(self.lookup_url_kwarg or self.lookup_field)
+        row = self.get_queryset().filter(**{self.lookup_field: lookup}).values_list('pk', 'version').first()
+        if row is None:
+            return None
+        return object_etag(self.get_queryset().model, *row), None
+
+    def perform_update(self, serializer):
+        instance = serializer.instance
+        version = expected_version(self.request, instance)
+        conditional_update(instance, version, **serializer.validated_data)
+        # Queryset updates skip the post_save signal.
+        bump_version(instance.company_id, *self.get_version_resources())
+
+    def update(self, request, *args, **kwargs):
+        response = super().update(request, *args, **kwargs)
+        if response.status_code == status.HTTP_200_OK:
+            response['ETag'] = object_etag(self.get_queryset().model, response.data['id'], response.data['version'])
+        return response
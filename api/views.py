@@ -1,45 +1,61 @@
-from datetime import timedelta
 from django.db import transaction
-from django.utils import timezone
 from rest_framework import viewsets, status, serializers
-from rest_framework.decorators import api_view, permission_classes as api_permission_classes
+from rest_framework.decorators import action, api_view, permission_classes as api_permission_classes, throttle_classes
 from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated
-from django.db.models import F
-from .models import Product, Material, ProductMaterialMapping, ProductionOrder, InwardEntry
-from .serializers import ProductSerializer, MaterialSerializer, ProductMaterialMappingSerializer, ProductionOrderSerializer, InwardEntrySerializer
+from django.db.models import F, Prefetch
+from .models import Product, Material, ProductMaterialMapping, ProductionOrder, InwardEntry, ArchivedProductionOrder, ArchivedInwardEntry, StockReservation
+from .serializers import ProductSerializer, MaterialSerializer, ProductMaterialMappingSerializer, ProductionOrderSerializer, InwardEntrySerializer, BomEntrySerializer, StockReservationSerializer
+from . import metrics, reports, reservations as stock_reservations, stock_stripes
+from .bom import bom_etag, lock_boms, replace_bom
+from .bulk_upsert import BulkUpsertMixin
+from .expansion import ExpandableViewSetMixin
+from .idempotency import IdempotentCreateMixin
 from .permissions import IsAdminUser
+from .routing import use_read_replica
+from .search import MATERIALS, PRODUCTS, SearchMixin
+from .throttling import ReportRateThrottle
+from .versioning import ConditionalGetMixin, OptimisticUpdateMixin, bump_version, coalesced_bumps, object_etag
 
-class LowStockMaterialViewSet(viewsets.ReadOnlyModelViewSet):
+# Loads mapped materials with on_hand in one query, however many are striped.
+MATERIALS_WITH_STOCK = Prefetch('material', queryset=Material.objects.with_stock())
+
+class LowStockMaterialViewSet(ExpandableViewSetMixin, ConditionalGetMixin, viewsets.ReadOnlyModelViewSet):
     """
     API endpoint that allows viewing of materials that are low on stock.
     """
     serializer_class = MaterialSerializer
+    read_replica = True
+    version_resources = ('materials',)
     permission_classes = [IsAuthenticated]
 
     def get_queryset(self):
         """
         This view should return a list of all materials for the user's company
-        where the quantity is less than or equal to the low_stock_threshold.
+        where the available (unreserved) quantity is less than or equal to the
+        low_stock_threshold.
         """
         try:
             user_company = self.request.user.profile.company
-            return Material.objects.filter(
+            return Material.objects.with_stock().filter(
                 company=user_company,
-                quantity__lte=F('low_stock_threshold')
+                on_hand_quantity__lte=F('low_stock_threshold') + F('reserved_quantity')
             )
         except AttributeError:
             # Handle cases where user has no profile (e.g., superuser) or no company
             return Material.objects.none()
 
-class ProductViewSet(viewsets.ModelViewSet):
+class ProductViewSet(SearchMixin, BulkUpsertMixin, ExpandableViewSetMixin, ConditionalGetMixin, viewsets.ModelViewSet):
     """
     API endpoint that allows products to be viewed or edited.
     """
     serializer_class = ProductSerializer
+    read_replica = True
+    version_resources = ('products',)
+    search_index = PRODUCTS
 
     def get_permissions(self):
-        if self.action in ['list', 'retrieve']:
+        if self.action in ['list', 'retrieve', 'search'] or (self.action == 'mappings' and self.request.method == 'GET'):
             self.permission_classes = [IsAuthenticated]
         else:
             self.permission_classes = [IsAdminUser]
@@ -68,11 +84,35 @@ class ProductViewSet(viewsets.ModelViewSet):
         else:
             raise serializers.ValidationError("Admin user cannot create company-specific resources.")
 
-class InwardEntryViewSet(viewsets.ModelViewSet):
+    @action(detail=True, methods=['get', 'put'])
+    def mappings(self, request, pk=None):
+        """
+        GET returns the product's full bill of materials; PUT replaces it with
+        the submitted list in one transaction and bumps the product's BOM
+        version. Both carry the BOM version as ETag, and PUT honours If-Match.
+        """
+        product = self.get_object()
+        summary = {}
+        if request.method == 'PUT':
+            entries = BomEntrySerializer(data=request.data, many=True)
+            entries.is_valid(raise_exception=True)
+            product, summary = replace_bom(product, entries.validated_data, request=request)
+
+        mappings = ProductMaterialMapping.objects.filter(product=product).order_by('material_id')
+        data = {
+            'product': product.pk,
+            'bom_version': product.bom_version,
+            'mappings': ProductMaterialMappingSerializer(mappings, many=True).data,
+            **summary,
+        }
+        return Response(data, headers={'ETag': bom_etag(product)})
+
+class InwardEntryViewSet(IdempotentCreateMixin, ExpandableViewSetMixin, viewsets.ModelViewSet):
     """
     API endpoint that allows inward entries to be viewed or edited.
     """
     serializer_class = InwardEntrySerializer
+    read_replica = True
 
     def get_permissions(self):
         if self.action in ['list', 'retrieve', 'create']:
@@ -92,21 +132,34 @@ class InwardEntryViewSet(viewsets.ModelViewSet):
 
     def perform_create(self, serializer):
         if hasattr(self.request.user, 'profile'):
-            inward_entry = serializer.save(company=self.request.user.profile.company)
-            material = inward_entry.material
-            material.quantity += inward_entry.quantity
-            material.save()
+            company = self.request.user.profile.company
+            # The entry's post_save bump and the materials bump are written
+            # together, after the stock transaction.
+            with coalesced_bumps(), transaction.atomic():
+                inward_entry = serializer.save(company=company)
+                if inward_entry.material.stock_stripes:
+                    stock_stripes.add(inward_entry.material, inward_entry.quantity)
+                else:
+                    # A single UPDATE: concurrent entries and edits cannot lose each other's changes.
+                    Material.objects.filter(pk=inward_entry.material_id).update(
+                        quantity=F('quantity') + inward_entry.quantity, version=F('version') + 1
+                    )
+                bump_version(company.pk, 'materials')
+            metrics.stock_mutations.inc(kind='inward')
         else:
             raise serializers.ValidationError("Admin user cannot create company-specific resources.")
 
-class MaterialViewSet(viewsets.ModelViewSet):
+class MaterialViewSet(SearchMixin, BulkUpsertMixin, ExpandableViewSetMixin, OptimisticUpdateMixin, ConditionalGetMixin, viewsets.ModelViewSet):
     """
     API endpoint that allows materials to be viewed or edited.
     """
     serializer_class = MaterialSerializer
+    read_replica = True
+    version_resources = ('materials',)
+    search_index = MATERIALS
 
     def get_permissions(self):
-        if self.action in ['list', 'retrieve']:
+        if self.action in ['list', 'retrieve', 'search']:
             self.permission_classes = [IsAuthenticated]
         else:
             self.permission_classes = [IsAdminUser]
@@ -114,13 +167,50 @@ class MaterialViewSet(viewsets.ModelViewSet):
 
     def get_queryset(self):
         try:
-            return Material.objects.filter(
+            return Material.objects.with_stock().filter(
                 company=self.request.user.profile.company,
                 company__isnull=False
             )
         except AttributeError:
             return Material.objects.none()
 
+    def get_validators(self, request, **kwargs):
+        # Stock changes of a striped material do not write its row, so its
+        # row version cannot validate a cached copy; the company's materials
+        # version, bumped by every stock change, can.
+        if self.action == 'retrieve' and not request.query_params.get('expand'):
+            lookup = kwargs.get(self.lookup_url_kwarg or self.lookup_field)
+            row = self.get_queryset().filter(pk=lookup).values_list('pk', 'version', 'stock_stripes').first()
+            if row is None:
+                return None
+            if not row[2]:
+                return object_etag(Material, row[0], row[1]), None
+        return ConditionalGetMixin.get_validators(self, request, **kwargs)
+
+    def perform_update(self, serializer):
+        with transaction.atomic():
+            if 'quantity' in serializer.validated_data:
+                error = stock_reservations.below_reserved({serializer.instance.pk: serializer.validated_data['quantity']})
+                if error:
+                    raise serializers.ValidationError({'quantity': error})
+            if serializer.instance.stock_stripes and 'quantity' in serializer.validated_data:
+                # The new quantity is the whole stock.
+                stock_stripes.discard([serializer.instance.pk])
+            super().perform_update(serializer)
+        # Re-read the stripes for the response.
+        serializer.instance.striped_quantity = None
+
+    def write_upsert(self, model, company, fields, created, updated):
+        # plan_upsert() locked the rows, so their reserved quantities are current.
+        error = stock_reservations.reserved_stock_error([
+            (current.name, current.reserved_quantity) for current, row, changes in updated
+            if 'quantity' in changes and row['quantity'] < current.reserved_quantity
+        ])
+        if error:
+            raise serializers.ValidationError({'quantity': error})
+        stock_stripes.discard([current.pk for current, _, changes in updated if current.stock_stripes and 'quantity' in changes])
+        super().write_upsert(model, company, fields, created, updated)
+
     def perform_create(self, serializer):
         if hasattr(self.request.user, 'profile'):
             company = self.request.user.profile.company
@@ -131,11 +221,13 @@ class MaterialViewSet(viewsets.ModelViewSet):
         else:
             raise serializers.ValidationError("Admin user cannot create company-specific resources.")
 
-class ProductMaterialMappingViewSet(viewsets.ModelViewSet):
+class ProductMaterialMappingViewSet(ExpandableViewSetMixin, OptimisticUpdateMixin, ConditionalGetMixin, viewsets.ModelViewSet):
     """
     API endpoint that allows product-material mappings to be viewed or edited.
     """
     serializer_class = ProductMaterialMappingSerializer
+    read_replica = True
+    version_resources = ('mappings',)
 
     def get_permissions(self):
         if self.action in ['list', 'retrieve']:
@@ -159,11 +251,31 @@ class ProductMaterialMappingViewSet(viewsets.ModelViewSet):
         else:
             raise serializers.ValidationError("Admin user cannot create company-specific resources.")
 
-class ProductionOrderViewSet(viewsets.ModelViewSet):
+    def perform_update(self, serializer):
+        # The conditional UPDATE skips the signal that bumps the BOM version,
+        # and the mapping may have moved to another product.
+        product_ids = {serializer.instance.product_id}
+        if 'product' in serializer.validated_data:
+            product_ids.add(serializer.validated_data['product'].pk)
+        with transaction.atomic():
+            lock_boms(product_ids)
+            super().perform_update(serializer)
+            Product.objects.filter(pk__in=product_ids).update(bom_version=F('bom_version') + 1)
+            bump_version(serializer.instance.company_id, 'products')
+
+    def perform_destroy(self, instance):
+        # The post_delete signal updates the product after the mapping row is
+        # locked, so take the product lock first.
+        with transaction.atomic(savepoint=False):
+            lock_boms([instance.product_id])
+            instance.delete()
+
+class ProductionOrderViewSet(IdempotentCreateMixin, ExpandableViewSetMixin, viewsets.ModelViewSet):
     """
     API endpoint that allows production orders to be viewed or edited.
     """
     serializer_class = ProductionOrderSerializer
+    read_replica = True
 
     def get_permissions(self):
         if self.action in ['list', 'retrieve', 'create']:
@@ -187,41 +299,146 @@ class ProductionOrderViewSet(viewsets.ModelViewSet):
 
         product = serializer.validated_data['product']
         quantity = serializer.validated_data['quantity']
+        reservations = list({reservation.pk: reservation for reservation in serializer.validated_data.pop('reservations', [])}.values())
 
         # Rule 1: Ensure the product has material mappings
-        mappings = ProductMaterialMapping.objects.filter(product=product)
-        if not mappings.exists():
+        mappings = list(ProductMaterialMapping.objects.filter(product=product).prefetch_related(MATERIALS_WITH_STOCK))
+        if not mappings:
             raise serializers.ValidationError(
                 "Production failed: This product has no mapped materials."
             )
+        material_ids = [mapping.material_id for mapping in mappings]
 
         # Rule 2: For the first production run, ensure all materials have an inward history
-        is_first_production = not ProductionOrder.objects.filter(product=product).exists()
+        # Archived history counts too, so archiving never changes the outcome.
+        is_first_production = not (
+            ProductionOrder.objects.filter(product=product).exists()
+            or ArchivedProductionOrder.objects.filter(product=product).exists()
+        )
         if is_first_production:
+            with_history = set(
+                InwardEntry.objects.filter(material_id__in=material_ids).values_list('material_id', flat=True).distinct()
+            )
+            if len(with_history) < len(material_ids):
+                with_history.update(
+                    ArchivedInwardEntry.objects.filter(material_id__in=material_ids)
+                    .values_list('material_id', flat=True).distinct()
+                )
             for mapping in mappings:
-                if not InwardEntry.objects.filter(material=mapping.material).exists():
+                if mapping.material_id not in with_history:
                     raise serializers.ValidationError(
                         f"Production failed: The material '{mapping.material.name}' has no inward entry record. "
                         "Please make an inward entry for all mapped materials before the first production run."
                     )
 
-        # Check for sufficient materials
+        # Reservations the order consumes must belong to the company and the BOM.
+        for reservation in reservations:
+            if reservation.company_id != self.request.user.profile.company_id:
+                raise serializers.ValidationError({'reservations': f'Reservation {reservation.pk} not found in your company.'})
+            if reservation.material_id not in material_ids:
+                raise serializers.ValidationError(
+                    {'reservations': f"Reservation {reservation.pk} is not for a material of this product."}
+                )
+
+        # Check for sufficient materials. Stock reserved for other orders is
+        # not available; this order's own reservations are.
         for mapping in mappings:
             required_quantity = mapping.fixed_quantity * quantity
-            if mapping.material.quantity < required_quantity:
+            available = mapping.material.available_quantity + sum(
+                reservation.quantity for reservation in reservations if reservation.material_id == mapping.material_id
+            )
+            if available < required_quantity:
+                metrics.insufficient_stock.inc(material_id=mapping.material_id)
                 raise serializers.ValidationError(
                     f"Not enough {mapping.material.name} in stock. "
-                    f"Required: {required_quantity}, Available: {mapping.material.quantity}"
+                    f"Required: {required_quantity}, Available: {available}"
                 )
 
-        # Deduct materials and save the order
-        with transaction.atomic():
-            for mapping in mappings:
-                mapping.material.quantity -= mapping.fixed_quantity * quantity
-                mapping.material.save()
+        # Release the consumed reservations, deduct materials and save the
+        # order. The deduction is one conditional UPDATE over all unstriped
+        # materials, so a concurrent order can never drive the stock negative
+        # or into stock reserved for others. Striped materials are deducted
+        # from one of their stripes each (see api/stock_stripes.py), in
+        # material order so that concurrent orders lock them in the same order.
+        required = {mapping.material_id: mapping.fixed_quantity * quantity for mapping in mappings}
+        striped = {mapping.material_id: mapping.material for mapping in mappings if mapping.material.stock_stripes}
+        plain = {material_id: amount for material_id, amount in required.items() if material_id not in striped}
+        with coalesced_bumps(), transaction.atomic():
+            count, _ = stock_reservations.release(reservations)
+            if count != len(reservations):
+                raise serializers.ValidationError(
+                    {'reservations': 'A reservation expired or was released while placing the order. Please retry.'}
+                )
+            # The reservations' quantities were just moved from reserved back
+            # to available, so the condition below sees them as available.
+            required_expr = stock_reservations.amount_case(plain)
+            deducted = Material.objects.filter(
+                pk__in=plain, quantity__gte=F('reserved_quantity') + required_expr
+            ).update(quantity=F('quantity') - required_expr, version=F('version') + 1) if plain else 0
+            if deducted != len(plain):
+                available = dict(
+                    Material.objects.filter(pk__in=plain)
+                    .values_list('pk', F('quantity') - F('reserved_quantity'))
+                )
+                for mapping in mappings:
+                    if mapping.material_id in plain and available[mapping.material_id] < required[mapping.material_id]:
+                        metrics.insufficient_stock.inc(material_id=mapping.material_id)
+                        raise serializers.ValidationError(
+                            f"Not enough {mapping.material.name} in stock. "
+                            f"Required: {required[mapping.material_id]}, Available: {available[mapping.material_id]}"
+                        )
+                # Stock was replenished between the UPDATE and this read.
+                raise serializers.ValidationError("Stock levels changed while placing the order. Please retry.")
+            for material_id in sorted(striped):
+                taken, available = stock_stripes.take(striped[material_id], required[material_id])
+                if not taken:
+                    metrics.insufficient_stock.inc(material_id=material_id)
+                    raise serializers.ValidationError(
+                        f"Not enough {striped[material_id].name} in stock. "
+                        f"Required: {required[material_id]}, Available: {available}"
+                    )
 
             serializer.save(company=self.request.user.profile.company)
+            bump_version(self.request.user.profile.company_id, 'materials')
+        metrics.stock_mutations.inc(kind='production')
 
+class StockReservationViewSet(IdempotentCreateMixin, ExpandableViewSetMixin, viewsets.ModelViewSet):
+    """
+    API endpoint that allows stock to be reserved for planned production.
+    Deleting a reservation releases it; a production order that lists it
+    in `reservations` consumes it.
+    """
+    serializer_class = StockReservationSerializer
+    read_replica = True
+    permission_classes = [IsAuthenticated]
+    http_method_names = ['get', 'post', 'delete', 'head', 'options']
+
+    def get_queryset(self):
+        try:
+            return StockReservation.objects.filter(
+                company=self.request.user.profile.company,
+                company__isnull=False
+            )
+        except AttributeError:
+            return StockReservation.objects.none()
+
+    def perform_create(self, serializer):
+        if not hasattr(self.request.user, 'profile'):
+            raise serializers.ValidationError("Admin user cannot create company-specific resources.")
+        company = self.request.user.profile.company
+        material = serializer.validated_data['material']
+        if material.company_id != company.pk:
+            raise serializers.ValidationError({'material': 'Material not found in your company.'})
+        serializer.instance = stock_reservations.reserve(
+            company, material, serializer.validated_data['quantity'],
+            expires_at=serializer.validated_data.get('expires_at'), note=serializer.validated_data.get('note', ''),
+        )
+
+    def perform_destroy(self, instance):
+        with coalesced_bumps(), transaction.atomic():
+            stock_reservations.release([instance])
+
+@use_read_replica
 @api_view(['GET'])
 @api_permission_classes([IsAuthenticated])
 def dashboard_data(request):
@@ -237,9 +454,9 @@ def dashboard_data(request):
         material_count = Material.objects.filter(company=company).count()
 
         # Low Stock Materials
-        low_stock_materials = Material.objects.filter(
+        low_stock_materials = Material.objects.with_stock().filter(
             company=company,
-            quantity__lte=F('low_stock_threshold')
+            on_hand_quantity__lte=F('low_stock_threshold') + F('reserved_quantity')
         )
         low_stock_serializer = MaterialSerializer(low_stock_materials, many=True)
 
@@ -269,8 +486,10 @@ def dashboard_data(request):
             'recent_inward_entries': [],
         })
 
+@use_read_replica
 @api_view(['GET'])
 @api_permission_classes([IsAuthenticated])
+@throttle_classes([ReportRateThrottle])
 def material_usage_by_product(request, product_id):
     """
     Calculates material usage for a specific product based on production orders.
@@ -283,32 +502,12 @@ def material_usage_by_product(request, product_id):
     except Product.DoesNotExist:
         return Response(status=status.HTTP_404_NOT_FOUND)
 
-    frequency = request.query_params.get('frequency', 'daily').lower()
-    now = timezone.now()
-    if frequency == 'daily':
-        start_date = now - timedelta(days=1)
-    elif frequency == 'weekly':
-        start_date = now - timedelta(weeks=1)
-    elif frequency == 'monthly':
-        start_date = now - timedelta(days=30) # approximation
-    else:
+    try:
+        start_date = reports.start_date_for(request.query_params.get('frequency', 'daily').lower())
+    except ValueError:
         return Response({'error': 'Invalid frequency parameter'}, status=status.HTTP_400_BAD_REQUEST)
 
-    production_orders = ProductionOrder.objects.filter(
-        company=request.user.profile.company,
-        product=product,
-        created_at__gte=start_date
-    )
-
-    material_usage = {}
-    for order in production_orders:
-        mappings = ProductMaterialMapping.objects.filter(product=order.product)
-        for mapping in mappings:
-            material_name = mapping.material.name
-            usage = mapping.fixed_quantity * order.quantity
-            material_usage[material_name] = material_usage.get(material_name, 0) + usage
-
-    return Response(material_usage)
+    return Response(reports.material_usage(request.user.profile.company, start_date, product=product))
 
 
 @api_view(['POST'])
@@ -316,6 +515,7 @@ def material_usage_by_product(request, product_id):
 def material_calculator(request):
     """
     Calculates the required materials, current stock, and shortfall for producing a given quantity of a product.
+    The shortfall is measured against the available stock: reserved quantities are already promised.
     """
     try:
         product_id = request.data.get('product_id')
@@ -331,8 +531,8 @@ def material_calculator(request):
         user_company = request.user.profile.company
         product = Product.objects.get(pk=product_id, company=user_company)
 
-        mappings = ProductMaterialMapping.objects.filter(product=product)
-        if not mappings.exists():
+        mappings = list(ProductMaterialMapping.objects.filter(product=product).prefetch_related(MATERIALS_WITH_STOCK))
+        if not mappings:
             return Response({'error': 'No material mappings found for this product.'}, status=status.HTTP_404_NOT_FOUND)
 
         results = []
@@ -340,7 +540,8 @@ def material_calculator(request):
             material = mapping.material
             required_quantity = mapping.fixed_quantity * quantity_to_produce
             current_stock = material.quantity
-            shortfall = max(0, required_quantity - current_stock)
+            available_stock = material.available_quantity
+            shortfall = max(0, required_quantity - available_stock)
 
             results.append({
                 'material_id': material.id,
@@ -348,6 +549,8 @@ def material_calculator(request):
                 'material_unit': material.unit,
                 'required_quantity': float(required_quantity),
                 'current_stock': float(current_stock),
+                'reserved_quantity': float(material.reserved_quantity),
+                'available_stock': float(available_stock),
                 'shortfall': float(shortfall),
             })
 
@@ -360,93 +563,37 @@ def material_calculator(request):
     except Exception as e:
         return Response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
+@use_read_replica
 @api_view(['GET'])
 @api_permission_classes([IsAuthenticated])
+@throttle_classes([ReportRateThrottle])
 def overall_report(request):
     """
     Calculates the overall report of material inward vs. usage.
     Query parameters:
     - frequency: 'daily', 'weekly', or 'monthly'
     """
-    frequency = request.query_params.get('frequency', 'daily').lower()
-    now = timezone.now()
-    if frequency == 'daily':
-        start_date = now - timedelta(days=1)
-    elif frequency == 'weekly':
-        start_date = now - timedelta(weeks=1)
-    elif frequency == 'monthly':
-        start_date = now - timedelta(days=30) # approximation
-    else:
+    try:
+        start_date = reports.start_date_for(request.query_params.get('frequency', 'daily').lower())
+    except ValueError:
         return Response({'error': 'Invalid frequency parameter'}, status=status.HTTP_400_BAD_REQUEST)
 
-    # Calculate total inward quantity
-    inward_entries = InwardEntry.objects.filter(
-        company=request.user.profile.company,
-        created_at__gte=start_date
-    )
-    inward_quantity = {}
-    for entry in inward_entries:
-        material_name = entry.material.name
-        inward_quantity[material_name] = inward_quantity.get(material_name, 0) + entry.quantity
-
-    # Calculate total material usage
-    production_orders = ProductionOrder.objects.filter(
-        company=request.user.profile.company,
-        created_at__gte=start_date
-    )
-    material_usage = {}
-    for order in production_orders:
-        mappings = ProductMaterialMapping.objects.filter(product=order.product)
-        for mapping in mappings:
-            material_name = mapping.material.name
-            usage = mapping.fixed_quantity * order.quantity
-            material_usage[material_name] = material_usage.get(material_name, 0) + usage
-
-    # Calculate the overall report
-    overall_report = {}
-    all_materials = set(inward_quantity.keys()) | set(material_usage.keys())
-    for material in all_materials:
-        inward = inward_quantity.get(material, 0)
-        usage = material_usage.get(material, 0)
-        overall_report[material] = {
-            'inward': inward,
-            'usage': usage,
-            'balance': inward - usage
-        }
-
-    return Response(overall_report)
+    return Response(reports.overall_report(request.user.profile.company, start_date))
 
 
+@use_read_replica
 @api_view(['GET'])
 @api_permission_classes([IsAuthenticated])
+@throttle_classes([ReportRateThrottle])
 def overall_material_usage(request):
     """
     Calculates overall material usage across all products based on production orders.
     Query parameters:
     - frequency: 'daily', 'weekly', or 'monthly'
     """
-    frequency = request.query_params.get('frequency', 'daily').lower()
-    now = timezone.now()
-    if frequency == 'daily':
-        start_date = now - timedelta(days=1)
-    elif frequency == 'weekly':
-        start_date = now - timedelta(weeks=1)
-    elif frequency == 'monthly':
-        start_date = now - timedelta(days=30) # approximation
-    else:
+    try:
+        start_date = reports.start_date_for(request.query_params.get('frequency', 'daily').lower())
+    except ValueError:
         return Response({'error': 'Invalid frequency parameter'}, status=status.HTTP_400_BAD_REQUEST)
 
-    production_orders = ProductionOrder.objects.filter(
-        company=request.user.profile.company,
-        created_at__gte=start_date
-    )
-
-    material_usage = {}
-    for order in production_orders:
-        mappings = ProductMaterialMapping.objects.filter(product=order.product)
-        for mapping in mappings:
-            material_name = mapping.material.name
-            usage = mapping.fixed_quantity * order.quantity
-            material_usage[material_name] = material_usage.get(material_name, 0) + usage
-
-    return Response(material_usage)
+    return Response(reports.material_usage(request.user.profile.company, start_date))
@@ -0,0 +1,157 @@
+"""
+Worker warm-up: does the work Django and DRF otherwise leave to the first
+request.
+
+prepare() needs no I/O and runs in the gunicorn master when preload_app is
+on, so every forked worker inherits its results. connect() opens the
+database and cache connections and runs in each worker after the fork
+(connections must never be shared across processes). Both steps log and
+skip what fails: a worker that cannot warm up still serves requests.
+"""
+import logging
+import time
+
+from django.apps import apps
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connections
+from django.urls import URLPattern, URLResolver, get_resolver
+from django.utils import translation
+
+from . import routing
+
+logger = logging.getLogger(__name__)
+
+
+def _views(patterns):
+    for pattern in patterns:
+        if isinstance(pattern, URLResolver):
+            yield from _views(pattern.url_patterns)
+        elif isinstance(pattern, URLPattern):
+            yield pattern.callback
+
+
+def load_urls():
+    resolver = get_resolver()
+    # reverse_dict builds the lookup tables that resolve() and reverse() use.
+    resolver.reverse_dict
+    return resolver
+
+
+def load_rest_framework():
+    from rest_framework.settings import api_settings
+    from rest_framework_simplejwt.authentication import JWTAuthentication
+    from rest_framework_simplejwt.state import token_backend
+
+    # Each api_settings attribute imports its classes on first access.
+    for name in ('DEFAULT_AUTHENTICATION_CLASSES', 'DEFAULT_PERMISSION_CLASSES', 'DEFAULT_THROTTLE_CLASSES',
+                 'DEFAULT_RENDERER_CLASSES', 'DEFAULT_PARSER_CLASSES', 'DEFAULT_CONTENT_NEGOTIATION_CLASS',
+                 'EXCEPTION_HANDLER'):
+        getattr(api_settings, name)
+    JWTAuthentication()
+    # Signs and verifies a throwaway token, loading PyJWT's algorithms.
+    token_backend.decode(token_backend.encode({'warmup': True}))
+
+
+def _serializer_classes():
+    classes = []
+    for view in _views(load_urls().url_patterns):
+        serializer_class = getattr(getattr(view, 'cls', None), 'serializer_class', None)
+        if serializer_class is not None and serializer_class not in classes:
+            classes.append(serializer_class)
+    return classes
+
+
+def build_serializers():
+    """
+    Builds the fields of every routed view's serializer once, which imports
+    and compiles everything field construction needs.
+    """
+    for serializer_class in _serializer_classes():
+        serializer_class().fields
+
+
+def load_models():
+    for model in apps.get_models():
+        routing.is_tenant_model(model)
+
+
+def load_translations():
+    translation.activate(settings.LANGUAGE_CODE)
+    translation.deactivate()
+
+
+def connect_databases():
+    for alias in connections:
+        if alias == settings.READ_REPLICA_ALIAS and routing.replica_enabled():
+            # Records an outage the same way request routing does.
+            routing.replica_available()
+            continue
+        connection = connections[alias]
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT 1')
+        if getattr(connection, 'pool', None) is not None:
+            # Hand the connection back; the pool keeps it open.
+            connection.close()
+    if routing.sharding_enabled():
+        routing.tenant_databases()
+
+
+def run_queries():
+    """
+    Runs one empty primary-key lookup per served model, which compiles the
+    ORM's lazily built SQL paths on this worker's connection.
+    """
+    models = {getattr(getattr(serializer_class, 'Meta', None), 'model', None) for serializer_class in _serializer_classes()}
+    for model in filter(None, models):
+        list(model.objects.filter(pk=0))
+
+
+def connect_caches():
+    for alias in settings.CACHES:
+        caches[alias].get('warmup')
+
+
+PREPARE_STEPS = (
+    ('urls', load_urls),
+    ('rest_framework', load_rest_framework),
+    ('serializers', build_serializers),
+    ('models', load_models),
+    ('translations', load_translations),
+)
+CONNECT_STEPS = (
+    ('databases', connect_databases),
+    ('queries', run_queries),
+    ('caches', connect_caches),
+)
+
+
+def _run(steps):
+    timings = {}
+    for name, step in steps:
+        started = time.perf_counter()
+        try:
+            step()
+        except Exception:
+            logger.warning('Warm-up step %s failed.', name, exc_info=True)
+        timings[name] = (time.perf_counter() - started) * 1000
+    return timings
+
+
+def prepare():
+    """
+    Runs the steps that need no connections. Returns {step: milliseconds}.
+    """
+    return _run(PREPARE_STEPS)
+
+
+def connect():
+    """
+    Opens this process's database and cache connections. Returns
+    {step: milliseconds}.
+    """
+    return _run(CONNECT_STEPS)
+
+
+def warm_up():
+    return {**prepare(), **connect()}
@@ -0,0 +1,13 @@
+"""
+Settings for the test suite (manage.py test picks them automatically): the
+regular settings plus the stand-in replica and tenant shard that the routing
+tests need.
+"""
+from .settings import *  # noqa: F401,F403
+from .settings import BASE_DIR, DATABASES, DATABASE_SHARD_INDEX, USE_SQLITE
+
+for _alias in ('replica', 'shard_1'):
+    if _alias not in DATABASES:
+        _name = BASE_DIR / f'db_{_alias}.sqlite3' if USE_SQLITE else f"{DATABASES['default']['NAME']}_{_alias}"
+        DATABASES[_alias] = dict(DATABASES['default'], NAME=_name)
+DATABASE_SHARD_INDEX.setdefault('shard_1', len(DATABASE_SHARD_INDEX))
@@ -21,10 +21,12 @@ from rest_framework_simplejwt.views import (
     TokenObtainPairView,
     TokenRefreshView,
 )
+from api.metrics import metrics_view
 from api.user_views import CurrentUserView
 
 urlpatterns = [
     path("admin/", admin.site.urls),
+    path("metrics", metrics_view, name="metrics"),
     path("api/me/", CurrentUserView.as_view(), name="current-user"),
     path("api/", include("api.urls")),
     path('api/token/', TokenObtainPairView.as_view(), name='token_obtain_pair'),
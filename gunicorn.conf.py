@@ -0,0 +1,43 @@
+"""
+Gunicorn settings: gunicorn -c gunicorn.conf.py backend.wsgi:application
+
+The application is loaded once in the master (preload_app) and warmed up
+before the workers fork, so each worker starts with Django, DRF and the URL
+and serializer tables already built. Each worker then opens its own
+database and cache connections before it accepts its first request. The
+bind address and worker count come from PORT and WEB_CONCURRENCY as usual.
+"""
+import os
+
+preload_app = True
+timeout = int(os.getenv('GUNICORN_TIMEOUT', '30'))
+
+
+def _format(timings):
+    return ', '.join(f'{step} {milliseconds:.0f} ms' for step, milliseconds in timings.items())
+
+
+def when_ready(server):
+    from api import warmup
+
+    server.log.info('Warm-up (master): %s', _format(warmup.prepare()))
+
+
+def post_fork(server, worker):
+    from api import metrics
+
+    # A worker starts with no counts of its own.
+    metrics.reset()
+
+
+def post_worker_init(worker):
+    from api import warmup
+
+    worker.log.info('Warm-up (worker %s): %s', worker.pid, _format(warmup.connect()))
+
+
+def child_exit(server, worker):
+    from api import metrics
+
+    # Keep the exited worker's counts; its pid may be handed to a new worker.
+    metrics.retire_process(worker.pid)